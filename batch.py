@@ -0,0 +1,89 @@
+import json
+import re
+
+from myutils import natsort
+from excel_reader import read_excel_columns
+from ingestion import needed_columns
+from normalization import drop_kein_material
+from schema import is_compact, compact_results
+
+
+# START BATCH CONFIGURATIONS
+# Several cuts of the same data in one run: each configuration changes some of the parameters below (the others are
+# those of program_parameters.py) and gets its own final sheet. The raw results are merged once and turned into the
+# compact layout of schema.py once, keeping Kein Material rows; each configuration then only drops them if it does not
+# keep them and goes through the stages depending on it: deduplication (reference parameter), grid (num_max_days),
+# sheets (sub_period_duration) and writing.
+#
+# The configurations are a json list, e.g.
+# [
+#  {"name": "proenkephalin", "reference_parameter": "Proenkephalin"},
+#  {"name": "albumin-50-days", "reference_parameter": "Albumin", "num_max_days": 50, "sub_period_duration": 7, "keep_kein_material": "n"}
+# ]
+
+batch_settings = ['num_max_days', 'sub_period_duration', 'reference_parameter', 'keep_kein_material']
+
+def load_batch_configurations(filepath, defaults, parameter_catalog):
+	'''Reads the configurations of filepath; returns a list of dictionaries with name and every key of batch_settings,
+	missing keys taken from defaults. Raises ValueError on invalid configurations.'''
+	from processing import period_maker
+
+	with open(filepath) as file:
+		entries = json.load(file)
+	if not isinstance(entries, list) or len(entries) == 0:
+		raise ValueError(f'{filepath} must contain a non empty list of configurations')
+
+	configurations = []
+	for i, entry in enumerate(entries):
+		if not isinstance(entry, dict):
+			raise ValueError(f'Configuration {i+1} of {filepath} is not a dictionary')
+		unknown = sorted(set(entry) - set(batch_settings) - {'name'})
+		if len(unknown) > 0:
+			raise ValueError(f'Configuration {i+1} of {filepath} has unknown settings {", ".join(unknown)}, choose among {", ".join(batch_settings)}')
+
+		configuration = {'name': str(entry.get('name', f'config{i+1}'))}
+		configuration.update({ setting: entry.get(setting, defaults[setting]) for setting in batch_settings })
+		name = configuration['name']
+
+		# the name ends up in the file names of the final sheets
+		if re.fullmatch(r'[A-Za-z0-9_.-]+', name) is None:
+			raise ValueError(f'Configuration name {name!r} may only contain letters, digits, _, . and -')
+		if name in [ other['name'] for other in configurations ]:
+			raise ValueError(f'Configuration name {name} appears more than once in {filepath}')
+		if not isinstance(configuration['num_max_days'], int) or not isinstance(configuration['sub_period_duration'], int) or configuration['sub_period_duration'] <= 0:
+			raise ValueError(f'Configuration {name}: num_max_days and sub_period_duration must be positive whole numbers')
+		try:
+			period_maker(configuration['num_max_days'], configuration['sub_period_duration'])
+		except Exception as error:
+			raise ValueError(f'Configuration {name}: {str(error).strip()}') from None
+		if configuration['reference_parameter'] not in parameter_catalog['parameters']:
+			raise ValueError(f'Configuration {name}: reference_parameter {configuration["reference_parameter"]} is not a needed parameter')
+		if configuration['keep_kein_material'] not in ('y', 'n'):
+			raise ValueError(f"Configuration {name}: keep_kein_material must be 'y' or 'n'")
+
+		configurations.append(configuration)
+	return configurations
+
+def compact_patients(sources, parameter_catalog, initial_day_of_study, negative_result, positive_result, excel_reader = 'auto'):
+	'''Compact layout of the rows of each patient, keeping Kein Material rows; sources maps filename -> raw rows or path
+	of the patient file, read once here
+
+	Patients that cannot be read or compacted keep their source, so that each configuration reports their error as a normal run would.
+	'''
+	compact = {}
+	for patient in sorted(sources, key = natsort):
+		source = sources[patient]
+		try:
+			data = read_excel_columns(source, needed_columns, excel_reader) if isinstance(source, str) else source.reset_index(drop = True)
+			compact[patient] = compact_results(data, parameter_catalog, initial_day_of_study, negative_result, positive_result, 'y')
+		except Exception:
+			compact[patient] = source
+	return compact
+
+def configuration_data(compact, keep_kein_material):
+	'''The rows each patient enters the configuration with: the compact rows, without Kein Material unless kept'''
+	if keep_kein_material != 'n':
+		return compact
+	return { patient: drop_kein_material(data) if not isinstance(data, str) and is_compact(data) else data for patient, data in compact.items() }
+
+# END BATCH CONFIGURATIONS
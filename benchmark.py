@@ -0,0 +1,224 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from program_parameters import *
+from myutils import red
+from magic import initial_day_of_study
+from synthetic_cohort import write_cohort
+
+
+# START BENCHMARK
+# Times each stage of the pipeline on synthetic cohorts (see synthetic_cohort.py) of several sizes, and with --memory
+# measures the peak memory traced during each stage in a second pass (tracing slows everything down):
+# ingest (reading the raw exports), merge (concatenating and splitting by patient), normalize (compact schema),
+# dedupe, grid (cells of each patient and final array) and write (final workbook).
+# The golden check runs the whole program on a fixed cohort, once through the patient files and once with --direct,
+# and compares the final sheets with benchmark_golden.json, so that optimizations can be checked to change nothing.
+# The leading zero check runs it on a cohort whose PATIFALLNR start with a zero and checks every patient is in the final sheet.
+
+default_scales = ['20x20x2', '100x30x3', '400x30x3']
+stages = ['ingest', 'merge', 'normalize', 'dedupe', 'grid', 'write']
+
+golden_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_golden.json')
+golden_cohort = {'patients': 25, 'days': 20, 'samples_per_day': 2, 'files': 2, 'seed': 0}
+leading_zero_cohort = {'patients': 5, 'days': 10, 'samples_per_day': 2, 'files': 1, 'seed': 0, 'first_patient': 1000000}
+
+def parse_scale(scale):
+	'''patients x days x samples per day, e.g. 100x30x3'''
+	patients, days, samples_per_day = (int(n) for n in scale.split('x'))
+	return patients, days, samples_per_day
+
+def measure(function, memory):
+	'''Returns the result of function, its wall time and, if memory, the peak traced memory in MB'''
+	if memory:
+		tracemalloc.start()
+	start = time.perf_counter()
+	result = function()
+	seconds = time.perf_counter() - start
+	peak = None
+	if memory:
+		peak = tracemalloc.get_traced_memory()[1] / 1e6
+		tracemalloc.stop()
+	return result, seconds, peak
+
+def run_stages(root, memory = False):
+	'''Runs the stages one after the other on the study directory root; returns {stage: (rows, seconds, peak MB)}'''
+	import numpy as np
+	from parameter_catalog import compile_parameter_catalog
+	from patients import read_patients_map, index_patients_map
+	from ingestion import raw_results_files, read_raw_results_file, concat_raw_results
+	from export import partition_by_patient
+	from schema import compact_results, day_offsets
+	from deduplication import resolve_duplicate_exams
+	from grid import patient_cells, build_grid, grid_sheets, sheet_to_dataframe
+	from processing import data_splitter
+	from workbook import write_workbook
+
+	catalog = compile_parameter_catalog(f'{root}/parameters_directory')
+	patients_map = read_patients_map(f'{root}/patients_map.xlsx')
+	patient_numbers, patient_day0s = index_patients_map(patients_map)
+	patients_8_digit = set(patients_map.PATIFALLNR)
+	raw_directory = f'{root}/{lab_results_raw_directory}'
+	report = {}
+
+	def ingest():
+		return [ read_raw_results_file(f'{raw_directory}/{raw_result}', patients_8_digit, catalog)[0] for raw_result in raw_results_files(raw_directory) ]
+	frames, seconds, peak = measure(ingest, memory)
+	report['ingest'] = (sum(len(frame) for frame in frames), seconds, peak)
+
+	def merge():
+		raw_df = concat_raw_results(frames)
+		return partition_by_patient(raw_df, raw_df.PATIFALLNR.to_numpy() // 10)
+	raw_df_by_patient, seconds, peak = measure(merge, memory)
+	report['merge'] = (sum(len(frame) for frame in raw_df_by_patient.values()), seconds, peak)
+
+	def normalize():
+		return { patient: compact_results(frame, catalog, initial_day_of_study, negative_result, positive_result, keep_kein_material) for patient, frame in raw_df_by_patient.items() }
+	compact_by_patient, seconds, peak = measure(normalize, memory)
+	report['normalize'] = (sum(len(data) for data in compact_by_patient.values()), seconds, peak)
+
+	def dedupe():
+		return { patient: data.loc[resolve_duplicate_exams(data, reference_parameter, data.VALUE.notna())] for patient, data in compact_by_patient.items() }
+	deduplicated_by_patient, seconds, peak = measure(dedupe, memory)
+	report['dedupe'] = (sum(len(data) for data in deduplicated_by_patient.values()), seconds, peak)
+
+	def grid():
+		cells_per_patient = []
+		for patient, data in deduplicated_by_patient.items():
+			day0 = int(day_offsets(np.array([patient_day0s[patient]], dtype = 'datetime64[ns]'), initial_day_of_study)[0])
+			cells_per_patient.append(patient_cells(data, day0, num_max_days))
+		return cells_per_patient, build_grid(cells_per_patient, len(catalog['parameters']), num_max_days, empty_result)
+	(cells_per_patient, final_grid), seconds, peak = measure(grid, memory)
+	report['grid'] = (sum(len(cells[0]) for cells in cells_per_patient), seconds, peak)
+
+	split_days = data_splitter(list(range(num_max_days)), num_max_days, sub_period_duration)
+	patients = [ str(patient) for patient in deduplicated_by_patient ]
+	def write():
+		sheets = grid_sheets(final_grid, split_days)
+		with tempfile.TemporaryDirectory() as directory:
+			write_workbook(f'{directory}/final.xlsx', ( (f'Sheet{s+1}', sheet_to_dataframe(sheets[s], patients, catalog['parameters'], split_days[s])) for s in range(len(split_days)) ))
+	_, seconds, peak = measure(write, memory)
+	report['write'] = (final_grid.size, seconds, peak)
+
+	return report
+
+def benchmark(scales, memory, seed, csv_path = None):
+	lines = []
+	print(f"{'scale':>12} {'stage':>10} {'rows':>10} {'seconds':>9} {'rows/s':>10} {'peak MB':>8}")
+	for scale in scales:
+		patients, days, samples_per_day = parse_scale(scale)
+		with tempfile.TemporaryDirectory() as root:
+			write_cohort(root, patients, days, samples_per_day, seed = seed)
+			report = run_stages(root)
+			peaks = run_stages(root, memory = True) if memory else {}
+		for stage in stages:
+			rows, seconds, _ = report[stage]
+			peak = peaks[stage][2] if stage in peaks else None
+			lines.append({'scale': scale, 'stage': stage, 'rows': rows, 'seconds': seconds, 'peak_mb': peak})
+			peak_text = f'{peak:8.1f}' if peak is not None else f"{'-':>8}"
+			print(f'{scale:>12} {stage:>10} {rows:>10} {seconds:>9.3f} {rows / max(seconds, 1e-9):>10.0f} {peak_text}')
+
+	if csv_path is not None:
+		import pandas as pd
+		pd.DataFrame(lines).to_csv(csv_path, index = False)
+	return lines
+
+def final_sheets_digests(filepath):
+	'''sha256 of the values of each sheet of the final workbook'''
+	import pandas as pd
+	sheets = pd.read_excel(filepath, sheet_name = None, header = None, dtype = object)
+	return { name: hashlib.sha256(sheet.to_csv(index = False, header = False).encode()).hexdigest() for name, sheet in sheets.items() }
+
+def run_program(root, argv):
+	'''Runs magic.py with argv in the study directory root; returns the path of the final sheet'''
+	import magic
+	working_directory = os.getcwd()
+	os.chdir(root)
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			if magic.main(argv) != 0:
+				raise Exception(f'magic.py {" ".join(argv)} failed in {root}')
+		final_sheets = sorted(filename for filename in os.listdir(directory_final_sheet) if filename.endswith('.xlsx'))
+		return os.path.abspath(f'{directory_final_sheet}/{final_sheets[-1]}')
+	finally:
+		os.chdir(working_directory)
+
+def golden_check(update = False):
+	'''Compares the final sheets of the golden cohort with benchmark_golden.json (or rewrites it); returns True if they match'''
+	digests = {}
+	for mode, argv in [('patient files', ['--merge']), ('direct', ['--merge', '--direct'])]:
+		with tempfile.TemporaryDirectory() as root:
+			write_cohort(root, **golden_cohort)
+			digests[mode] = final_sheets_digests(run_program(root, argv))
+
+	if update:
+		with open(golden_path, 'w') as file:
+			json.dump({'cohort': golden_cohort, 'sheets': digests['patient files']}, file, indent = 1)
+		print(f'Golden final sheets written to {golden_path}')
+		return True
+
+	with open(golden_path) as file:
+		golden = json.load(file)
+	all_good = True
+	for mode, sheets in digests.items():
+		different = [ name for name in sorted(set(sheets) | set(golden['sheets'])) if sheets.get(name) != golden['sheets'].get(name) ]
+		if len(different) > 0:
+			all_good = False
+			print(red(f'Golden check failed ({mode}): {", ".join(different)} differ'))
+		else:
+			print(f'Golden check passed ({mode})')
+	return all_good
+
+def leading_zero_check():
+	'''Runs the program on a cohort whose 9-digit PATIFALLNR start with a zero; returns True if each mode puts every patient in the final sheet'''
+	import pandas as pd
+	from patients import read_patients_map
+
+	all_good = True
+	for mode, argv in [('patient files', ['--merge']), ('direct', ['--merge', '--direct'])]:
+		with tempfile.TemporaryDirectory() as root:
+			write_cohort(root, **leading_zero_cohort)
+			expected = sorted(str(lfdnr) for lfdnr in read_patients_map(f'{root}/patients_map.xlsx').LFDNR)
+			try:
+				sheet = pd.read_excel(run_program(root, argv), sheet_name = 'Sheet1', header = None, dtype = object)
+				# rows of the patients are labelled 'LFDNR - PATIFALLNR - day0'
+				found = sorted(str(label).split(' - ')[0] for label in sheet.iloc[:, 0] if ' - ' in str(label))
+			except Exception as error:
+				found = [f'{type(error).__name__}: {error}']
+		if found != expected:
+			all_good = False
+			print(red(f'Leading zero check failed ({mode}): expected patients {", ".join(expected)}, got {", ".join(found)}'))
+		else:
+			print(f'Leading zero check passed ({mode})')
+	return all_good
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(description = 'Times each stage of the pipeline on synthetic cohorts and checks the final sheets against the golden ones')
+	parser.add_argument('--scales', nargs = '+', default = default_scales, metavar = 'PxDxS', help = f'patients x days x samples per day (default {" ".join(default_scales)})')
+	parser.add_argument('--memory', action = 'store_true', help = 'also measure the peak memory of each stage (second, slower pass)')
+	parser.add_argument('--seed', type = int, default = 0)
+	parser.add_argument('--csv', help = 'also write the timings to this csv file')
+	parser.add_argument('--golden', action = 'store_true', help = 'only run the golden and leading zero checks')
+	parser.add_argument('--update-golden', action = 'store_true', help = 'rewrite benchmark_golden.json from the current code')
+	args = parser.parse_args(argv)
+
+	if args.update_golden:
+		return 0 if golden_check(True) else 1
+	if args.golden:
+		return 0 if golden_check() & leading_zero_check() else 1
+
+	benchmark(args.scales, args.memory, args.seed, args.csv)
+	return 0 if golden_check() & leading_zero_check() else 1
+
+# END BENCHMARK
+
+if __name__ == '__main__':
+	import sys
+	sys.exit(main())
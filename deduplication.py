@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+
+# START DUPLICATE EXAM RESOLUTION
+# Same rules as the old per-parameter / per-day drop loops, done with a few sorts and groupbys:
+# - reference parameter: earliest numerical result of the day, or earliest result if no result is a number
+# - other parameters, if the reference parameter was measured that day: numerical result closest in time to it,
+#   or closest result if no result is a number
+# - other parameters, if the reference parameter was not measured that day: earliest numerical result of the day,
+#   or earliest result if no result is a number
+# Ties are always broken by row order, like idxmin and min did.
+
+def resolve_duplicate_exams(data, reference_parameter, is_numeric, patients=None):
+	'''Returns the index of the rows of data to keep, in their original order
+
+	data is in the compact layout of schema.py: BESCHREIBUNG categorical, LABEINDAT datetime and DAY integer
+	is_numeric is a boolean array-like, True where ERGEBNIST is a number
+	patients, if given, is the patient of each row: the rows of several patients are then resolved at once, each patient
+	on its own, as if each were resolved alone
+	'''
+	day = data.DAY.to_numpy()
+	if patients is not None:
+		# one day of one patient per value; DAY is an int16, so this is unique
+		day = np.asarray(patients, dtype='int64') * 65536 + (day.astype('int64') + 32768)
+
+	parameters = data.BESCHREIBUNG.cat.categories
+	frame = pd.DataFrame({
+		'param': data.BESCHREIBUNG.cat.codes.to_numpy(),
+		'time': data.LABEINDAT.to_numpy(dtype='datetime64[ns]'),
+		'day': day,
+		'numeric': np.asarray(is_numeric, dtype=bool),
+		'position': np.arange(len(data)),
+	})
+	frame['not_numeric'] = ~frame.numeric
+
+	# First make sure reference parameter does not appear more than once per day
+	is_reference = frame.param.to_numpy() == (parameters.get_loc(reference_parameter) if reference_parameter in parameters else -2)
+	reference = frame[is_reference].sort_values(['day', 'not_numeric', 'time', 'position'], kind='stable')
+	reference = reference.drop_duplicates('day', keep='first')
+	frame = pd.concat([frame[~is_reference], reference])
+
+	# Time of the (now unique) reference sample of each day, if any
+	reference_time = reference[['day', 'time']].rename(columns={'time': 'reference_time'})
+	frame = frame.merge(reference_time, on='day', how='left')
+	frame['has_reference'] = frame.reference_time.notna()
+
+	# Only numerical results compete, unless no result of that parameter is a number on that day
+	groups = ['param', 'day']
+	frame['candidate'] = frame.numeric | ~frame.groupby(groups).numeric.transform('any')
+
+	# Distance to reference sample if there is one, otherwise plain time so that the earliest wins
+	frame['key'] = (frame.time - frame.reference_time).abs().where(frame.has_reference, frame.time - frame.time.min())
+	chosen = frame[frame.candidate].sort_values(groups + ['key', 'position'], kind='stable').drop_duplicates(groups, keep='first')
+
+	# Without reference the chosen row is kept. With reference the old code kept the first row of the day
+	# having the chosen time, numerical or not, so look it up among all rows of the group.
+	chosen_with_reference = chosen[chosen.has_reference]
+	chosen_without_reference = chosen[~chosen.has_reference]
+
+	same_time = frame.merge(chosen_with_reference[groups + ['time']], on=groups + ['time'])
+	kept_with_reference = same_time.sort_values('position', kind='stable').drop_duplicates(groups, keep='first')
+
+	positions = np.sort(np.concatenate([kept_with_reference.position.to_numpy(), chosen_without_reference.position.to_numpy()]))
+	return data.index[positions]
+
+# END DUPLICATE EXAM RESOLUTION
@@ -0,0 +1,129 @@
+import contextlib
+import csv
+import json
+import logging
+import os
+import sys
+import time
+
+
+# START DIAGNOSTICS
+# Verbose output goes through the logging module with lazy arguments (log.debug('... %s', data)), so that dataframes are
+# only turned into text when -v is on. With --profile, wall time, CPU time, memory and rows are recorded for each stage
+# and each patient, and saved next to the final sheet; without it nothing is measured.
+# Memory is the maximum RSS of the process so far (ru_maxrss, which never goes down) and how much the stage or patient
+# raised it: 0 for everything that stays below an earlier peak, so a stage's own peak is not measured.
+
+logger_name = 'monkey_table'
+
+def get_logger(module):
+	return logging.getLogger(f'{logger_name}.{module}')
+
+def configure_logging(verbose):
+	'''Messages of all modules go to stdout as they are; debug messages only if verbose'''
+	logger = logging.getLogger(logger_name)
+	logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+	logger.propagate = False
+	if len(logger.handlers) == 0:
+		handler = logging.StreamHandler(sys.stdout)
+		handler.setFormatter(logging.Formatter('%(message)s'))
+		logger.addHandler(handler)
+
+def max_rss_mb():
+	'''Maximum resident memory reached so far by this process and its finished children, None where the resource module is missing'''
+	try:
+		import resource
+	except ImportError:
+		return None
+	peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+	# kilobytes on Linux, bytes on macOS
+	return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+def rss_growth_mb(before, after):
+	'''How much the maximum RSS rose between two max_rss_mb() readings, None if unknown'''
+	return None if before is None or after is None else after - before
+
+def cpu_seconds():
+	'''CPU time of this process and of its finished children'''
+	times = os.times()
+	return times.user + times.system + times.children_user + times.children_system
+
+def new_profile():
+	return {'stages': [], 'patients': []}
+
+@contextlib.contextmanager
+def profile_stage(profile, stage):
+	'''Measures the block as stage of profile; the block may set entry['rows']. Does nothing if profile is None'''
+	entry = {'stage': stage, 'rows': None}
+	if profile is None:
+		yield entry
+		return
+	start_wall, start_cpu, start_rss = time.perf_counter(), cpu_seconds(), max_rss_mb()
+	try:
+		yield entry
+	finally:
+		entry['wall_seconds'] = time.perf_counter() - start_wall
+		entry['cpu_seconds'] = cpu_seconds() - start_cpu
+		entry['max_rss_mb'] = max_rss_mb()
+		entry['max_rss_growth_mb'] = rss_growth_mb(start_rss, entry['max_rss_mb'])
+		profile['stages'].append(entry)
+
+def start_patient_measure():
+	return time.perf_counter(), time.process_time(), max_rss_mb()
+
+def patient_measure(start, patient, rows_in, rows_out, cached = False, read_seconds = None):
+	'''Measures of one patient since start (from start_patient_measure), in the process that handled it'''
+	start_wall, start_cpu, start_rss = start
+	rss = max_rss_mb()
+	return {
+		'patient': patient,
+		'rows_in': rows_in,
+		'rows_out': rows_out,
+		'cached': cached,
+		# reading the patient file, None for patients processed from memory
+		'read_seconds': read_seconds,
+		'wall_seconds': time.perf_counter() - start_wall,
+		'cpu_seconds': time.process_time() - start_cpu,
+		'max_rss_mb': rss,
+		'max_rss_growth_mb': rss_growth_mb(start_rss, rss),
+		'process': os.getpid(),
+	}
+
+def save_profile(profile, filepath_without_extension, file_format = 'json'):
+	'''Writes profile as filepath_without_extension.json, or .csv with one row per stage and per patient; returns the path'''
+	filepath = f'{filepath_without_extension}.profile.{file_format}'
+	os.makedirs(os.path.dirname(filepath) or '.', exist_ok = True)
+	if file_format == 'json':
+		with open(filepath, 'w') as file:
+			json.dump(profile, file, indent = 1)
+	else:
+		rows = [ dict(entry, kind = 'stage') for entry in profile['stages'] ] + [ dict(entry, kind = 'patient') for entry in profile['patients'] ]
+		columns = ['kind', 'stage', 'patient', 'rows', 'rows_in', 'rows_out', 'cached', 'read_seconds', 'wall_seconds', 'cpu_seconds', 'max_rss_mb', 'max_rss_growth_mb', 'process']
+		with open(filepath, 'w', newline = '') as file:
+			writer = csv.DictWriter(file, fieldnames = columns)
+			writer.writeheader()
+			writer.writerows(rows)
+	return filepath
+
+def profile_summary(profile, top = 10):
+	'''Text table of the stages and of the top slowest patients'''
+	lines = [f"{'stage':<24} {'rows':>10} {'wall s':>9} {'cpu s':>9} {'max RSS so far MB':>18} {'raised by MB':>13}"]
+	for entry in profile['stages']:
+		rows = '' if entry['rows'] is None else entry['rows']
+		rss = '' if entry['max_rss_mb'] is None else f"{entry['max_rss_mb']:.1f}"
+		growth = '' if entry['max_rss_growth_mb'] is None else f"{entry['max_rss_growth_mb']:.1f}"
+		lines.append(f"{entry['stage']:<24} {rows:>10} {entry['wall_seconds']:>9.3f} {entry['cpu_seconds']:>9.3f} {rss:>18} {growth:>13}")
+
+	slowest = sorted(profile['patients'], key = lambda entry: entry['wall_seconds'], reverse = True)[:top]
+	if len(slowest) > 0:
+		lines.append('')
+		lines.append(f"{'slowest patients':<24} {'rows in':>10} {'wall s':>9} {'cpu s':>9} {'rows out':>12} {'read s':>9}")
+		for entry in slowest:
+			# rows are None for patients that failed
+			rows_in = '' if entry['rows_in'] is None else entry['rows_in']
+			rows_out = 'error' if entry['rows_out'] is None else entry['rows_out']
+			read = '' if entry['read_seconds'] is None else f"{entry['read_seconds']:.3f}"
+			lines.append(f"{entry['patient']:<24} {rows_in:>10} {entry['wall_seconds']:>9.3f} {entry['cpu_seconds']:>9.3f} {rows_out:>12} {read:>9}")
+	return '\n'.join(lines)
+
+# END DIAGNOSTICS
@@ -0,0 +1,86 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# START EXCEL READER
+# Patient files and the patients map are read through one function with a choice of engines:
+# - calamine (python-calamine, if installed): a Rust reader, several times faster than openpyxl
+# - openpyxl in read-only mode, streaming the cell values without building the object model of the workbook
+# - pandas: pd.read_excel, as before
+# 'auto' takes the first one available. Only the needed columns are turned into a dataframe, and cells are converted as
+# pd.read_excel converts them (whole numbers to int, empty cells to missing), so that the engines give the same frames.
+
+excel_reader_engines = ['auto', 'calamine', 'openpyxl', 'pandas']
+
+def calamine_available():
+	try:
+		import python_calamine
+	except ImportError:
+		return False
+	return True
+
+def resolve_engine(engine = 'auto'):
+	if engine not in excel_reader_engines:
+		raise ValueError(f'Unknown excel reader {engine}, choose one of {", ".join(excel_reader_engines)}')
+	if engine == 'auto':
+		return 'calamine' if calamine_available() else 'openpyxl'
+	return engine
+
+def sheet_rows_calamine(filepath):
+	from python_calamine import CalamineWorkbook
+	return CalamineWorkbook.from_path(filepath).get_sheet_by_index(0).to_python()
+
+def sheet_rows_openpyxl(filepath):
+	import openpyxl
+	workbook = openpyxl.load_workbook(filepath, read_only = True, data_only = True, keep_links = False)
+	try:
+		sheet = workbook.worksheets[0]
+		# files saved by other programs may declare wrong dimensions
+		sheet.reset_dimensions()
+		return [ list(row) for row in sheet.iter_rows(values_only = True) ]
+	finally:
+		workbook.close()
+
+def cell_value(value, empty):
+	'''A cell as pd.read_excel gives it: empty cells become empty, whole numbers int'''
+	if value is None or (isinstance(value, str) and value == ''):
+		return empty
+	if isinstance(value, float) and value.is_integer():
+		return int(value)
+	return value
+
+def rows_to_dataframe(rows, columns, filepath, empty):
+	'''Dataframe of columns from the rows of a sheet, the first row being the header'''
+	if len(rows) == 0:
+		raise ValueError(f'{filepath} is empty')
+	header = [ '' if name is None else str(name) for name in rows[0] ]
+	missing = [ col for col in columns if col not in header ]
+	if len(missing) > 0:
+		raise ValueError(f'{filepath} has no column {", ".join(missing)}')
+	positions = [ header.index(col) for col in columns ]
+
+	data = rows[1:]
+	# trailing empty rows are dropped, as pd.read_excel does
+	while len(data) > 0 and all(value is None or value == '' for value in data[-1]):
+		data = data[:-1]
+
+	values = { col: [ cell_value(row[position] if position < len(row) else None, empty) for row in data ] for col, position in zip(columns, positions) }
+	return pd.DataFrame({ col: pd.Series(values[col], dtype = None if len(values[col]) > 0 else object) for col in columns })
+
+def read_excel_columns(filepath, columns, engine = 'auto', empty = np.nan):
+	'''The columns of the first sheet of filepath; empty cells become empty (np.nan, or '' as with keep_default_na = False)'''
+	engine = resolve_engine(engine)
+	if engine == 'pandas':
+		return pd.read_excel(filepath, usecols = columns, keep_default_na = not isinstance(empty, str))[columns]
+	rows = sheet_rows_calamine(filepath) if engine == 'calamine' else sheet_rows_openpyxl(filepath)
+	return rows_to_dataframe(rows, columns, filepath, empty)
+
+def timed_read_excel_columns(filepath, columns, engine = 'auto', empty = np.nan):
+	'''read_excel_columns and the seconds it took'''
+	start = time.perf_counter()
+	data = read_excel_columns(filepath, columns, engine, empty)
+	return data, time.perf_counter() - start
+
+# END EXCEL READER
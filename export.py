@@ -0,0 +1,66 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+# START PATIENT FILES EXPORT
+# The merged rows are split by patient in one pass (one stable sort on the 8-digit identifier, then slices), and the
+# per-patient excel files are written by a pool of worker processes. Every write is timed, so that the merge can report
+# its throughput.
+
+def partition_by_patient(raw_df, patients_8_digit):
+	'''Dictionary 8-digit PATIFALLNR -> rows of raw_df of that patient, in their original order
+
+	patients_8_digit is the 8-digit identifier of each row of raw_df. Costs one sort, whatever the number of patients.
+	'''
+	order = np.argsort(patients_8_digit, kind='stable')
+	sorted_patients = patients_8_digit[order]
+	sorted_df = raw_df.iloc[order]
+
+	boundaries = np.flatnonzero(np.diff(sorted_patients)) + 1
+	starts = np.concatenate([[0], boundaries])
+	stops = np.concatenate([boundaries, [len(sorted_patients)]])
+
+	return { int(sorted_patients[start]): sorted_df.iloc[start:stop] for start, stop in zip(starts, stops) if stop > start }
+
+def save_excel_patient_sheet(df, dirname, filename):
+
+	filepath = f'{dirname}/{filename}'
+	os.makedirs(dirname, exist_ok=True)
+
+	with pd.ExcelWriter(filepath) as writer:
+		df.to_excel(writer, index = False)
+
+def timed_save_excel_patient_sheet(df, dirname, filename):
+	start = time.perf_counter()
+	save_excel_patient_sheet(df, dirname, filename)
+	return {'file': filename, 'rows': len(df), 'seconds': time.perf_counter() - start, 'bytes': os.path.getsize(f'{dirname}/{filename}')}
+
+def export_patient_sheets(df_per_file, dirname, jobs = 1):
+	'''Writes each dataframe of the dictionary filename -> dataframe to dirname/filename
+
+	With jobs > 1 the files are written by that many worker processes. Returns one dictionary per file with its name,
+	rows, seconds spent and bytes written.
+	'''
+	filenames = list(df_per_file)
+	if jobs <= 1 or len(filenames) <= 1:
+		return [ timed_save_excel_patient_sheet(df_per_file[filename], dirname, filename) for filename in filenames ]
+
+	os.makedirs(dirname, exist_ok=True)
+	chunksize = max(1, len(filenames) // (jobs * 4))
+	with ProcessPoolExecutor(max_workers = jobs) as executor:
+		return list(executor.map(timed_save_excel_patient_sheet, [df_per_file[filename] for filename in filenames], [dirname] * len(filenames), filenames, chunksize = chunksize))
+
+def export_summary(report, seconds):
+	'''One line about the files of report (as returned by export_patient_sheets), written in seconds of wall time'''
+	rows = sum(entry['rows'] for entry in report)
+	kilobytes = sum(entry['bytes'] for entry in report) / 1000
+	writing_seconds = sum(entry['seconds'] for entry in report)
+	per_file = writing_seconds / len(report) if len(report) > 0 else 0
+	return (f'{len(report)} patient files, {rows} rows, {kilobytes:.1f} kB in {seconds:.2f} s: '
+			f'{len(report) / max(seconds, 1e-9):.1f} files/s, {rows / max(seconds, 1e-9):.0f} rows/s, {per_file:.3f} s per file')
+
+# END PATIENT FILES EXPORT
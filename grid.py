@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+from normalization import sheet_results
+
+
+# START GRID
+# All results end up in one array indexed by (patient, parameter, day from day0). Each patient only contributes the
+# coordinates and values of its results (cells), which are scattered into the array at once; each sheet is a slice
+# of the array along the day axis, reshaped into a dataframe with (parameter, day) columns.
+# Cells keep numbers and texts apart (VALUE and TEXT of schema.py); numbers stay numbers in the grid and in the sheets.
+
+def patient_cells(data, day0, num_max_days):
+	'''Returns (parameter index, day offset from day0, value, text) of the results of data within the first num_max_days days
+
+	data is in the compact layout of schema.py, with at most one result per parameter and day; day0 is counted in days
+	like data.DAY.
+	'''
+	parameter_index = data.BESCHREIBUNG.cat.codes.to_numpy(dtype = 'int64')
+	day_offset = data.DAY.to_numpy(dtype = 'int64') - day0
+	keep = (parameter_index >= 0) & (day_offset >= 0) & (day_offset < num_max_days)
+	return parameter_index[keep], day_offset[keep], data.VALUE.to_numpy(dtype = 'float64')[keep], data.TEXT.to_numpy(dtype = object)[keep]
+
+def flatten_cells(cells_per_patient):
+	'''(patient index, parameter index, day offset, value, text) of the cells of all patients, patient index being the
+	position of the patient in cells_per_patient'''
+	if len(cells_per_patient) == 0:
+		return np.array([], dtype = 'int64'), np.array([], dtype = 'int64'), np.array([], dtype = 'int64'), np.array([], dtype = 'float64'), np.array([], dtype = object)
+	patient_index = np.repeat(np.arange(len(cells_per_patient)), [len(cells[0]) for cells in cells_per_patient])
+	return (patient_index,) + tuple(np.concatenate([cells[i] for cells in cells_per_patient]) for i in range(4))
+
+def fill_grid(number_of_patients, number_of_parameters, num_max_days, empty_result, patient_index, parameter_index, day_offset, values, texts):
+	'''Array of shape (patients, parameters, num_max_days) with the given results (floats or texts) and empty_result elsewhere'''
+	grid = np.full((number_of_patients, number_of_parameters, num_max_days), empty_result, dtype = object)
+	grid[patient_index, parameter_index, day_offset] = sheet_results(values, texts)
+	return grid
+
+def build_grid(cells_per_patient, number_of_parameters, num_max_days, empty_result):
+	'''Array of shape (patients, parameters, num_max_days) with the cells of each patient and empty_result elsewhere'''
+	return fill_grid(len(cells_per_patient), number_of_parameters, num_max_days, empty_result, *flatten_cells(cells_per_patient))
+
+def grid_sheets(grid, split_days):
+	'''One view of grid per sheet, split_days being the list of days of each sheet as made by data_splitter'''
+	return [ grid[:, :, days[0]:days[-1]+1] for days in split_days ]
+
+def sheet_to_dataframe(sheet, patients, parameters, days):
+	'''Wide dataframe with one row per patient and (parameter, day) columns'''
+	columns = pd.MultiIndex.from_product([parameters, days], names = ['parameter', 'day'])
+	index = pd.Index(patients, name = 'patient')
+	return pd.DataFrame(sheet.reshape(sheet.shape[0], len(columns)), index = index, columns = columns)
+
+# END GRID
@@ -0,0 +1,71 @@
+import os
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from parameter_catalog import needed_mask, unknown_names
+
+
+# START RAW RESULTS INGESTION
+# Raw lab exports are read in chunks, keeping only the needed columns and, chunk by chunk, only the rows of patients in the
+# patients map and of needed parameters. Peak memory then depends on the kept data rather than on the size of the export.
+# Parameter names, repeated on every row, are kept as categoricals (as read from the file, fixed later, see schema.py).
+
+needed_columns = ['PATIFALLNR', 'BESCHREIBUNG', 'ERGEBNIST', 'LABEINDAT']
+raw_results_dtypes = { col: str for col in needed_columns }
+raw_results_chunksize = 200000
+
+def raw_results_files(directory):
+	return [raw_result for raw_result in os.listdir(directory) if raw_result.endswith(".csv") and not raw_result.startswith("~")]
+
+def read_raw_results_chunks(filepath, patients_8_digit, catalog, seen_patients, unknown_counts, chunksize = raw_results_chunksize):
+	'''Yields the kept rows of each chunk of one raw lab export (see read_raw_results_file)
+
+	Adds the 9-digit PATIFALLNR seen in each chunk to seen_patients and the rows of not needed names to unknown_counts.
+	'''
+	# encoding https://stackoverflow.com/questions/42339876/error-unicodedecodeerror-utf-8-codec-cant-decode-byte-0xff-in-position-0-in
+	# separator https://stackoverflow.com/questions/18039057/python-pandas-error-tokenizing-data
+	with pd.read_csv(filepath, encoding='cp1252', sep = ';', usecols = needed_columns, dtype = raw_results_dtypes, chunksize = chunksize) as reader:
+		for chunk in reader:
+			# kill empty results
+			chunk = chunk.dropna()
+			chunk = chunk.astype({"PATIFALLNR": 'int64'})
+
+			seen_patients.update(chunk.PATIFALLNR.unique().tolist())
+
+			for name, rows in unknown_names(chunk.BESCHREIBUNG, catalog).items():
+				unknown_counts[name] = unknown_counts.get(name, 0) + rows
+
+			keep = (chunk.PATIFALLNR // 10).isin(patients_8_digit) & needed_mask(chunk.BESCHREIBUNG, catalog)
+			yield chunk[keep]
+
+def read_raw_results_file(filepath, patients_8_digit, catalog, chunksize = raw_results_chunksize):
+	'''Reads one raw lab export, keeping only rows of patients_8_digit and of needed parameters of the catalog
+
+	Names are kept as read from the file. Returns the kept rows, with integer 9-digit PATIFALLNR, the set of all 9-digit
+	PATIFALLNR seen in the file and the counts of the parameter names that are not needed, as {name: rows}.
+	'''
+	seen_patients = set()
+	unknown_counts = {}
+	kept_chunks = list(read_raw_results_chunks(filepath, patients_8_digit, catalog, seen_patients, unknown_counts, chunksize))
+
+	if len(kept_chunks) == 0:
+		return empty_raw_results(), seen_patients, unknown_counts
+
+	kept = pd.concat(kept_chunks, ignore_index = True)
+	kept['BESCHREIBUNG'] = kept.BESCHREIBUNG.astype('category')
+	return kept, seen_patients, unknown_counts
+
+def empty_raw_results():
+	return pd.DataFrame({ col: pd.Series(dtype = {'PATIFALLNR': 'int64', 'BESCHREIBUNG': 'category'}.get(col, object)) for col in needed_columns })
+
+def concat_raw_results(frames):
+	'''pd.concat of raw results, parameter names staying categorical (pd.concat alone falls back to strings when categories differ)'''
+	frames = list(frames)
+	if len(frames) == 0:
+		return empty_raw_results()
+	categories = union_categoricals([frame.BESCHREIBUNG for frame in frames]).categories
+	frames = [frame.assign(BESCHREIBUNG = frame.BESCHREIBUNG.cat.set_categories(categories)) for frame in frames]
+	return pd.concat(frames, ignore_index = True)
+
+# END RAW RESULTS INGESTION
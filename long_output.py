@@ -0,0 +1,67 @@
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from grid import flatten_cells, fill_grid
+
+
+# START LONG FORMAT OUTPUT
+# The results of the final sheet as one long table, one row per result: PATIFALLNR (9-digit), LFDNR, DAY0, PARAMETER,
+# DAY (from day0), VALUE (number, NaN for non numerical results) and TEXT (non numerical results, empty for numbers).
+# It is written as parquet (sorted by patient and parameter) and/or as a SQLite database (indexed on patient and
+# parameter); the wide excel sheets are a view of the same table (see long_to_grid).
+
+long_columns = ['PATIFALLNR', 'LFDNR', 'DAY0', 'PARAMETER', 'DAY', 'VALUE', 'TEXT']
+sqlite_table = 'results'
+
+def long_results(cells_per_patient, patient_identifier_PATIFALLNR, day0_all_patients, patient_lfdnrs, parameters):
+	'''Long table of the cells of each patient (see grid.py), with the 9-digit identifier, LFDNR and day0 of each patient
+	and the names of parameters, in the order of the final sheet'''
+	patient_index, parameter_index, day_offset, values, texts = flatten_cells(cells_per_patient)
+	texts = np.where(np.isnan(values), texts, None)
+
+	return pd.DataFrame({
+		'PATIFALLNR': np.asarray(patient_identifier_PATIFALLNR, dtype = 'int64')[patient_index],
+		'LFDNR': np.asarray(patient_lfdnrs, dtype = object)[patient_index],
+		'DAY0': pd.DatetimeIndex(pd.to_datetime(list(day0_all_patients)))[patient_index],
+		'PARAMETER': pd.Categorical.from_codes(parameter_index, categories = parameters),
+		'DAY': day_offset.astype('int16'),
+		'VALUE': values,
+		'TEXT': texts,
+	}, columns = long_columns)
+
+def long_to_grid(long_df, patient_identifier_PATIFALLNR, number_of_parameters, num_max_days, empty_result):
+	'''Grid of grid.py (patients in the order of patient_identifier_PATIFALLNR) from the long table'''
+	patients = pd.Index(patient_identifier_PATIFALLNR)
+	patient_index = patients.get_indexer(long_df.PATIFALLNR)
+	return fill_grid(len(patients), number_of_parameters, num_max_days, empty_result, patient_index, long_df.PARAMETER.cat.codes.to_numpy(dtype = 'int64'),
+					long_df.DAY.to_numpy(dtype = 'int64'), long_df.VALUE.to_numpy(dtype = 'float64'), long_df.TEXT.to_numpy(dtype = object))
+
+def save_long_parquet(long_df, filepath):
+	'''Sorted by patient and parameter, so that readers filtering on them skip whole row groups'''
+	os.makedirs(os.path.dirname(filepath) or '.', exist_ok = True)
+	long_df.sort_values(['PATIFALLNR', 'PARAMETER', 'DAY'], kind = 'stable').to_parquet(filepath, index = False)
+
+def save_long_sqlite(long_df, filepath):
+	'''Table results, indexed on patient and on parameter'''
+	os.makedirs(os.path.dirname(filepath) or '.', exist_ok = True)
+	if os.path.exists(filepath):
+		os.remove(filepath)
+
+	# LFDNR keeps the type it has in the patients map and in parquet: whole numbers as INTEGER, anything else as TEXT
+	lfdnr_is_integer = pd.api.types.infer_dtype(long_df.LFDNR, skipna = True) == 'integer'
+	lfdnr = long_df.LFDNR.map(int) if lfdnr_is_integer else long_df.LFDNR.astype(str)
+
+	# sqlite3 takes python values only, NULL for missing ones
+	rows = long_df.assign(LFDNR = lfdnr, DAY0 = long_df.DAY0.dt.strftime('%Y-%m-%d'), PARAMETER = long_df.PARAMETER.astype(str)).astype(object)
+	rows = rows.where(rows.notna(), None)
+	with sqlite3.connect(filepath) as connection:
+		connection.execute(f'CREATE TABLE {sqlite_table} (PATIFALLNR INTEGER, LFDNR {"INTEGER" if lfdnr_is_integer else "TEXT"}, DAY0 TEXT, PARAMETER TEXT, DAY INTEGER, VALUE REAL, TEXT TEXT)')
+		connection.executemany(f'INSERT INTO {sqlite_table} VALUES (?, ?, ?, ?, ?, ?, ?)', rows.itertuples(index = False, name = None))
+		connection.execute(f'CREATE INDEX {sqlite_table}_patient ON {sqlite_table} (PATIFALLNR, DAY)')
+		connection.execute(f'CREATE INDEX {sqlite_table}_parameter ON {sqlite_table} (PARAMETER, PATIFALLNR)')
+	connection.close()
+
+# END LONG FORMAT OUTPUT
@@ -1,34 +1,35 @@
-import pandas as pd
+import argparse
 import os
 import time
 from datetime import datetime, timedelta
-import numpy as np
-import xarray as xr
-from tqdm import tqdm
 import sys
-import logging
 import shutil
 
 from program_parameters import *
 from myutils import *
+from diagnostics import get_logger, configure_logging, new_profile, profile_stage, save_profile, profile_summary
+
+# Heavy modules (pandas, numpy, tqdm, and through them openpyxl, pyarrow, xlsxwriter) are imported by the stages that
+# need them, so that --help and argument errors return at once and importing this module does no work.
 
 
 ####################################################################################################################################################################################
 ## START METADATA
 ####################################################################################################################################################################################
 
-current_date = datetime.utcfromtimestamp( int(time.time()) ).strftime('%Y-%m-%d-%H_%M_%S')
 initial_day_of_study = datetime(2021, 11, 2)
 
 
 #pd.set_option("display.max_rows", None, "display.max_columns", None)
 
 nan_value = float("NaN")
-horizontal_line = '=' * os.get_terminal_size().columns
+# falls back to 80 columns without a terminal (cron, batch schedulers)
+horizontal_line = '=' * shutil.get_terminal_size().columns
 horizontal_line_before_space = f'\n{horizontal_line}'
 horizontal_line_after_space = f'{horizontal_line}\n'
 
-log = logging.getLogger(__name__)
+# -v shows debug messages, see diagnostics.py
+log = get_logger('magic')
 
 ####################################################################################################################################################################################
 # END METADATA
@@ -39,19 +40,78 @@ log = logging.getLogger(__name__)
 ## START ARGPARSE
 ####################################################################################################################################################################################
 
-verbose = False
-if '-v' in sys.argv:
-	verbose = True
+def parse_arguments(argv = None):
+	parser = argparse.ArgumentParser(prog = 'magic', description = 'Builds the final sheet of the study from the raw lab results and the patients map. Without --merge or --no-merge, asks whether to perform the merging routine.')
+
+	parser.add_argument('-v', '--verbose', action = 'store_true', help = 'print the data at each step')
+
+	# if debug is true, the program runs only on the files where it encoutered errors during the previous run
+	parser.add_argument('-debug', '--debug', action = 'store_true', help = 'run only on the patients that failed in the previous run, printing what goes wrong')
+
+	merge = parser.add_mutually_exclusive_group()
+	merge.add_argument('--merge', dest = 'merge', action = 'store_true', default = None, help = 'perform the merging routine without asking')
+	merge.add_argument('--no-merge', dest = 'merge', action = 'store_false', help = 'use the most recent merge without asking')
+
+	# if direct is true, the merged data of each patient is processed in memory, without writing and reading back one excel file per patient
+	parser.add_argument('--direct', action = 'store_true', help = 'merge and process the patients in memory, without one excel file per patient (implies --merge, ignored with --debug)')
+
+	# in direct mode, also write the excel file of each patient to inspect it
+	parser.add_argument('--export-patients', action = 'store_true', help = 'with --direct, also write the excel file of each patient')
+
+	# if full_merge is true, the merging routine parses all raw files again instead of only new or changed ones
+	parser.add_argument('--full-merge', action = 'store_true', help = 'parse all raw files again instead of only new or changed ones')
+
+	# number of processes writing the patient files and in the patients loop; --jobs 0 uses all cores
+	parser.add_argument('--jobs', type = int, default = 1, metavar = 'N', help = 'number of worker processes, 0 for all cores (default 1)')
+
+	# if out_of_core is true, the raw results are spilled to on-disk shards and processed one shard at a time
+	parser.add_argument('--out-of-core', action = 'store_true', help = 'for raw results larger than memory: stream them into on-disk shards by patient and process one shard at a time (ignored with --debug)')
+	parser.add_argument('--memory-budget', type = float, default = 1024, metavar = 'MB', help = 'with --out-of-core, memory for one shard and its processing, in MB (default 1024)')
+
+	# formats of the final results: the wide excel sheets and/or one long table as parquet or SQLite
+	parser.add_argument('--output', nargs = '+', choices = ['xlsx', 'parquet', 'sqlite'], default = ['xlsx'], metavar = 'FORMAT',
+						help = 'xlsx (wide sheets, default), parquet and/or sqlite (one long table of all results, indexed on patient and parameter)')
+
+	# if no_cache is true, every patient is processed again instead of re-using the results of unchanged patients
+	parser.add_argument('--no-cache', action = 'store_true', help = f'process every patient again, without the cache of processed patients in {directory_patient_cache}')
 
-if verbose:
-	def verprint(data):
-		print(data)
-else:
-	def verprint(data):
-		pass
+	# if profile is given, time, memory and rows of each stage and patient are saved next to the final sheet
+	parser.add_argument('--profile', nargs = '?', const = 'json', choices = ['json', 'csv'], help = 'record wall time, CPU time, maximum RSS so far (and how much it rose) and rows of each stage and patient, saved next to the final sheet as json (default) or csv')
 
-# if debug is true, the program runs only on the files where it encoutered errors during the previous run
-debug = False if '-debug' not in sys.argv else True
+	# if check is given, the raw results and the patients map are only checked, every problem of the cohort saved in one report
+	parser.add_argument('--check', nargs = '?', const = 'json', choices = ['json', 'csv'], help = 'only check the raw results against the patients map, without merging or processing: every problem of the cohort is saved next to the final sheet as json (default) or csv, exit code 1 if there are errors')
+
+	# if batch is given, the raw results are merged and normalized once and processed with each configuration of the file
+	parser.add_argument('--batch', metavar = 'CONFIGS', help = 'json list of configurations (name, num_max_days, sub_period_duration, reference_parameter, keep_kein_material; missing ones from program_parameters.py): the raw results are merged and normalized once, then one final sheet is written per configuration')
+
+	# if serve is given, the cohort is kept in memory and served to local requests, see service.py
+	parser.add_argument('--serve', nargs = '?', const = '127.0.0.1:8765', metavar = 'ADDRESS', help = 'keep the patients map, the parameter catalog and the processed cohort in memory and answer local HTTP requests on HOST:PORT (default 127.0.0.1:8765) or unix:PATH, processing again when the raw results change (see service.py)')
+	parser.add_argument('--watch-interval', type = float, default = 10, metavar = 'SECONDS', help = 'with --serve, seconds between two checks of the raw results directory, 0 to never check (default 10)')
+
+	args = parser.parse_args(argv)
+
+	args.direct = args.direct and not args.debug
+	args.out_of_core = args.out_of_core and not args.debug
+	if args.batch is not None and (args.debug or args.out_of_core):
+		parser.error('--batch cannot be used with --debug or --out-of-core')
+	if args.serve is not None and (args.debug or args.out_of_core or args.batch is not None or args.check is not None):
+		parser.error('--serve cannot be used with --debug, --out-of-core, --batch or --check')
+	if args.memory_budget <= 0:
+		parser.error('--memory-budget must be > 0')
+	if args.direct:
+		if args.merge is False:
+			parser.error('--direct always merges, it cannot be used with --no-merge')
+		args.merge = True
+	if args.serve is not None:
+		# the service merges in memory (--direct) at start, unless --no-merge, and whenever the raw results change
+		if args.merge is None:
+			args.merge = True
+		args.direct = True
+	if args.jobs == 0:
+		args.jobs = os.cpu_count()
+	if args.jobs < 0:
+		parser.error('--jobs must be >= 0')
+	return args
 
 ####################################################################################################################################################################################
 ## END ARGPARSE
@@ -61,76 +121,70 @@ debug = False if '-debug' not in sys.argv else True
 ####################################################################################################################################################################################
 # START PATIENTS MAP 8-digit!
 ####################################################################################################################################################################################
-patients_map = pd.read_excel(patients_map_path, keep_default_na = False)
-patients_map['DAY0'] = pd.to_datetime(patients_map['DAY0'], dayfirst = True)
 
-# this function returns 8-digit identifier
-#def patNum2ID(num):
-#	return patients_map[ patients_map.LFDNR == num ].PATIFALLNR.iloc[0]
+def load_patients():
+	'''Returns the patients map and its lookups 8-digit PATIFALLNR -> LFDNR and -> DAY0, warning about problems of the map'''
+	from patients import load_patients_map, index_patients_map, validate_patients_map
 
-# this function takes 8-digit identifier
-def patID2Num(ID):
-	return patients_map[ patients_map.PATIFALLNR == ID ].LFDNR.iloc[0]
+	# parsed once and cached, see patients.py
+	patients_map = load_patients_map(patients_map_path, excel_reader_engine)
+	patient_numbers, patient_day0s = index_patients_map(patients_map)
 
+	patients_map_issues = validate_patients_map(patients_map)
+	if len(patients_map_issues['duplicated']) > 0:
+		print(orange(f'\nThese PATIFALLNR appear more than once in the patients map, only their first row is used: {patients_map_issues["duplicated"]}\n'))
+	if len(patients_map_issues['day0_missing']) > 0:
+		print(orange(f'\nThese PATIFALLNR have no DAY0 in the patients map, so their results will fail: {patients_map_issues["day0_missing"]}\n'))
 
-####################################################################################################################################################################################
-# END PATIENTS MAP
-####################################################################################################################################################################################
-
+	return patients_map, patient_numbers, patient_day0s, patients_map_issues
 
+# this function takes 8-digit identifier
+def patID2Num(patient_numbers, ID):
+	return patient_numbers[ID]
 
 ####################################################################################################################################################################################
-# START DATA MERGING ROUTINE
-# Goal: from multiple csv, each with data of multiple patients, get multiple excel files, each with all the data of a single patient
+# END PATIENTS MAP
 ####################################################################################################################################################################################
-perform_merging_routine = ''
 
-if not debug: 
-	while perform_merging_routine not in ['y', 'n']:
-		perform_merging_routine = input("\nPerform merging routine? Type y or n: ")
 
-if perform_merging_routine == 'y':
 
-	lab_results_directory = f'{directory_merged_results_per_patient}/{current_date}'   # one file per patient
-	lab_results_directory_debug = f'{directory_merged_results_per_patient_debug}/{current_date}'   # one file per patient
-
-	def save_excel_patient_sheet(df, dirname, filename):
+# START FIXING PARAMETERS NAMES
 
-		filepath = f'{dirname}/{filename}'
-		os.makedirs(dirname, exist_ok=True)
+def load_parameter_catalog():
+	'''Real parameters are read from parameters.txt; names with strange characters are repaired automatically,
+	the correction files in parameters_directory (if present) taking precedence, see parameter_catalog.py'''
+	from parameter_catalog import compile_parameter_catalog
 
-		with pd.ExcelWriter(filepath) as writer:
-			df.to_excel(writer, index = False)
+	parameter_catalog = compile_parameter_catalog('parameters_directory')
+	all_needed_parameters = parameter_catalog['parameters']
+	all_needed_parameters_before_fixing_names = parameter_catalog['listed_parameters']
+	log.debug('\nHere are all needed parameters before fixing names: \n\n %s\n\n', all_needed_parameters_before_fixing_names)
 
-	raw_data = []
-	for raw_result in os.listdir(lab_results_raw_directory):
-		if raw_result.endswith(".csv") and not raw_result.startswith("~"):
-			print(f'\n Extracting data from {raw_result}...')
-			# encoding https://stackoverflow.com/questions/42339876/error-unicodedecodeerror-utf-8-codec-cant-decode-byte-0xff-in-position-0-in
-			# separator https://stackoverflow.com/questions/18039057/python-pandas-error-tokenizing-data
-			current_df = pd.read_csv(f'{lab_results_raw_directory}/{raw_result}', encoding='cp1252', sep = ';')
-			# replace empty with NaN, and kill Nan
-			current_df.replace("", nan_value, inplace=True)
-			current_df.dropna(inplace=True)
-			raw_data.append( current_df )  
+	log.debug('\nHere are all needed parameters before and after fixing names:\n')
+	for i in range(len(all_needed_parameters_before_fixing_names)):
+		if all_needed_parameters_before_fixing_names[i] != all_needed_parameters[i]:
+			log.debug(orange(f'{all_needed_parameters_before_fixing_names[i]} /// {all_needed_parameters[i]}'))
+		else:
+			log.debug('%s /// %s', all_needed_parameters_before_fixing_names[i], all_needed_parameters[i])
 
-	# Merge into single
-	raw_df = pd.concat( raw_data )
-	raw_df = raw_df.astype({"PATIFALLNR": int})
+	return parameter_catalog
 
-	print('\n All raw results merged into single result!')
+# END FIXING PARAMETERS NAMES
 
 
-	# 9-digit
-	patient_IDs_in_current_labresults = set(raw_df.PATIFALLNR)
-	patient_IDs_in_current_labresults_8_digit = set([p//10 for p in raw_df.PATIFALLNR])
-	#print(patient_IDs_in_current_labresults)
+####################################################################################################################################################################################
+# START DATA MERGING ROUTINE
+# Goal: from multiple csv, each with data of multiple patients, get multiple excel files, each with all the data of a single patient
+####################################################################################################################################################################################
 
-	# 8-digit
-	patient_IDs_in_patients_map = set(patients_map.PATIFALLNR)
-	#print(patient_IDs_in_patients_map)
-	#patients_in_current_labresults_not_in_map = patient_IDs_in_current_labresults - patient_IDs_in_patients_map
+def ask_merge():
+	perform_merging_routine = ''
+	while perform_merging_routine not in ['y', 'n']:
+		perform_merging_routine = input("\nPerform merging routine? Type y or n: ")
+	return perform_merging_routine == 'y'
 
+def report_patients_not_in_map(patient_IDs_in_current_labresults, patient_IDs_in_patients_map, patients_map_issues):
+	'''Prints the patients with results that are not in the map, raises if patients of the map have no number'''
 	# 9-digit
 	patients_in_current_labresults_not_in_map = [p for p in patient_IDs_in_current_labresults if p//10 not in patient_IDs_in_patients_map]
 	if len(patients_in_current_labresults_not_in_map) > 0:
@@ -140,606 +194,699 @@ if perform_merging_routine == 'y':
 		print(horizontal_line)
 		print()
 
-	# 9-digit
-	patients_in_map_but_number_missing = [ p for p in patient_IDs_in_patients_map if patID2Num(p) == '']
+	# 8-digit
+	patients_in_map_but_number_missing = patients_map_issues['number_missing']
 	if len(patients_in_map_but_number_missing) > 0:
 		[print(p) for p in patients_in_map_but_number_missing ]
 		print()
 		raise Exception('\nThese PATIFALLNR patients have labresults and ARE in patients map, but they are not associated to a number. Fix the patients map. \n')
 
-	print('\n Generating lab results file for each patient in patients map and in current result sheet...\n')
+def merge_raw_results(args, current_date, patients_map, patient_numbers, patients_map_issues, parameter_catalog, profile = None):
+	'''Merging routine; returns the directory of the merge and the dictionary filename -> raw rows of each patient'''
+	from tqdm import tqdm
+	from ingestion import needed_columns, raw_results_files, read_raw_results_file, concat_raw_results
+	from excel_reader import read_excel_columns
+	from parameter_catalog import catalog_signature
+	from manifest import load_manifest, save_manifest, merge_filters_fingerprint, compare_with_manifest
+	from store import save_merged_store, has_merged_store, load_merged_store
+	from export import partition_by_patient, export_patient_sheets, export_summary
 
-	patients_in_current_labresults_and_in_map_8_digit = patient_IDs_in_current_labresults_8_digit.intersection(patient_IDs_in_patients_map)
-
-	# patient is 8-digit identifier
-	for patient in tqdm(patients_in_current_labresults_and_in_map_8_digit):
-
-		# patient_number is rebecca identifer
-		patient_number = patID2Num(patient)
-		
-		raw_df_patient = raw_df[raw_df.PATIFALLNR//10 == patient]
-
-		filename = f'{patient_number}-{patient}.xlsx'
-		save_excel_patient_sheet(raw_df_patient, lab_results_directory, filename)
-
-	print(f'\n{horizontal_line}')
-	print('MERGING ROUTINE COMPLETED :)\n Starting data manipulation.')
-	print(horizontal_line)
-
-if perform_merging_routine == 'n':
-
-	name_of_directory_with_most_recent_results = [directory for directory in sorted(os.listdir(directory_merged_results_per_patient), key=natsort) if not directory.startswith('.')][-1]
-
-	lab_results_directory = f'{directory_merged_results_per_patient}/{name_of_directory_with_most_recent_results}'   # one file per patient
-
-if debug:
-	name_of_directory_with_most_recent_results_debug = [directory for directory in sorted(os.listdir(directory_merged_results_per_patient_debug), key=natsort) if not directory.startswith('.')][-1]
-
-	lab_results_directory = f'{directory_merged_results_per_patient_debug}/{name_of_directory_with_most_recent_results_debug}'   # one file per patient
-
-	print(red('\nDEBUG MODE ON\n'))
-
-####################################################################################################################################################################################
-# END DATA MERGING ROUTINE
-####################################################################################################################################################################################
-
-
-
-
-####################################################################################################################################################################################
-# START DATA MANIPULATION ROUTINE FOR EACH PATIENT
-####################################################################################################################################################################################
-
-
-
-def period_maker():
-	'''Returns [7, 7, 7, 2] if num_max_days = 23 and sub_period_duration = 7'''
-	if num_max_days < sub_period_duration:
-		raise Exception('First input must be >= second')
-	if num_max_days % sub_period_duration == 0:
-		raise Exception(f'\n\nFor technical reasons num_max_days {num_max_days} cannot be a multiple of sub_period_duration {sub_period_duration}. To resolve set for example num_max_days to {num_max_days+1}.\n ')
-	num_full_sub_periods = int(num_max_days/sub_period_duration)
-	days_in_final_subperiod = num_max_days % sub_period_duration
-	period_list = [sub_period_duration for _ in range(num_full_sub_periods)]
-	if days_in_final_subperiod != 0: period_list = period_list +[days_in_final_subperiod]
-	return period_list
-
-def data_splitter(data):
-	'''Given data of lenght num_max_days splits it according to period_maker
-
-	e.g. num_max_days = 11
-	sub_period_duration = 3
-	period_list = period_maker() returns [3, 3, 3, 2]
-	data = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+	lab_results_directory = f'{directory_merged_results_per_patient}/{current_date}'   # one file per patient
 
-	data_splitter(data) returns [[1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 11]]
+	# Rows of patients not in the map and of parameters not needed are dropped while reading
+	patient_IDs_in_patients_map = set(patients_map.PATIFALLNR)
 
-	'''
-	period_list = period_maker()
-	helper = [sum(period_list[:i]) for i in range(len(period_list)+1)]
-	return [  data[helper[i]:helper[i+1]] for i in range(len(helper)-1) ]
+	# Compare raw files with the manifest of the previous merge: only new or changed files are parsed,
+	# only the patients they touch are rebuilt and all the others are carried over from the previous merge
+	previous_lab_results_directory = None
+	if not args.full_merge and os.path.isdir(directory_merged_results_per_patient):
+		previous_lab_results_directory = most_recent_directory(directory_merged_results_per_patient)
+	previous_manifest = load_manifest(previous_lab_results_directory)
+	if previous_lab_results_directory is not None and previous_manifest is None:
+		print(orange(f'\n {previous_lab_results_directory} has no manifest of its raw files, so this merge is not incremental: every raw file is merged again.'))
+
+	filters_fingerprint = merge_filters_fingerprint(patients_map, catalog_signature(parameter_catalog))
+	raw_result_files = raw_results_files(lab_results_raw_directory)
+	raw_file_entries, unchanged_raw_files, raw_files_to_parse, removed_raw_files = compare_with_manifest(previous_manifest, lab_results_raw_directory, raw_result_files, filters_fingerprint)
+
+	parsed_raw_data = {}
+	unknown_parameter_names = {}
+	for raw_result in raw_files_to_parse:
+		print(f'\n Extracting data from {raw_result}...')
+		with profile_stage(profile, f'ingest {raw_result}') as stage:
+			parsed_raw_data[raw_result], current_patient_IDs, unknown_counts = read_raw_results_file(f'{lab_results_raw_directory}/{raw_result}', patient_IDs_in_patients_map, parameter_catalog)
+			stage['rows'] = len(parsed_raw_data[raw_result])
+		raw_file_entries[raw_result]['patients'] = sorted(current_patient_IDs)
+		for name, rows in unknown_counts.items():
+			unknown_parameter_names[name] = unknown_parameter_names.get(name, 0) + rows
+
+	# Names in the raw results that are not needed parameters, also after repairing strange characters
+	if len(unknown_parameter_names) > 0:
+		print(f'\n {len(unknown_parameter_names)} parameter names in the new raw results are not needed parameters, their rows are ignored.')
+		for name, rows in sorted(unknown_parameter_names.items()):
+			log.debug('   %s (%s rows)', name, rows)
 
-all_days = [_ for _ in range(num_max_days)]
-split_days = data_splitter(all_days)
-#print(split_days)
+	# 8-digit
+	patients_to_rebuild = set()
+	for raw_result in raw_files_to_parse:
+		patients_to_rebuild.update(p//10 for p in raw_file_entries[raw_result]['patients'])
+	for raw_result in raw_files_to_parse + removed_raw_files:
+		if previous_manifest is not None and raw_result in previous_manifest['files']:
+			patients_to_rebuild.update(p//10 for p in previous_manifest['files'][raw_result]['patients'])
+
+	# Unchanged patients are carried over from the store of the previous merge or, if it has none, from its patient files;
+	# patients it has neither for are rebuilt as well
+	previous_raw_df_per_patient = None
+	previous_files = set()
+	if len(unchanged_raw_files) > 0:
+		if has_merged_store(previous_lab_results_directory):
+			previous_raw_df_per_patient = load_merged_store(previous_lab_results_directory)
+			previous_files = set(previous_raw_df_per_patient)
+		else:
+			previous_files = set(os.listdir(previous_lab_results_directory))
+	for raw_result in unchanged_raw_files:
+		patients_to_rebuild.update(p//10 for p in raw_file_entries[raw_result]['patients'] if p//10 in patient_IDs_in_patients_map and f'{patID2Num(patient_numbers, p//10)}-{p//10}.xlsx' not in previous_files)
+
+	# Unchanged files are read again only if they contain rows of patients to rebuild, and only for those patients
+	for raw_result in unchanged_raw_files:
+		if any(p//10 in patients_to_rebuild for p in raw_file_entries[raw_result]['patients']):
+			print(f'\n Extracting data of changed patients from {raw_result}...')
+			with profile_stage(profile, f'ingest {raw_result}') as stage:
+				parsed_raw_data[raw_result], _, _ = read_raw_results_file(f'{lab_results_raw_directory}/{raw_result}', patient_IDs_in_patients_map & patients_to_rebuild, parameter_catalog)
+				stage['rows'] = len(parsed_raw_data[raw_result])
+
+	if len(unchanged_raw_files) > 0:
+		print(f'\n {len(unchanged_raw_files)} raw files unchanged since {previous_lab_results_directory}, {len(raw_files_to_parse)} new or changed, {len(removed_raw_files)} removed.')
+
+	# 9-digit, all patients in the raw results, also those not in the map
+	patient_IDs_in_current_labresults = set()
+	for entry in raw_file_entries.values():
+		patient_IDs_in_current_labresults.update(entry['patients'])
+
+	# Merge into single, in the same order as a full merge
+	raw_data = [parsed_raw_data[raw_result] for raw_result in raw_result_files if raw_result in parsed_raw_data]
+	with profile_stage(profile, 'merge') as stage:
+		raw_df = concat_raw_results(raw_data)
+		stage['rows'] = len(raw_df)
 
+	print('\n All raw results merged into single result!')
 
-def dictionary_values_splitter(dictionary_to_split):
-	return { k:data_splitter(v) for k,v in dictionary_to_split.items() }
 
-def dict_of_lists_to_list_of_dicts(dict_of_lists):
-	return [ dict(zip(dict_of_lists, i)) for i in zip(*dict_of_lists.values()) ]
+	# 9-digit, all patients in the raw results, also those not in the map
+	patient_IDs_in_current_labresults_8_digit = set([p//10 for p in patient_IDs_in_current_labresults])
 
+	report_patients_not_in_map(patient_IDs_in_current_labresults, patient_IDs_in_patients_map, patients_map_issues)
 
-# START FIXING PARAMETERS NAMES
-# Real parameters are read from parameters.txt
-all_needed_parameters = generate_parameters('parameters_directory/parameters.txt')
-all_needed_parameters_before_fixing_names = all_needed_parameters[:]
-verprint(f'\nHere are all needed parameters before fixing names: \n\n {all_needed_parameters}\n\n')
-
-parameters_strange_characters_from_lab = generate_parameters('parameters_directory/parameters_strange_characters_from_lab.txt')
-parameters_strange_characters_from_lab_python = generate_parameters('parameters_directory/parameters_strange_characters_from_lab_python.txt')
-
-parameters_strange_characters_from_lab_corrected = generate_parameters('parameters_directory/parameters_strange_characters_from_lab_corrected.txt')
-
-parameters_correction_dictionary = dict_from_two_lists(parameters_strange_characters_from_lab, parameters_strange_characters_from_lab_corrected)
-parameters_correction_dictionary_python = dict_from_two_lists(parameters_strange_characters_from_lab_python, parameters_strange_characters_from_lab_corrected)
-
-# Acts in place; remove parameters with strange names from all needed parameters with those with correct names
-# The same procedure has to be done on the data, using parameters_correction_dictionary_python
-replace_list_elements_by_dict(all_needed_parameters, parameters_correction_dictionary)
-verprint('\nHere are all needed parameters before and after fixing names:\n')
-for i in range(len(all_needed_parameters_before_fixing_names)):
-	#if all_needed_parameters_before_fixing_names[i] in parameters_strange_characters_from_lab:
-	if all_needed_parameters_before_fixing_names[i] != all_needed_parameters[i]:
-		verprint(orange(f'{all_needed_parameters_before_fixing_names[i]} /// {all_needed_parameters[i]}'))
+	if args.direct:
+		print('\n Splitting lab results by patient for each patient in patients map and in current result sheet...\n')
 	else:
-		verprint(f'{all_needed_parameters_before_fixing_names[i]} /// {all_needed_parameters[i]}')
-
-# END FIXING PARAMETERS NAMES
-
-
-#num_patients = 0
-patient_identifier_PATIFALLNR = []
-day0_all_patients = []
+		print('\n Generating lab results file for each patient in patients map and in current result sheet...\n')
 
-# Multiple sheets
-
-number_of_sheets = int(num_max_days/sub_period_duration) + 1
-
-big_data_multiple_sheets = [  [ ] for _ in range(number_of_sheets)  ]
-
-
-
-# START PATIENT
-patients_with_error = []
-# Read each excel file in lab_results_directory into dataframe and put it into data_list
-print('\n Starting patients loop...')
-for patient in tqdm( sorted(os.listdir(lab_results_directory), key=natsort) ):
-	# make sure to select only excel files; sometimes hidden files like ~$patient.xlsx are created, which must be excluded:
-	if patient.endswith(".xlsx") and not patient.startswith("~"):
-
-		try:
-			#num_patients +=1
-			verprint(f'\n{horizontal_line}')
-			verprint(horizontal_line)
-			verprint(orange(f'--> Processing patient {patient}...\n'))
-
-			# START MERGING DATAFRAME
-			# Read data into two df
-			data = pd.read_excel(f'{lab_results_directory}/{patient}') #, skiprows = 2, usecols = 'A, B, C, D')
-
-			# Get rid of spaces in columns
-			#data.columns = data.columns.str.replace(' ', '')
-
-			# Get rid of » symbol in indiced
-			# data.BESCHREIBUNG = data.BESCHREIBUNG.str.replace(' »', '')
+	patients_in_current_labresults_and_in_map_8_digit = patient_IDs_in_current_labresults_8_digit.intersection(patient_IDs_in_patients_map)
 
-			# drop not needed columns
-			#not_needed_columns = ['AUFTRAGNR', 'GEBDAT', 'SEX', 'EINSCODE', 'LABEINDAT']
-			needed_columns = ['PATIFALLNR', 'BESCHREIBUNG', 'ERGEBNIST', 'LABEINDAT']
-			for col in data.columns:
-				if col not in needed_columns:
-					data.drop(col, axis = 1, inplace = True)
+	# filename -> raw rows of the patient
+	raw_df_per_patient = {}
 
-			# Replace weird german characters parameters names with normal ones
+	# 8-digit identifier of each row, derived once, and rows split by patient in a single pass
+	with profile_stage(profile, 'partition') as stage:
+		raw_df_by_patient = partition_by_patient(raw_df, raw_df.PATIFALLNR.to_numpy() // 10)
+		stage['rows'] = len(raw_df)
 
-			verprint(horizontal_line_before_space)
-			verprint(f'Here is the data before renaming weird parameters: \n \n {data}')
+	# patient is 8-digit identifier
+	for patient in tqdm(patients_in_current_labresults_and_in_map_8_digit & patients_to_rebuild):
 
-			for i in range(len(data.BESCHREIBUNG)):
-				if data.at[i, 'BESCHREIBUNG'] in parameters_strange_characters_from_lab_python:
-					data.at[i, 'BESCHREIBUNG'] = parameters_correction_dictionary_python[data.at[i, 'BESCHREIBUNG']]
+		# patient_number is rebecca identifer
+		patient_number = patID2Num(patient_numbers, patient)
 
-			verprint(f'Here is the data after renaming weird parameters: \n \n {data}')
-			verprint('Things are ok if the names in all needed and in data AFTER CORRECTION match.')
-			verprint(horizontal_line_after_space)
+		filename = f'{patient_number}-{patient}.xlsx'
+		# patients whose rows were all dropped (e.g. only not needed parameters) get an empty file, as before
+		raw_df_per_patient[filename] = raw_df_by_patient.get(patient, raw_df.iloc[0:0])
+
+	# Excel files to write; those of unchanged patients are copied from the previous merge when possible
+	files_to_export = dict(raw_df_per_patient)
+	write_patient_files = not args.direct or args.export_patients
+
+	# Patients untouched by new or changed files
+	patients_to_carry_over = patients_in_current_labresults_and_in_map_8_digit - patients_to_rebuild
+	if len(patients_to_carry_over) > 0:
+		print(f'\n Carrying over {len(patients_to_carry_over)} unchanged patients from {previous_lab_results_directory}...\n')
+		for patient in patients_to_carry_over:
+			filename = f'{patID2Num(patient_numbers, patient)}-{patient}.xlsx'
+			if previous_raw_df_per_patient is not None:
+				raw_df_per_patient[filename] = previous_raw_df_per_patient[filename]
+			else:
+				raw_df_per_patient[filename] = read_excel_columns(f'{previous_lab_results_directory}/{filename}', needed_columns, excel_reader_engine)
+			if write_patient_files:
+				if os.path.exists(f'{previous_lab_results_directory}/{filename}'):
+					os.makedirs(lab_results_directory, exist_ok=True)
+					shutil.copy(f'{previous_lab_results_directory}/{filename}', lab_results_directory)
+				else:
+					files_to_export[filename] = raw_df_per_patient[filename]
+
+	if write_patient_files:
+		export_start = time.perf_counter()
+		with profile_stage(profile, 'export patient files') as stage:
+			export_report = export_patient_sheets(files_to_export, lab_results_directory, args.jobs)
+			stage['rows'] = sum(entry['rows'] for entry in export_report)
+		for entry in export_report:
+			log.debug(' %s: %s rows, %.1f kB in %.3f s', entry['file'], entry['rows'], entry['bytes']/1000, entry['seconds'])
+		print(f'\n Wrote {export_summary(export_report, time.perf_counter() - export_start)}')
+
+	# Single file with all merged patients, so that next runs can re-use this merge quickly
+	with profile_stage(profile, 'save merged store') as stage:
+		save_merged_store(raw_df_per_patient, lab_results_directory)
+		stage['rows'] = sum(len(df) for df in raw_df_per_patient.values())
+	# Manifest of the raw files in it, so that next merges can be incremental
+	save_manifest(lab_results_directory, {'filters': filters_fingerprint, 'files': raw_file_entries})
 
-			# IF INSTEAD PARAMETERS ARE VALUES OF COLUMN # <----------- MAIN DROP
-			# https://stackoverflow.com/questions/18172851/deleting-dataframe-row-in-pandas-based-on-column-value
+	print(f'\n{horizontal_line}')
+	print('MERGING ROUTINE COMPLETED :)\n Starting data manipulation.')
+	print(horizontal_line)
 
-			# From labresults, drop parameters that are not needed
-			for param in data.BESCHREIBUNG:
-				if param not in all_needed_parameters:
-					verprint(red(f'{param} is in lab results, but is not one of the needed parameters, so I am dropping it \n'))
-					data.drop(data.index[ data.BESCHREIBUNG == param ], inplace = True) 
-
-					# Should be allright without this
-					# try:
-					#   data.drop(data.index[ data.BESCHREIBUNG == param ], inplace = True)
-					# except:
-					#   pass
-
-			# Since some rows were dropped, not index looks like [0, 1, 5, 9, 15, ...]
-			# Which is a mess because data.colum[i] refers to that index. So need to reset.
-			data.reset_index(inplace = True, drop = True)
-
-
-
-			# Now not needed parameters are dropped from data.BESCHREIBUNG. It may still happen that a needed parameter is not present in result. Fixed later. 
-
-
-
-
-			# Fix dates format
-			# for i in range(len(data.LABEINDAT)):
-
-			#   # Some dates were recognized by pandas already as datetimes; other are still strings because 1. they contain spaces and 2. they contain . rather than /
-			#   if type( data.at[i, 'LABEINDAT'] ) is str:
-			#       data.at[i, 'LABEINDAT'] = data.at[i, 'LABEINDAT'].replace(' ', '')
-			#       data.at[i, 'LABEINDAT'] = data.at[i, 'LABEINDAT'].replace('.', '/')   
-
-			# Convert to datetime
-			data['LABEINDAT'] = pd.to_datetime(data['LABEINDAT'], dayfirst = True)
-
-			# Add column only with info about day
-			data = data.assign(DAY=data['LABEINDAT'].dt.strftime('%Y-%m-%d'))
-			data['DAY'] = pd.to_datetime(data['DAY'], dayfirst = True)
-			# This way DAY contains datetime objects, but keeps only year, month and date forgetting about hour, minute and second
-			# ---------------------------------------------------------------------------------------------------
-
-			#START GETTING RID OF kein material ROWS
-			if keep_kein_material == 'n':
-				strings_to_kill = ['Kein Material', 'K.Mat.']
-				for s in strings_to_kill:
-					index_to_kill = data.index[ data.ERGEBNIST == s ]
-					[ print(f"---------------Dropping {s} for {data.at[ i , 'Parameter']}") for i in list(index_to_kill) ]
-					data.drop(index_to_kill, inplace = True)
-
-				data.reset_index(inplace = True, drop = True)
-
-			# END GETTING RID OF kein material ROWS
-
-			# NON STANDARD RESULTS
-			# + and positive to 1
-			# - and negative to empty
-			# anything else remains text
-
-			# Get rid of !L and !H flags
-			for i in range(len(data.ERGEBNIST)):
-				if type( data.at[i, 'ERGEBNIST'] ) is str:
-					#data.at[i, 'ERGEBNIST'] = data.at[i, 'ERGEBNIST'].replace(' !L', '')
-					#data.at[i, 'ERGEBNIST'] = data.at[i, 'ERGEBNIST'].replace(' !H', '')
-					data.at[i, 'ERGEBNIST'] = data.at[i, 'ERGEBNIST'].replace('negativ', negative_result)
-					data.at[i, 'ERGEBNIST'] = data.at[i, 'ERGEBNIST'].replace('-', negative_result)
-					data.at[i, 'ERGEBNIST'] = data.at[i, 'ERGEBNIST'].replace('positiv', positive_result)
-					data.at[i, 'ERGEBNIST'] = data.at[i, 'ERGEBNIST'].replace('+', positive_result)
-
-					#This converts results to float if possible
-					try:
-						data.at[i, 'ERGEBNIST'] = data.at[i, 'ERGEBNIST'].replace(',', '.')
-						data.at[i, 'ERGEBNIST'] = float(data.at[i, 'ERGEBNIST'])
-					except:
-						pass
-
-			# END NON STANDARD RESULTS
-
-			# START GETTING RID OF DUPLICATE EXAM 
-			# POSSIBILITIES:
-			
-			# 1. Restructure all so that parameters are column, not index, and use
-			# https://stackoverflow.com/questions/50885093/how-do-i-remove-rows-with-duplicate-values-of-columns-in-pandas-data-frame
-
-			# 2. Keep parameters as index, work on sub-frames for each parameter, drop duplicate date column
-			# Then reconstruct big dataframe by composition
-
-			## IMPROVED DUPLICATED ALGORITH: KEEP WITH THIS PRIORITY
-			# - the one done closest in time to penkid
-			# - the first of the day
-
-			# First make sure reference parameter does not appear more than once per day
-			df_specific_for_reference_parameter = data.loc[ data.BESCHREIBUNG == reference_parameter ]
-			boolean_duplicated_series_reference = df_specific_for_reference_parameter.duplicated( ['BESCHREIBUNG', 'DAY'], keep = False )
-			if( boolean_duplicated_series_reference.any() ):
-				df_duplicated_reference_parameter = df_specific_for_reference_parameter[boolean_duplicated_series_reference]
-				
-				for day in set(df_duplicated_reference_parameter.DAY):
-					df_duplicated_reference_parameter_day = df_duplicated_reference_parameter[ df_duplicated_reference_parameter.DAY == day ]
-
-					# print(df_duplicated_reference_parameter_day)
-					# print()
-					# print('---')
-					# for p in df_duplicated_reference_parameter_day.ERGEBNIST:
-					# 	print(p)
-					# 	print(type(p))
-					# print('---')
-
-					# Keep earlies numerical result, or earliest result if no result is a number
-					# https://stackoverflow.com/questions/50967231/pandas-select-rows-by-type-not-dtype
-					try:
-						index_to_keep_reference = df_duplicated_reference_parameter_day[df_duplicated_reference_parameter_day.ERGEBNIST.map(type)==float]['LABEINDAT'].idxmin()
-					except:
-						index_to_keep_reference = df_duplicated_reference_parameter_day['LABEINDAT'].idxmin()
-					#print(index_to_keep_reference)
-					#print()
-					#print(df_duplicated_reference_parameter_day[index_to_keep_reference])
-					#print()
-					#print(df_duplicated_reference_parameter_day)
-					for i in df_duplicated_reference_parameter_day.index:
-						if str(i) != str(index_to_keep_reference):
-							data.drop(i, inplace = True)
-				data.reset_index(inplace = True, drop = True)
-				#input(f'\n ---- ALERT----- \n\n Reference parameter {reference_parameter} appears more than once per day. Keeping first of each day. Enter to continue' )
-
-
-			##############################################
-			# Now deal with duplicates of all other parameters
-
-			# OPTION 1
-			#data.drop_duplicates( ['Parameter', 'LABEINDAT'], keep = 'first', inplace = True, ignore_index = True  )
-			for p in set(data.BESCHREIBUNG):
-				#print(f'PERFORMING PARAMETER {p} WHILE REFERENCE IS {reference_parameter}\n')
-				df_specific_for_p = data.loc[ data.BESCHREIBUNG == p ]
-
-				# https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.duplicated.html
-				boolean_duplicated_series = df_specific_for_p.duplicated( ['BESCHREIBUNG', 'DAY'], keep = False )
-
-				if( boolean_duplicated_series.any() ):
-					df_duplicated_p = df_specific_for_p[boolean_duplicated_series]
-					for day in set(df_duplicated_p.DAY):
-						df_duplicated_p_day = df_duplicated_p[ df_duplicated_p.DAY == day ]
-						#print()
-						#print(df_duplicated_p_day)
-					   
-
-						# Not reference parameter
-						current_day = list(df_duplicated_p_day.DAY)[0]
-						#####
-						reference_df = data[ data.BESCHREIBUNG == reference_parameter ]
-						reference_df = reference_df[ reference_df.DAY == current_day ]
-						#reference_time = list(reference_df.LABEINDAT)[0]
-						# print()
-						# print('debug------------------')
-						# print(reference_df)
-						# print()
-						# print('debug------------------')
-						# print()
-						#####
-
-						# IF THERE IS PENKID COMPARE WITH PENKID
-						try:
-							# reference_df = data[ data.BESCHREIBUNG == reference_parameter ]
-							# reference_df = reference_df[ reference_df.DAY == current_day ]
-							reference_time = list(reference_df.LABEINDAT)[0]
-
-							# IF THERE IS NUMERICAL RESULT, TAKE NUMERICAL CLOSET TO PENKID
-							try:
-								closest_time = find_nearest( df_duplicated_p_day[df_duplicated_p_day.ERGEBNIST.map(type)==float].LABEINDAT, reference_time ) 
-
-							# IF NO RESULT IS NUMERICAL, TAKE CLOSEST TO PENKID
-							except:
-								closest_time = find_nearest( df_duplicated_p_day.LABEINDAT, reference_time )
-
-							index_to_keep = df_duplicated_p_day.index[df_duplicated_p_day['LABEINDAT'] == closest_time].tolist()[0]
-							# print('Comparison done')
-							# print(f'reference_time: {reference_time}')
-
-						# IF THERE IS NO PENKID TAKE THE FIRST RESULT OF THE DAY
-						except:
-
-							# IF THERE IS NUMERICAL RESULT, TAKE FIRST NUMERICAL
-							try:
-								index_to_keep = df_duplicated_p_day[df_duplicated_p_day.ERGEBNIST.map(type)==float]['LABEINDAT'].idxmin()
-
-							# IF THERE IS NO NUMERICAL RESULT, TAKE FIRST 
-							except:
-								index_to_keep = df_duplicated_p_day['LABEINDAT'].idxmin()
-						#     print('Just kept first')
-						# print(f'Index to keep: {index_to_keep}\n')
-
-						# DROP DUPLICATES
-
-						for i in df_duplicated_p_day.index:
-							if str(i) != str(index_to_keep):
-								data.drop(i, inplace = True)
-
-			data.reset_index(inplace = True, drop = True)
-			
-			# Reconvert results to number like 3,4 rather than 3.4, so that excel is happy.. #-------------------------------------------------------------------------------------------
-			# Alternative: in Excel use dot as float separator https://www.officetooltips.com/excel_2016/tips/change_the_decimal_point_to_a_comma_or_vice_versa.html
-			for i in range(len(data.ERGEBNIST)):
-				if type( data.at[i, 'ERGEBNIST'] ) is float:
-					data.at[i, 'ERGEBNIST'] = str(data.at[i, 'ERGEBNIST'])
-					data.at[i, 'ERGEBNIST'] = data.at[i, 'ERGEBNIST'].replace('.', ',')
-
-
-			# END GETTING RID OF DUPLICATE EXAM # ----------
-
-			# END MANIPULATING DATAFRAME
-
-
-			# CAREFUL ACTUALLY DAY0 IS FROM EXTERNAL SOURCE, IT MAY BE THAT NO EXAM IS TAKEN ON DAY 0 <------------------------------------------------------------------------------------------------------------------- temporary
-			# Get patient day0 = when she enters hospital
-
-			# 9-digit identifier
-			current_patient_PATIFALLNR = data['PATIFALLNR'][0]
+	return lab_results_directory, raw_df_per_patient
 
-			
+def load_previous_merge():
+	'''Returns the most recent merge directory and, if it has a store of merged results, the dictionary filename -> raw rows of each patient'''
+	from store import has_merged_store, load_merged_store
 
+	lab_results_directory = most_recent_directory(directory_merged_results_per_patient)   # one file per patient
 
-			# SWITCH THIS ON ONCE REAL DATA FOR DAY 0 IS AVAILABLE; NOW SIMULATE
-			#print('TAKING CORRECT DATE')
-			day0 = patients_map[ patients_map.PATIFALLNR == current_patient_PATIFALLNR//10 ].DAY0.iloc[0] #.strftime('%Y-%m-%d')
-			#print(day0)
+	# Prefer the store of the merge over the excel files, if there is one
+	if lab_results_directory is not None and has_merged_store(lab_results_directory):
+		print(f'\n Loading merged results from {lab_results_directory}...')
+		return lab_results_directory, load_merged_store(lab_results_directory)
+	return lab_results_directory, None
 
+def merge_has_only_shards(lab_results_directory):
+	'''Whether the merge in lab_results_directory was made out of core without patient files (e.g. with --direct), so
+	that its results are only in its shards'''
+	from shards import has_shards
+	from store import has_merged_store
 
-			# simulate day0 as day before day of first exam; to switch off once real data for time0 is available
-			#day0 = day_of_first_exam - timedelta(days = 1)
+	if not has_shards(lab_results_directory) or has_merged_store(lab_results_directory):
+		return False
+	return not any(patient.endswith(".xlsx") and not patient.startswith("~") for patient in os.listdir(lab_results_directory))
 
-			day0_all_patients.append(day0)
+def spill_raw_results_to_shards(args, current_date, patients_map, patients_map_issues, parameter_catalog, profile = None):
+	'''First phase of the out-of-core merging routine: streams the raw results into on-disk shards by patient (see shards.py)
+	sized for args.memory_budget; returns the directory of the merge'''
+	from ingestion import raw_results_files
+	from shards import shards_for_budget, chunksize_for_budget, spill_raw_results
 
+	lab_results_directory = f'{directory_merged_results_per_patient}/{current_date}'
 
-			# GETTING RID OF EXAMS DONE BEFORE DAY 0 and before november second 2021 and sort data by date
-			#print(day0)
-			data = data[ data.DAY >= day0 ]
-			data = data[ data.DAY >= initial_day_of_study ]
-			data.sort_values('DAY', inplace = True)
-			# END GETTING RID OF EXAMS DOBE BEFORE DAY 0
+	patient_IDs_in_patients_map = set(patients_map.PATIFALLNR)
+	raw_result_filepaths = [f'{lab_results_raw_directory}/{raw_result}' for raw_result in raw_results_files(lab_results_raw_directory)]
+	num_shards = shards_for_budget(sum(os.path.getsize(filepath) for filepath in raw_result_filepaths), args.memory_budget)
 
-			
-			try:
-				day_of_first_exam = min(data.DAY)
-			except:
-				raise Exception(f"It could be that every exam is done after day0; check patient map for patient {patient} ")
+	print(f'\n Streaming {len(raw_result_filepaths)} raw files into {num_shards} shards by patient (memory budget {args.memory_budget:g} MB)...')
+	with profile_stage(profile, 'spill to shards') as stage:
+		patient_IDs_in_current_labresults, unknown_parameter_names, stage['rows'] = spill_raw_results(raw_result_filepaths, lab_results_directory, patient_IDs_in_patients_map,
+																										parameter_catalog, num_shards, chunksize_for_budget(args.memory_budget))
 
+	if len(unknown_parameter_names) > 0:
+		print(f'\n {len(unknown_parameter_names)} parameter names in the raw results are not needed parameters, their rows are ignored.')
+		for name, rows in sorted(unknown_parameter_names.items()):
+			log.debug('   %s (%s rows)', name, rows)
 
-			if day0 > day_of_first_exam:
-				raise Exception(f'\nFor patient {patient} day 0 is {day0} but first exam is done on {day_of_first_exam}\n')
+	report_patients_not_in_map(patient_IDs_in_current_labresults, patient_IDs_in_patients_map, patients_map_issues)
 
-			if day0 < initial_day_of_study:
-				raise Exception(f'\nFor patient {patient} day 0 is {day0} but initial day of study is {initial_day_of_study}\n')
-			  
+	print(f'\n{horizontal_line}')
+	print('RAW RESULTS SPILLED TO SHARDS :)\n Merging and processing one shard at a time.')
+	print(horizontal_line)
 
-			# Get range of time in which exams are taken; not really used anywhere
-			day_first_exam, day_last_exam = min(data.LABEINDAT), max(data.LABEINDAT)
-			exam_period = day_last_exam - day_first_exam
-			# print(exam_period)
+	return lab_results_directory
 
-			# Check time period
-			if exam_period > pd.Timedelta(num_max_days, unit = 'd'):
-				print(red(f'\n\n-----------SOMETHING WRONG---------\n\n Exam period lasts {exam_period}, longer than {num_max_days} days\n----------\n'))
-				raise Exception
+####################################################################################################################################################################################
+# END DATA MERGING ROUTINE
+####################################################################################################################################################################################
 
-			# Set maximal period of staying in the hospital; equal for everybody
-			period = pd.date_range(start=day0, periods=num_max_days)
-			# print(period)
 
-			# PARAMETERS TO KEEP 
 
-			# parameters actually present in lab results
-			# parameters_needed_and_available_from_lab = list(set(data.BESCHREIBUNG)) # this works but CHANGES ORDER
 
-			# this contains the parameters that are needed AND available from the lab results, in the same order of all_needed_parameters
-			parameters_needed_and_available_from_lab = [ p for p in all_needed_parameters if p in list(data.BESCHREIBUNG )]
+####################################################################################################################################################################################
+# START DATA MANIPULATION ROUTINE FOR EACH PATIENT
+####################################################################################################################################################################################
 
-			# parameters_needed_and_available_from_lab is equal to data.BESCHREIBUNG, without repetitions
-			parameters_needed_but_not_available_from_lab = [p for p in all_needed_parameters if p not in list(data.BESCHREIBUNG)]
+def process_patients(args, lab_results_directory, raw_df_per_patient, lab_results_directory_debug, parameter_catalog, patient_day0s, profile = None, settings = None, data_per_patient = None):
+	'''Processes each patient, from memory if raw_df_per_patient is given, otherwise from the excel files of lab_results_directory
 
-			# for parameter in data.BESCHREIBUNG:
-			#   if parameter not in parameters_needed_and_available_from_lab:
-			#       data.drop(parameter, axis = 0, inplace = True)
+	Returns the cells of each patient in the final grid, their 9-digit identifiers and day0s, and the patients with errors.
+	With profile, the measures of each patient are appended to profile['patients']. settings default to those of
+	program_parameters.py; data_per_patient, if given, are the rows processed instead (e.g. already compacted, see batch.py),
+	raw_df_per_patient or the files still being what is exported for the patients with errors.
+	'''
+	from tqdm import tqdm
+	from export import save_excel_patient_sheet
+	from processing import make_settings, run_patients
+
+	#num_patients = 0
+	patient_identifier_PATIFALLNR = []
+	day0_all_patients = []
+
+	# cells of each patient in the final grid, see grid.py
+	cells_per_patient = []
+
+	# START PATIENT
+
+	patients_with_error = []
+
+	if settings is None:
+		settings = make_settings(parameter_catalog, patient_day0s, initial_day_of_study, num_max_days, sub_period_duration,
+								reference_parameter, keep_kein_material, empty_result, positive_result, negative_result, args.verbose,
+								profile = profile is not None, cache_directory = None if args.no_cache or args.debug else directory_patient_cache,
+								excel_reader = excel_reader_engine)
+
+	# Read each excel file in lab_results_directory (or each in memory patient in direct mode or from the merged store) and process it
+	print('\n Starting patients loop...')
+	patients_in_memory = raw_df_per_patient is not None
+	if data_per_patient is not None:
+		patients_to_process = sorted(data_per_patient, key=natsort)
+		sources = [data_per_patient[patient] for patient in patients_to_process]
+	elif patients_in_memory:
+		patients_to_process = sorted(raw_df_per_patient, key=natsort)
+		sources = [raw_df_per_patient[patient] for patient in patients_to_process]
+	else:
+		# make sure to select only excel files; sometimes hidden files like ~$patient.xlsx are created, which must be excluded:
+		patients_to_process = [patient for patient in sorted(os.listdir(lab_results_directory), key=natsort) if patient.endswith(".xlsx") and not patient.startswith("~")]
+		sources = [f'{lab_results_directory}/{patient}' for patient in patients_to_process]
 
 
-			# data.sort_values(by=['LABEINDAT'], inplace = True) 
-			# print(f'\nSorted by date \n {data}\n')
+	# Results come back in the order of patients_to_process, whatever the number of jobs
+	patients_from_cache = 0
+	for patient, result, error_traceback, cached, measures in tqdm( run_patients(patients_to_process, sources, settings, args.jobs), total = len(patients_to_process) ):
 
-			# Start building dictionary
+		if measures is not None:
+			profile['patients'].append(measures)
+		patients_from_cache += cached
 
-			# This worked with parameter as index
-			# def get_results(parameter):
-			#   try:
-			#       # if there is more than one result
-			#       return list(data.loc[parameter].ERGEBNIST)
-			#   except:
-			#       # if there is only one result
-			#       return [data.loc[parameter].ERGEBNIST]
+		if error_traceback is None:
+			patient_cells, current_patient_PATIFALLNR, day0 = result
 
-			# def get_dates(parameter):
-			#   try:
-			#       # if there is more than one result
-			#       return list(data.loc[parameter].LABEINDAT)
-			#   except:
-			#       # if there is only one result
-			#       return [data.loc[parameter].LABEINDAT]
+			cells_per_patient.append(patient_cells)
 
-			def get_results(parameter):
-				return list(data[data.BESCHREIBUNG == parameter].ERGEBNIST)
+			# contains 9-digit identifiers
+			patient_identifier_PATIFALLNR.append(current_patient_PATIFALLNR)
+			day0_all_patients.append(day0)
 
-			def get_dates(parameter):
-				return list(data[data.BESCHREIBUNG == parameter].DAY)
+		else:
+			print(horizontal_line)
+			print(red(f'\n ------------>Error processing patient {patient}, so I skip it and continue with the others.\n To see the problem run the program again only on his/her file with the flag -debug.\n'))
+			if args.debug:
+				log.error(orange(f'\nHere is what goes wrong with patient {patient}:\n') + f'\n{error_traceback}')
+			patients_with_error.append(patient)
+			print(horizontal_line)
 
+	if patients_from_cache > 0:
+		print(f'\n {patients_from_cache} of {len(patients_to_process)} patients unchanged, taken from the cache.')
 
-			final_dictionary = {}
-			for p in all_needed_parameters:
-				if p in parameters_needed_and_available_from_lab:
-					final_dictionary[p] = [get_results(p), get_dates(p)]
+	if not args.debug:
+		if len(patients_with_error) > 0:
+			print(horizontal_line)
+			print(red(f'Patients with errors: \n {patients_with_error}'))
+			os.makedirs(lab_results_directory_debug, exist_ok=True)
+			for file in patients_with_error:
+				if patients_in_memory:
+					# patient files may not exist on disk, so export the patients that failed from memory
+					save_excel_patient_sheet(raw_df_per_patient[file], lab_results_directory_debug, file)
+				else:
+					shutil.copy(f'{lab_results_directory}/{file}', lab_results_directory_debug)
 
-				elif p in parameters_needed_but_not_available_from_lab:
-					final_dictionary[p] = [ [empty_result for _ in range(num_max_days)] , 0 ]
+			print(horizontal_line)
 
-				else:
-					raise Exception('Something wrong')
+	return cells_per_patient, patient_identifier_PATIFALLNR, day0_all_patients, patients_with_error
 
+def process_shards(args, lab_results_directory, lab_results_directory_debug, patients_map, patient_numbers, parameter_catalog, patient_day0s, export_patients, profile = None):
+	'''Second phase of the out-of-core mode: merges and processes the shards of lab_results_directory one at a time
 
-			#print(final_dictionary)
-			# Add empty in day when exam is not done
-			for p in parameters_needed_and_available_from_lab:
-				results, dates = final_dictionary[p]
-				#print(dates)
-				if len(results) < num_max_days:
-					for i in range(num_max_days):
-						if period[i] not in dates:
-							#print(f'{period[i]} not in {dates}')
-							results.insert(i,empty_result)
+	With export_patients, the excel file of each patient is written as the shard is merged. Returns the same as
+	process_patients, with the patients in the same order as if they had all been processed at once.
+	'''
+	from shards import load_shards_index, load_shard, shard_of
+	from export import partition_by_patient, export_patient_sheets
+
+	num_shards, patient_IDs_in_current_labresults = load_shards_index(lab_results_directory)
+
+	# 8-digit, patients with results and in the map; each is in one shard only
+	patients = sorted(set(p//10 for p in patient_IDs_in_current_labresults) & set(patients_map.PATIFALLNR))
+	shard_per_patient = dict(zip(patients, shard_of(patients, num_shards).tolist()))
+
+	results = []
+	patients_with_error = []
+	for shard in range(num_shards):
+		with profile_stage(profile, f'merge shard {shard}') as stage:
+			raw_df = load_shard(lab_results_directory, shard)
+			raw_df_by_patient = partition_by_patient(raw_df, raw_df.PATIFALLNR.to_numpy() // 10)
+			# patients whose rows were all dropped (e.g. only not needed parameters) get an empty frame, as in the merging routine
+			raw_df_per_patient = { f'{patID2Num(patient_numbers, patient)}-{patient}.xlsx': raw_df_by_patient.get(patient, raw_df.iloc[0:0]) for patient in patients if shard_per_patient[patient] == shard }
+			stage['rows'] = len(raw_df)
+		if len(raw_df_per_patient) == 0:
+			continue
+
+		print(f'\n Shard {shard+1} of {num_shards}: {len(raw_df_per_patient)} patients, {len(raw_df)} rows')
+		if export_patients:
+			export_patient_sheets(raw_df_per_patient, lab_results_directory, args.jobs)
+
+		cells_per_patient, patient_identifier_PATIFALLNR, day0_all_patients, shard_patients_with_error = process_patients(args, lab_results_directory, raw_df_per_patient, lab_results_directory_debug,
+																															parameter_catalog, patient_day0s, profile)
+		results.extend(zip(cells_per_patient, patient_identifier_PATIFALLNR, day0_all_patients))
+		patients_with_error.extend(shard_patients_with_error)
+		del raw_df, raw_df_by_patient, raw_df_per_patient
+
+	# Same order as process_patients on all the patient files
+	results.sort(key = lambda result: natsort(f'{patID2Num(patient_numbers, result[1]//10)}-{result[1]//10}.xlsx'))
+	patients_with_error.sort(key = natsort)
+
+	return [result[0] for result in results], [result[1] for result in results], [result[2] for result in results], patients_with_error
+
+def process_batch(args, current_date, configurations, lab_results_directory, raw_df_per_patient, lab_results_directory_debug, parameter_catalog, patient_numbers, patient_day0s, profile = None):
+	'''Batch mode: normalizes the merged results once, then processes the patients and writes the final sheet of each
+	configuration (see batch.py), as current_date-name; returns the paths written'''
+	from batch import batch_settings, compact_patients, configuration_data
+	from processing import make_settings
+
+	if raw_df_per_patient is not None:
+		sources = raw_df_per_patient
+	else:
+		sources = { patient: f'{lab_results_directory}/{patient}' for patient in os.listdir(lab_results_directory) if patient.endswith(".xlsx") and not patient.startswith("~") }
 
-			# Collect all results; here final dictionary still contains dates, and [0] gets rid of it
-			# patient_results = [ final_dictionary[p][0] for p in all_needed_parameters ]
-			# big_data.append(patient_results)
+	print(f'\n Normalizing the results of {len(sources)} patients once for {len(configurations)} configurations...')
+	with profile_stage(profile, 'normalize') as stage:
+		compact = compact_patients(sources, parameter_catalog, initial_day_of_study, negative_result, positive_result, excel_reader_engine)
+		stage['rows'] = sum(len(data) for data in compact.values() if not isinstance(data, str))
 
-			# Make dictionaries for multiple sheets
-			final_dictionary_without_dates = { k:v[0] for k,v in final_dictionary.items() }
+	paths = []
+	for configuration in configurations:
+		name = configuration['name']
+		print(f'\n{horizontal_line}')
+		print(f'CONFIGURATION {name}: ' + ', '.join(f'{setting} {configuration[setting]}' for setting in batch_settings))
+		print(horizontal_line)
 
-			# This list contains as many dictionaries as number of sheets, each to be treated as final_dictionary
-			list_of_patient_dictionaries = dict_of_lists_to_list_of_dicts( dictionary_values_splitter( final_dictionary_without_dates ) )
+		settings = make_settings(parameter_catalog, patient_day0s, initial_day_of_study, configuration['num_max_days'], configuration['sub_period_duration'],
+								configuration['reference_parameter'], configuration['keep_kein_material'], empty_result, positive_result, negative_result, args.verbose,
+								profile = profile is not None, cache_directory = None if args.no_cache else directory_patient_cache,
+								excel_reader = excel_reader_engine)
+		with profile_stage(profile, f'{name}: patients loop') as stage:
+			cells_per_patient, patient_identifier_PATIFALLNR, day0_all_patients, patients_with_error = process_patients(args, lab_results_directory, raw_df_per_patient, lab_results_directory_debug, parameter_catalog,
+																														patient_day0s, profile, settings, configuration_data(compact, configuration['keep_kein_material']))
+			stage['rows'] = sum(len(cells[0]) for cells in cells_per_patient)
 
-			for s in range(number_of_sheets):
-				big_data_multiple_sheets[s].append( list(list_of_patient_dictionaries[s].values()) )
+		paths.extend(write_final_sheet(f'{current_date}-{name}', cells_per_patient, patient_identifier_PATIFALLNR, day0_all_patients, patient_numbers, parameter_catalog['parameters'], args.output, profile,
+										configuration['num_max_days'], configuration['sub_period_duration']))
+	return paths
 
-			# each element of big_data_multiple_sheets is to be treated as big_data
+####################################################################################################################################################################################
+# END DATA MANIPULATION ROUTINE FOR EACH PATIENT
+####################################################################################################################################################################################
 
-			# contains 9-digit identifiers
-			patient_identifier_PATIFALLNR.append(current_patient_PATIFALLNR)
+####################################################################################################################################################################################
+# START WRITING TO FINAL SHEET
+####################################################################################################################################################################################
 
+def write_final_sheet(current_date, cells_per_patient, patient_identifier_PATIFALLNR, day0_all_patients, patient_numbers, all_needed_parameters, outputs = ('xlsx',), profile = None,
+					max_days = num_max_days, period_duration = sub_period_duration):
+	'''Writes the final results in each format of outputs (xlsx, parquet, sqlite), named after current_date; returns the paths written
 
-			verprint(horizontal_line_before_space)
-			verprint(f'\n Here is the final data for patient {patient}: \n\n {data} \n')
+	The results are first put into one long table (see long_output.py); the excel sheets are a wide view of it, max_days
+	days from day0 split into sheets of period_duration days.
+	'''
+	from tqdm import tqdm
+	from grid import grid_sheets, sheet_to_dataframe
+	from workbook import write_workbook
+	from processing import data_splitter
+	from long_output import long_results, long_to_grid, save_long_parquet, save_long_sqlite
+	from store import parquet_supported
+
+	paths = []
+
+	with profile_stage(profile, 'long table') as stage:
+		long_df = long_results(cells_per_patient, patient_identifier_PATIFALLNR, day0_all_patients, [ patID2Num(patient_numbers, patient//10) for patient in patient_identifier_PATIFALLNR ], all_needed_parameters)
+		stage['rows'] = len(long_df)
+
+	if 'parquet' in outputs:
+		if parquet_supported():
+			with profile_stage(profile, 'write parquet') as stage:
+				save_long_parquet(long_df, f'{directory_final_sheet}/{current_date}.parquet')
+				stage['rows'] = len(long_df)
+			paths.append(f'{directory_final_sheet}/{current_date}.parquet')
+			print(f'\n Long table of {len(long_df)} results written to {paths[-1]}')
+		else:
+			print(orange('\n pyarrow is not installed, so the long table is not written as parquet.'))
+
+	if 'sqlite' in outputs:
+		with profile_stage(profile, 'write sqlite') as stage:
+			save_long_sqlite(long_df, f'{directory_final_sheet}/{current_date}.sqlite')
+			stage['rows'] = len(long_df)
+		paths.append(f'{directory_final_sheet}/{current_date}.sqlite')
+		print(f'\n Long table of {len(long_df)} results written to {paths[-1]}')
+
+	if 'xlsx' not in outputs:
+		return paths
+
+	all_days = [_ for _ in range(max_days)]
+	split_days = data_splitter(all_days, max_days, period_duration)
+
+	# Multiple sheets
+	number_of_sheets = int(max_days/period_duration) + 1
+
+	#print('\n Creating patient map, first step...')
+	patient_identifier_PATIFALLNR_last_digit_separated = [ f'{str(i)[:-1]}_{str(i)[-1:]}' for i in patient_identifier_PATIFALLNR  ]
+	#print('\n Creating patient map, second step...')
+	day0_all_patients_string = [d.strftime('%d-%m-%Y') for d in day0_all_patients]
+	patient_identifier_final = [ f'{patID2Num(patient_numbers, patient_identifier_PATIFALLNR[i]//10)} - {patient_identifier_PATIFALLNR_last_digit_separated[i]} - {day0_all_patients_string[i]}' for i in range(len(patient_identifier_PATIFALLNR_last_digit_separated)) ]
+
+	# patient x parameter x day; each sheet is a slice of it
+	with profile_stage(profile, 'grid') as stage:
+		grid = long_to_grid(long_df, patient_identifier_PATIFALLNR, len(all_needed_parameters), max_days, empty_result)
+		sheets = grid_sheets(grid, split_days)
+		stage['rows'] = len(long_df)
+
+	def final_sheets():
+		# one sheet per sub-period, built only when the writer gets to it
+		for s in tqdm(range(number_of_sheets)):
+			yield f'Sheet{s+1}', sheet_to_dataframe(sheets[s], patient_identifier_final, all_needed_parameters, split_days[s])
+
+
+	print('\n Starting to write in Excel sheets...')
+	# filename = f'{current_patient_one}-{current_patient_one+num_patients-1}-{current_date}.xlsx'
+	filename = f'{current_date}.xlsx'
 
-		except:
-			print(horizontal_line)
-			print(red(f'\n ------------>Error processing patient {patient}, so I skip it and continue with the others.\n To see the problem run the program again only on his/her file with the flag -debug.\n'))
-			if debug:
-				log.exception(orange(f'\nHere is what goes wrong with patient {patient}:\n'))
-			patients_with_error.append(patient)
-			print(horizontal_line)
+	with profile_stage(profile, 'write final sheet') as stage:
+		write_report = write_workbook(f'{directory_final_sheet}/{filename}', final_sheets())
+		stage['rows'] = grid.shape[0] * grid.shape[1]
 
-if not debug:
-	if len(patients_with_error) > 0:
-		print(horizontal_line)
-		print(red(f'Patients with errors: \n {patients_with_error}'))
-		os.makedirs(lab_results_directory_debug, exist_ok=True)
-		for file in patients_with_error:
-		    shutil.copy(f'{lab_results_directory}/{file}', lab_results_directory_debug)
+	for entry in write_report:
+		print(f" {entry['sheet']}: {entry['bytes']/1024:.1f} kB in {entry['seconds']:.2f} s")
+	print(f" Total: {sum(entry['bytes'] for entry in write_report)/1024:.1f} kB in {sum(entry['seconds'] for entry in write_report):.2f} s")
 
-		print(horizontal_line)
+	paths.append(f'{directory_final_sheet}/{filename}')
+	return paths
 
 ####################################################################################################################################################################################
-# END DATA MANIPULATION ROUTINE FOR EACH PATIENT
+# END WRITING TO FINAL SHEET
 ####################################################################################################################################################################################
-print('\n Patient loop completed!')
+
 ####################################################################################################################################################################################
-# START WRITING TO FINAL SHEET
+# START PREFLIGHT CHECK
 ####################################################################################################################################################################################
-#print('\n Creating patient map, first step...')
-patient_identifier_PATIFALLNR_last_digit_separated = [ f'{str(i)[:-1]}_{str(i)[-1:]}' for i in patient_identifier_PATIFALLNR  ]
-#print('\n Creating patient map, second step...')
-day0_all_patients_string = [d.strftime('%d-%m-%Y') for d in day0_all_patients]
-patient_identifier_final = [ f'{patID2Num( patient_identifier_PATIFALLNR[i]//10 )} - {patient_identifier_PATIFALLNR_last_digit_separated[i]} - {day0_all_patients_string[i]}' for i in range(len(patient_identifier_PATIFALLNR_last_digit_separated)) ]
-
-dims = ['patient', 'parameter', 'day']
-
-def save_excel_sheet(df, dirname, filename, sheetname):
 
-	filepath = f'{dirname}/{filename}'
-	os.makedirs(dirname, exist_ok=True)
+def run_check(args, current_date, patients_map, patients_map_issues, parameter_catalog, patient_day0s, profile = None):
+	'''Checks the raw results of the whole cohort against the patients map (see preflight.py) and saves the report;
+	returns the exit code, 1 if a patient would fail'''
+	import pandas as pd
+	from ingestion import raw_results_files, read_raw_results_chunks, empty_raw_results
+	from preflight import check_cohort, save_check_report, check_summary
+	from processing import make_settings
 
-	if not os.path.exists(filepath):
-		with pd.ExcelWriter(filepath) as writer:
-			df.to_excel(writer, sheet_name=sheetname)
+	patient_IDs_in_patients_map = set(patients_map.PATIFALLNR)
+	raw_result_filepaths = [f'{lab_results_raw_directory}/{raw_result}' for raw_result in raw_results_files(lab_results_raw_directory)]
+
+	print(f'\n Checking {len(raw_result_filepaths)} raw files against the patients map...')
+	with profile_stage(profile, 'check') as stage:
+		seen_patients = set()
+		unknown_counts = {}
+		rows = [ chunk for filepath in raw_result_filepaths
+				for chunk in read_raw_results_chunks(filepath, patient_IDs_in_patients_map, parameter_catalog, seen_patients, unknown_counts) ]
+		rows = pd.concat(rows, ignore_index = True) if len(rows) > 0 else empty_raw_results()
+		stage['rows'] = len(rows)
+
+		# the settings of the patient loop, whose cleaning the check repeats
+		settings = make_settings(parameter_catalog, patient_day0s, initial_day_of_study, num_max_days, sub_period_duration,
+								reference_parameter, keep_kein_material, empty_result, positive_result, negative_result, args.verbose)
+		issues = check_cohort(rows, seen_patients, unknown_counts, patients_map, patients_map_issues, settings)
+		report_path = save_check_report(issues, f'{directory_final_sheet}/{current_date}', args.check)
+
+	print(f'\n{check_summary(issues)}')
+	print(f'\n Report saved to {report_path}')
+
+	if profile is not None:
+		profile_path = save_profile(profile, f'{directory_final_sheet}/{current_date}', args.profile)
+		print(f'\n{profile_summary(profile)}')
+		print(f'\n Profile saved to {profile_path}')
+
+	errors = sum(issue['severity'] == 'error' for issue in issues)
+	print(f'\n{horizontal_line}')
+	if errors > 0:
+		print(red(f'CHECK FAILED: {errors} errors, the patients concerned would fail. Fix them and check again.'))
 	else:
-		with pd.ExcelWriter(filepath, engine='openpyxl', mode='a') as writer:
-			df.to_excel(writer, sheet_name=sheetname)
-
-
-print('\n Starting to write in Excel sheets...')
-for s in tqdm(range(number_of_sheets)):
-	#coords = {'patient':range(current_patient_one, current_patient_one+num_patients), 'parameter':all_needed_parameters, 'day':split_days[s] }
-	coords = {'patient':patient_identifier_final, 'parameter':all_needed_parameters, 'day':split_days[s] }
-	data = xr.DataArray(big_data_multiple_sheets[s], dims = dims, coords = coords )
-	df = data.to_dataframe('value')
-	df = data.to_series().unstack(level=[1,2])
+		print('CHECK PASSED :)')
+	print(horizontal_line)
+	return 1 if errors > 0 else 0
 
-	# filename = f'{current_patient_one}-{current_patient_one+num_patients-1}-{current_date}.xlsx'
-	filename = f'{current_date}.xlsx'
+####################################################################################################################################################################################
+# END PREFLIGHT CHECK
+####################################################################################################################################################################################
 
-	save_excel_sheet(df, directory_final_sheet, filename, f'Sheet{s+1}')
+####################################################################################################################################################################################
+# START RESIDENT SERVICE
+####################################################################################################################################################################################
 
-print(f'\n{horizontal_line}')
-print('ALL GOOD :)')
-print(f'{horizontal_line}')
-if debug:
-	print(orange('The debug went fine! Now implement the corrections you did in the debug lab sheet into the main lab sheet, and run the program without the -debug flag.'))
+def serve_cohort(args, patients_map, patient_numbers, patients_map_issues, parameter_catalog, patient_day0s):
+	'''Service mode: keeps the processed cohort in memory and answers local requests until interrupted (see service.py);
+	returns the exit code'''
+	from service import serve, new_snapshot
+
+	def refresh(merge):
+		# each refresh is a run of its own: a new merge directory and debug directory
+		current_date = datetime.utcfromtimestamp( int(time.time()) ).strftime('%Y-%m-%d-%H_%M_%S')
+		lab_results_directory_debug = f'{directory_merged_results_per_patient_debug}/{current_date}'
+		if merge:
+			lab_results_directory, raw_df_per_patient = merge_raw_results(args, current_date, patients_map, patient_numbers, patients_map_issues, parameter_catalog)
+		else:
+			lab_results_directory, raw_df_per_patient = load_previous_merge()
+		if lab_results_directory is None:
+			raise Exception('There are no merged results yet: run the merging routine first.')
+		if merge_has_only_shards(lab_results_directory):
+			raise Exception(f'The most recent merge {lab_results_directory} has only shards, which the service cannot load: run again without --no-merge.')
+
+		cells_per_patient, patient_identifier_PATIFALLNR, day0_all_patients, patients_with_error = process_patients(args, lab_results_directory, raw_df_per_patient, lab_results_directory_debug, parameter_catalog, patient_day0s)
+		if not args.no_cache:
+			from result_cache import evict_cache
+			evict_cache(directory_patient_cache, patient_cache_max_mb)
+		return new_snapshot(cells_per_patient, patient_identifier_PATIFALLNR, day0_all_patients, patients_with_error, patient_numbers, parameter_catalog['parameters'],
+							num_max_days, sub_period_duration, empty_result, lab_results_directory)
+
+	try:
+		return serve(args.serve, refresh, lab_results_raw_directory, args.watch_interval, args.merge)
+	except (OSError, ValueError) as error:
+		print(red(f'\n{error}'))
+		return 2
 
+####################################################################################################################################################################################
+# END RESIDENT SERVICE
+####################################################################################################################################################################################
 
+def main(argv = None):
+	args = parse_arguments(argv)
+	configure_logging(args.verbose)
+	profile = new_profile() if args.profile is not None else None
 
+	current_date = datetime.utcfromtimestamp( int(time.time()) ).strftime('%Y-%m-%d-%H_%M_%S')
+	lab_results_directory_debug = f'{directory_merged_results_per_patient_debug}/{current_date}'   # one file per patient
 
+	# In debug mode the merging routine is skipped, the failed patients of the previous run are processed from their excel files
+	perform_merging_routine = False
+	if not args.debug and args.check is None:
+		perform_merging_routine = args.merge
+		if perform_merging_routine is None:
+			if not sys.stdin.isatty():
+				print(red('\nNo terminal to ask whether to perform the merging routine: run again with --merge or --no-merge.'))
+				return 2
+			perform_merging_routine = ask_merge()
+
+	with profile_stage(profile, 'patients map') as stage:
+		patients_map, patient_numbers, patient_day0s, patients_map_issues = load_patients()
+		stage['rows'] = len(patients_map)
+	with profile_stage(profile, 'parameter catalog') as stage:
+		parameter_catalog = load_parameter_catalog()
+		stage['rows'] = len(parameter_catalog['parameters'])
+
+	configurations = None
+	if args.batch is not None:
+		from batch import load_batch_configurations
+		try:
+			configurations = load_batch_configurations(args.batch, {'num_max_days': num_max_days, 'sub_period_duration': sub_period_duration, 'reference_parameter': reference_parameter,
+																	'keep_kein_material': keep_kein_material}, parameter_catalog)
+		except (OSError, ValueError) as error:
+			print(red(f'\n{error}'))
+			return 2
+
+	if args.check is not None:
+		return run_check(args, current_date, patients_map, patients_map_issues, parameter_catalog, patient_day0s, profile)
+
+	if args.serve is not None:
+		return serve_cohort(args, patients_map, patient_numbers, patients_map_issues, parameter_catalog, patient_day0s)
+
+	if args.debug:
+		lab_results_directory, raw_df_per_patient = most_recent_directory(directory_merged_results_per_patient_debug), None
+		print(red('\nDEBUG MODE ON\n'))
+	elif args.out_of_core:
+		from shards import has_shards
+		raw_df_per_patient = None
+		if perform_merging_routine:
+			lab_results_directory = spill_raw_results_to_shards(args, current_date, patients_map, patients_map_issues, parameter_catalog, profile)
+		else:
+			# the shards of the most recent merge are processed again
+			lab_results_directory = most_recent_directory(directory_merged_results_per_patient)
+			if lab_results_directory is not None and not has_shards(lab_results_directory):
+				print(red(f'\nThe most recent merge {lab_results_directory} has no shards: run again with --out-of-core --merge.'))
+				return 1
+	elif perform_merging_routine:
+		lab_results_directory, raw_df_per_patient = merge_raw_results(args, current_date, patients_map, patient_numbers, patients_map_issues, parameter_catalog, profile)
+		# batch mode keeps the merged patients in memory to normalize them once
+		if not args.direct and configurations is None:
+			raw_df_per_patient = None
+	else:
+		with profile_stage(profile, 'load previous merge') as stage:
+			lab_results_directory, raw_df_per_patient = load_previous_merge()
+			if raw_df_per_patient is not None:
+				stage['rows'] = sum(len(df) for df in raw_df_per_patient.values())
+		if merge_has_only_shards(lab_results_directory):
+			if configurations is not None:
+				print(red(f'\nThe most recent merge {lab_results_directory} has only shards, which --batch cannot process: run again with --merge.'))
+				return 1
+			# the shards of an out-of-core merge without patient files are processed one at a time, as with --out-of-core
+			print(f'\n The most recent merge {lab_results_directory} has only shards, processing them one at a time.')
+			args.out_of_core = True
+
+	if lab_results_directory is None:
+		print(red('\nThere are no merged results yet: run the merging routine first.'))
+		return 1
+
+	if configurations is not None:
+		final_paths = process_batch(args, current_date, configurations, lab_results_directory, raw_df_per_patient, lab_results_directory_debug, parameter_catalog, patient_numbers, patient_day0s, profile)
+		print(f'\n Final sheets of {len(configurations)} configurations: {", ".join(final_paths)}')
+	else:
+		with profile_stage(profile, 'patients loop') as stage:
+			if args.out_of_core:
+				export_patients = perform_merging_routine and (not args.direct or args.export_patients)
+				cells_per_patient, patient_identifier_PATIFALLNR, day0_all_patients, patients_with_error = process_shards(args, lab_results_directory, lab_results_directory_debug, patients_map, patient_numbers,
+																															parameter_catalog, patient_day0s, export_patients, profile)
+			else:
+				cells_per_patient, patient_identifier_PATIFALLNR, day0_all_patients, patients_with_error = process_patients(args, lab_results_directory, raw_df_per_patient, lab_results_directory_debug, parameter_catalog, patient_day0s, profile)
+			stage['rows'] = sum(len(cells[0]) for cells in cells_per_patient)
+		print('\n Patient loop completed!')
+
+	if not args.no_cache and not args.debug:
+		from result_cache import evict_cache
+		evicted = evict_cache(directory_patient_cache, patient_cache_max_mb)
+		if evicted > 0:
+			print(f'\n {evicted} least recently used patients removed from the cache, to keep it under {patient_cache_max_mb} MB.')
+
+	if configurations is None:
+		write_final_sheet(current_date, cells_per_patient, patient_identifier_PATIFALLNR, day0_all_patients, patient_numbers, parameter_catalog['parameters'], args.output, profile)
+
+	if profile is not None:
+		profile_path = save_profile(profile, f'{directory_final_sheet}/{current_date}', args.profile)
+		print(f'\n{profile_summary(profile)}')
+		print(f'\n Profile saved to {profile_path}')
 
+	print(f'\n{horizontal_line}')
+	print('ALL GOOD :)')
+	print(f'{horizontal_line}')
+	if args.debug:
+		print(orange('The debug went fine! Now implement the corrections you did in the debug lab sheet into the main lab sheet, and run the program without the -debug flag: only the patients whose lab results changed are processed again, the others are taken from the cache.'))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
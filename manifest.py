@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+
+
+# START MERGE MANIFEST
+# Each merge directory gets a manifest.json listing the raw files that went into it (size, mtime, content hash) and the
+# 9-digit PATIFALLNR each file touched. The next merge compares the raw directory against it, parses only new or changed
+# files and rebuilds only the patients they touch; all other patients are carried over from the previous merge.
+
+manifest_filename = 'manifest.json'
+
+def manifest_path(dirname):
+	return f'{dirname}/{manifest_filename}'
+
+def load_manifest(dirname):
+	'''Returns the manifest of a merge directory, or None if it has none'''
+	if dirname is None or not os.path.exists(manifest_path(dirname)):
+		return None
+	with open(manifest_path(dirname)) as file:
+		return json.load(file)
+
+def save_manifest(dirname, manifest):
+	os.makedirs(dirname, exist_ok=True)
+	with open(manifest_path(dirname), 'w') as file:
+		json.dump(manifest, file, indent = 1)
+
+def file_hash(filepath):
+	sha = hashlib.sha256()
+	with open(filepath, 'rb') as file:
+		for block in iter(lambda: file.read(1 << 20), b''):
+			sha.update(block)
+	return sha.hexdigest()
+
+def file_entry(filepath, previous_entry = None):
+	'''Size, mtime and hash of a raw file; the hash of previous_entry is re-used if size and mtime did not change'''
+	stat = os.stat(filepath)
+	entry = {'path': filepath, 'size': stat.st_size, 'mtime': stat.st_mtime}
+	if previous_entry is not None and previous_entry['size'] == entry['size'] and previous_entry['mtime'] == entry['mtime']:
+		entry['sha256'] = previous_entry['sha256']
+	else:
+		entry['sha256'] = file_hash(filepath)
+	return entry
+
+def merge_filters_fingerprint(patients_map, parameters_signature):
+	'''Hash of everything deciding which rows a merge keeps and how patient files are named'''
+	sha = hashlib.sha256()
+	sha.update(json.dumps(sorted(zip(patients_map.PATIFALLNR.astype(str), patients_map.LFDNR.astype(str)))).encode())
+	sha.update(json.dumps(sorted(parameters_signature)).encode())
+	return sha.hexdigest()
+
+def compare_with_manifest(previous_manifest, directory, filenames, filters_fingerprint):
+	'''Splits the raw files into unchanged ones and ones to parse
+
+	Returns (entries of all current files, names of unchanged files, names of new or changed files, names of removed files).
+	If there is no usable previous manifest, every file is new.
+	'''
+	previous_files = {}
+	if previous_manifest is not None and previous_manifest.get('filters') == filters_fingerprint:
+		previous_files = previous_manifest['files']
+
+	entries = {}
+	unchanged, to_parse = [], []
+	for filename in filenames:
+		previous_entry = previous_files.get(filename)
+		entries[filename] = file_entry(f'{directory}/{filename}', previous_entry)
+		if previous_entry is not None and previous_entry['sha256'] == entries[filename]['sha256']:
+			entries[filename]['patients'] = previous_entry['patients']
+			unchanged.append(filename)
+		else:
+			to_parse.append(filename)
+
+	removed = [filename for filename in previous_files if filename not in entries]
+	return entries, unchanged, to_parse, removed
+
+# END MERGE MANIFEST
@@ -1,3 +1,4 @@
+import os
 import re
 
 def find_nearest(items, pivot):
@@ -14,6 +15,13 @@ def generate_parameters(filename):
 # https://stackoverflow.com/questions/4836710/is-there-a-built-in-function-for-string-natural-sort
 natsort = lambda s: [int(t) if t.isdigit() else t.lower() for t in re.split('(\d+)', s)]
 
+def most_recent_directory(dirname):
+    # Sub-directories are named by timestamp, so the last one in natural order is the most recent; None if there is none
+    directories = [directory for directory in sorted(os.listdir(dirname), key=natsort) if not directory.startswith('.') and os.path.isdir(f'{dirname}/{directory}')]
+    if len(directories) == 0:
+        return None
+    return f'{dirname}/{directories[-1]}'
+
 def replace_list_elements_by_dict(mylist, mydict):
     # Acts in place
     for i in range(len(mylist)):
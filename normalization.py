@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+
+
+# START NON STANDARD RESULTS
+# + and positive to positive_result
+# - and negative to negative_result
+# comma decimals to numbers
+# anything else remains text
+
+kein_material_strings = ['Kein Material', 'K.Mat.']
+
+def parse_result(raw, negative_result, positive_result):
+	'''Returns (number, text) for a single raw ERGEBNIST, exactly one of them being None'''
+	if not isinstance(raw, str):
+		try:
+			return float(raw), None
+		except (TypeError, ValueError):
+			return None, raw
+
+	result = raw.replace('negativ', negative_result)
+	result = result.replace('-', negative_result)
+	result = result.replace('positiv', positive_result)
+	result = result.replace('+', positive_result)
+	result = result.replace(',', '.')
+	try:
+		return float(result), None
+	except ValueError:
+		# Text results keep the comma replaced by a dot, as they always did
+		return None, result
+
+def normalize_results(data, negative_result, positive_result, keep_kein_material):
+	'''Replaces ERGEBNIST with a float64 VALUE column and a categorical TEXT column for non numerical results
+
+	Each distinct raw string is parsed only once, and each distinct text is stored only once. If keep_kein_material is 'n', Kein Material rows are dropped in the same pass.
+	Returns a new dataframe with a fresh index.
+	'''
+	codes, uniques = pd.factorize(data.ERGEBNIST, use_na_sentinel=False)
+
+	parsed = [parse_result(raw, negative_result, positive_result) for raw in uniques]
+	unique_values = np.array([np.nan if number is None else number for number, _ in parsed], dtype='float64')
+	text_codes, texts = pd.factorize(np.array([text for _, text in parsed], dtype=object))
+
+	keep = np.ones(len(data), dtype=bool)
+	if keep_kein_material == 'n':
+		unique_kill = np.array([raw in kein_material_strings for raw in uniques], dtype=bool)
+		keep = ~unique_kill[codes]
+		for s in kein_material_strings:
+			killed_parameters = data.BESCHREIBUNG[(data.ERGEBNIST == s).to_numpy()]
+			if len(killed_parameters) > 0:
+				print(f"---------------Dropping {s} for {', '.join(sorted(set(killed_parameters)))}")
+
+	data = data[keep].drop(columns='ERGEBNIST').reset_index(drop=True)
+	data['VALUE'] = unique_values[codes[keep]]
+	data['TEXT'] = pd.Categorical.from_codes(text_codes[codes[keep]], categories=texts)
+	return data
+
+def drop_kein_material(data):
+	'''Drops the Kein Material rows of results already normalized with keep_kein_material 'y', as normalize_results with 'n' would
+
+	Kein Material strings have no sign or comma, so their TEXT is the raw string. Returns a new dataframe with a fresh index.
+	'''
+	kill = data.TEXT.isin(kein_material_strings).to_numpy()
+	for s in kein_material_strings:
+		killed_parameters = data.BESCHREIBUNG[(data.TEXT == s).to_numpy()]
+		if len(killed_parameters) > 0:
+			print(f"---------------Dropping {s} for {', '.join(sorted(set(killed_parameters)))}")
+	return data[~kill].reset_index(drop=True)
+
+def sheet_results(values, texts):
+	'''Results as written to the final sheet, from float values (NaN for non numerical results) and their texts
+
+	Numbers stay numbers, so that excel can compute with them; excel shows them like 3,4 in a German locale (see workbook.py).
+	'''
+	values = np.asarray(values, dtype='float64')
+	return np.where(np.isnan(values), np.asarray(texts, dtype=object), values.astype(object))
+
+# END NON STANDARD RESULTS
@@ -0,0 +1,87 @@
+import os
+
+import pandas as pd
+
+from myutils import generate_parameters
+
+
+# START PARAMETER CATALOG
+# Parameter names come broken in two ways: parameters.txt is written on a Mac, so that e.g. ß reads ﬂ (Mac-Roman bytes read
+# as cp1252), and the raw exports contain the UTF-8 bytes of those names read as cp1252 (e.g. ï¬‚). Both decodings are undone
+# automatically; the hand-maintained correction files of parameters_directory, if present, take precedence.
+# The catalog is compiled once and maps every name met to its correct name, so that a whole column is renamed with a single
+# map and filtered with a single set membership mask.
+
+german_letters = set('äöüÄÖÜß')
+
+def german_letters_count(name):
+	return sum(character in german_letters for character in name)
+
+def repair_name(name):
+	'''Undoes UTF-8 read as cp1252, then Mac-Roman read as cp1252, e.g. Gesamteiweiï¬‚ -> Gesamteiweiﬂ -> Gesamteiweiß'''
+	try:
+		name = name.encode('cp1252').decode('utf-8')
+	except UnicodeError:
+		pass
+
+	try:
+		candidate = name.encode('mac_roman').decode('cp1252')
+	except UnicodeError:
+		return name
+	# Mac-Roman and cp1252 agree on ascii and some symbols (e.g. µ); only accept the candidate if it looks more german
+	if german_letters_count(candidate) > german_letters_count(name):
+		return candidate
+	return name
+
+def read_corrections(parameters_directory):
+	'''Explicit corrections from the three line-aligned files, as {broken name: correct name}; empty if the files are missing'''
+	corrected_path = f'{parameters_directory}/parameters_strange_characters_from_lab_corrected.txt'
+	if not os.path.exists(corrected_path):
+		return {}
+	corrected = generate_parameters(corrected_path)
+
+	corrections = {}
+	for filename in ['parameters_strange_characters_from_lab.txt', 'parameters_strange_characters_from_lab_python.txt']:
+		if os.path.exists(f'{parameters_directory}/{filename}'):
+			broken = generate_parameters(f'{parameters_directory}/{filename}')
+			if len(broken) != len(corrected):
+				raise Exception(f'\n{filename} and parameters_strange_characters_from_lab_corrected.txt must have the same number of lines\n')
+			corrections.update(zip(broken, corrected))
+	return corrections
+
+def compile_parameter_catalog(parameters_directory):
+	'''Returns the catalog: needed parameters (correct names, in the order of parameters.txt), as list and set, the explicit
+	corrections and the cache of all names met so far'''
+	corrections = read_corrections(parameters_directory)
+	catalog = {'corrections': corrections, 'names': dict(corrections)}
+
+	listed_parameters = generate_parameters(f'{parameters_directory}/parameters.txt')
+	catalog['listed_parameters'] = listed_parameters
+	catalog['parameters'] = [ correct_name(name, catalog) for name in listed_parameters ]
+	catalog['needed'] = set(catalog['parameters'])
+	return catalog
+
+def correct_name(name, catalog):
+	if name not in catalog['names']:
+		catalog['names'][name] = repair_name(name)
+	return catalog['names'][name]
+
+def correct_names(names, catalog):
+	'''Whole-column map of names to correct names; each distinct name is looked up once'''
+	return names.map({ name: correct_name(name, catalog) for name in pd.unique(names) })
+
+def needed_mask(names, catalog):
+	'''True where the correct name is a needed parameter; names may be raw or already correct'''
+	return correct_names(names, catalog).isin(catalog['needed'])
+
+def unknown_names(names, catalog):
+	'''Counts of the names that are not needed parameters, as {name as met: rows}'''
+	counts = names.value_counts()
+	known = correct_names(pd.Series(counts.index, dtype = object), catalog).isin(catalog['needed']).to_numpy()
+	return counts[~known].to_dict()
+
+def catalog_signature(catalog):
+	'''Everything of the catalog deciding which raw rows are kept, as a sorted list of strings'''
+	return sorted(catalog['parameters']) + sorted(f'{broken} -> {correct}' for broken, correct in catalog['corrections'].items())
+
+# END PARAMETER CATALOG
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import pickle
+
+from manifest import file_hash
+from result_cache import modules_signature
+from timestamps import parse_timestamps
+from excel_reader import timed_read_excel_columns, resolve_engine
+from diagnostics import get_logger
+
+
+# START PATIENTS MAP
+# The patients map is parsed once and cached next to it; the cache is used as long as size and mtime of the excel file
+# (or, if those changed, its content hash) are the same, and as long as it was parsed by the same code and reader. Lookups go through dictionaries keyed by the 8-digit PATIFALLNR;
+# 9-digit PATIFALLNR from the lab results are turned into it with // 10 by the caller, as they may start with a zero.
+
+patients_map_columns = ['PATIFALLNR', 'LFDNR', 'DAY0']
+
+# Modules whose code decides the parsed map; editing any of them invalidates the cache
+parser_modules = ['patients', 'timestamps', 'excel_reader']
+
+log = get_logger('patients')
+
+def patients_map_cache_path(patients_map_path):
+	dirname, filename = os.path.split(patients_map_path)
+	return os.path.join(dirname, f'.{filename}.cache.pkl')
+
+def parser_signature(excel_reader = 'auto'):
+	'''Hash of the code parsing the map, of its columns and of the reader engine'''
+	sha = hashlib.sha256(modules_signature(parser_modules).encode())
+	sha.update(repr((patients_map_columns, resolve_engine(excel_reader))).encode())
+	return sha.hexdigest()
+
+def read_patients_map(patients_map_path, excel_reader = 'auto'):
+	# empty cells as '', as with keep_default_na = False
+	patients_map, read_seconds = timed_read_excel_columns(patients_map_path, patients_map_columns, excel_reader, empty = '')
+	log.debug('%s read in %.3f s', patients_map_path, read_seconds)
+	# excel dates come as datetimes already; texts are parsed with the known formats, see timestamps.py
+	patients_map['DAY0'] = parse_timestamps(patients_map['DAY0'])
+	return patients_map
+
+def load_patients_map(patients_map_path, excel_reader = 'auto'):
+	'''Returns the parsed patients map, from the cache if the excel file did not change'''
+	cache_path = patients_map_cache_path(patients_map_path)
+	stat = os.stat(patients_map_path)
+	key = {'size': stat.st_size, 'mtime': stat.st_mtime, 'parser': parser_signature(excel_reader)}
+
+	cached = None
+	if os.path.exists(cache_path):
+		try:
+			with open(cache_path, 'rb') as file:
+				cached = pickle.load(file)
+		except Exception:
+			cached = None
+
+	if cached is not None:
+		if cached['key'] == key:
+			return cached['patients_map']
+		key['sha256'] = file_hash(patients_map_path)
+		if cached['key'].get('sha256') == key['sha256'] and cached['key'].get('parser') == key['parser']:
+			return cached['patients_map']
+
+	patients_map = read_patients_map(patients_map_path, excel_reader)
+	key.setdefault('sha256', file_hash(patients_map_path))
+	try:
+		with open(cache_path, 'wb') as file:
+			pickle.dump({'key': key, 'patients_map': patients_map}, file)
+	except OSError:
+		pass
+	return patients_map
+
+def index_patients_map(patients_map):
+	'''Returns dictionaries 8-digit PATIFALLNR -> LFDNR and 8-digit PATIFALLNR -> DAY0, first row winning as before'''
+	first_rows = patients_map.drop_duplicates('PATIFALLNR', keep = 'first')
+	patient_numbers = dict(zip(first_rows.PATIFALLNR.tolist(), first_rows.LFDNR.tolist()))
+	patient_day0s = dict(zip(first_rows.PATIFALLNR.tolist(), first_rows.DAY0))
+	return patient_numbers, patient_day0s
+
+def validate_patients_map(patients_map):
+	'''Checks the whole map at once; returns lists of 8-digit PATIFALLNR per problem'''
+	number_missing = patients_map.LFDNR.astype(str).str.strip() == ''
+	duplicated = patients_map.PATIFALLNR.duplicated(keep = False)
+	day0_missing = patients_map.DAY0.isna()
+	return {
+		'number_missing': sorted(set(patients_map.PATIFALLNR[number_missing & ~patients_map.PATIFALLNR.duplicated()].tolist())),
+		'duplicated': sorted(set(patients_map.PATIFALLNR[duplicated].tolist())),
+		'day0_missing': sorted(set(patients_map.PATIFALLNR[day0_missing].tolist())),
+	}
+
+# END PATIENTS MAP
@@ -0,0 +1,155 @@
+import csv
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from timestamps import parse_timestamps
+from schema import compact_results
+from deduplication import resolve_duplicate_exams
+
+
+# START PREFLIGHT CHECK
+# Runs, for the whole cohort at once, the checks that otherwise stop single patients deep inside the patient loop:
+# the raw rows are joined with the patients map, go through the same cleaning as in the patient loop (Kein Material,
+# duplicate exams) for all patients at once, and each check is one vectorized comparison per patient, without building
+# grids or writing excel files. Every problem found becomes one issue (severity, issue, patient, detail), so
+# that the lab data and the map can be fixed in a single round. Errors are what would make a patient fail; warnings
+# are results that would be ignored.
+
+check_columns = ['severity', 'issue', 'PATIFALLNR', 'LFDNR', 'detail']
+
+def native(value):
+	return value.item() if isinstance(value, np.generic) else value
+
+def new_issue(severity, issue, patient, patient_numbers, detail):
+	patient = int(patient)
+	return {'severity': severity, 'issue': issue, 'PATIFALLNR': patient, 'LFDNR': native(patient_numbers.get(patient)), 'detail': detail}
+
+def floor_days(dates, origin):
+	'''Whole days from the day of origin to the day of each date, as float (NaN for NaT), not limited like schema.day_offsets'''
+	days = (dates.astype('datetime64[D]') - np.datetime64(pd.Timestamp(origin).date(), 'D')).astype('float64')
+	days[np.isnat(dates)] = np.nan
+	return days
+
+def check_cohort(rows, seen_patients, unknown_counts, patients_map, patients_map_issues, settings):
+	'''Returns the issues of the cohort, a list of dictionaries with the keys of check_columns
+
+	rows are the raw rows the merge keeps (patients in the map, needed parameters), with 9-digit PATIFALLNR;
+	seen_patients are the 9-digit PATIFALLNR of all raw rows, unknown_counts the rows of each name that is not a needed
+	parameter. settings are those of the patient loop, see processing.make_settings. Patients are identified by their
+	8-digit PATIFALLNR.
+	'''
+	initial_day_of_study = settings['initial_day_of_study']
+	num_max_days = settings['num_max_days']
+
+	first_rows = patients_map.drop_duplicates('PATIFALLNR', keep = 'first').set_index('PATIFALLNR')
+	patient_numbers = first_rows.LFDNR.to_dict()
+	in_map = set(first_rows.index)
+	with_results = set(p//10 for p in seen_patients)
+	# patients the patient loop would process
+	to_process = sorted(with_results & in_map)
+	issues = []
+
+	# Patients map
+	for patient in sorted(with_results - in_map):
+		issues.append(new_issue('warning', 'not_in_map', patient, patient_numbers, 'has lab results but is not in the patients map, its results are ignored'))
+	for patient in patients_map_issues['duplicated']:
+		issues.append(new_issue('warning', 'duplicated_in_map', patient, patient_numbers, 'appears more than once in the patients map, only its first row is used'))
+	for patient in patients_map_issues['number_missing']:
+		issues.append(new_issue('error', 'lfdnr_missing', patient, patient_numbers, 'has no LFDNR in the patients map, the merge stops'))
+	for patient in patients_map_issues['day0_missing']:
+		if patient in with_results:
+			issues.append(new_issue('error', 'day0_missing', patient, patient_numbers, 'has lab results but no DAY0 in the patients map'))
+
+	# Parameter names
+	for name, count in sorted(unknown_counts.items()):
+		issues.append({'severity': 'warning', 'issue': 'unknown_parameter', 'PATIFALLNR': None, 'LFDNR': None, 'detail': f'{name}: {count} rows, not a needed parameter (also after repairing its name)'})
+
+	# Dates of the results
+	patients = rows.PATIFALLNR.to_numpy(dtype = 'int64') // 10
+	dates = parse_timestamps(rows.LABEINDAT, errors = 'coerce')
+	# DAY of the patient loop is an int16
+	out_of_range = np.abs(floor_days(dates, initial_day_of_study)) > np.iinfo('int16').max
+	unparseable = (np.isnat(dates) & rows.LABEINDAT.notna().to_numpy()) | out_of_range
+	if unparseable.any():
+		bad = pd.DataFrame({'PATIFALLNR': patients[unparseable], 'LABEINDAT': rows.LABEINDAT.to_numpy()[unparseable]})
+		for patient, group in bad.groupby('PATIFALLNR'):
+			issues.append(new_issue('error', 'unparseable_date', patient, patient_numbers, f'{len(group)} LABEINDAT cannot be read as dates of the study, e.g. {group.LABEINDAT.iloc[0]!r}'))
+
+	day0s = first_rows.DAY0.reindex(to_process)
+	day0 = pd.Series(pd.to_datetime(day0s).to_numpy(dtype = 'datetime64[ns]'), index = to_process)
+	day0_offset = pd.Series(floor_days(day0.to_numpy(), initial_day_of_study), index = to_process)
+
+	# the rows as process_patient sees them: compact layout, Kein Material dropped unless kept, duplicate exams resolved
+	valid = ~np.isnat(dates) & ~unparseable
+	compact = compact_results(rows[valid].reset_index(drop = True), settings['parameter_catalog'], initial_day_of_study,
+							settings['negative_result'], settings['positive_result'], settings['keep_kein_material'])
+	if len(compact) > 0:
+		compact = compact.loc[resolve_duplicate_exams(compact, settings['reference_parameter'], compact.VALUE.notna(), compact.PATIENT)]
+	results = pd.DataFrame({'PATIFALLNR': compact.PATIENT.to_numpy(), 'LABEINDAT': compact.LABEINDAT.to_numpy(), 'DAY': compact.DAY.to_numpy(dtype = 'float64')})
+	with_needed_results = set(results.PATIFALLNR.unique().tolist())
+
+	# the rows process_patient keeps: from day0 on, and from initial_day_of_study on
+	results = results[(results.DAY >= results.PATIFALLNR.map(day0_offset).to_numpy()) & (results.DAY >= 0)]
+	per_patient = results.groupby('PATIFALLNR').agg(first_day = ('DAY', 'min'), first_exam = ('LABEINDAT', 'min'), last_exam = ('LABEINDAT', 'max'))
+	per_patient = per_patient.reindex(to_process)
+	per_patient['DAY0'] = day0
+	# midnight of the day of the first exam, as processing.py counts it
+	per_patient['day_of_first_exam'] = per_patient.first_exam.dt.floor('D')
+	per_patient['exam_period'] = per_patient.last_exam - per_patient.first_exam
+	has_day0 = per_patient.DAY0.notna()
+
+	no_needed = [ patient for patient in to_process if patient not in with_needed_results ]
+	for patient in no_needed:
+		issues.append(new_issue('error', 'no_needed_results', patient, patient_numbers, 'has lab results, but none of needed parameters with a readable date (and kept, see keep_kein_material)'))
+
+	checks = [
+		('no_results_from_day0', has_day0 & per_patient.first_day.isna() & ~per_patient.index.isin(no_needed),
+			lambda row: f'no results from DAY0 {row.DAY0:%d.%m.%Y} on: every exam is done before DAY0 or before the initial day of study'),
+		('day0_after_first_exam', has_day0 & (per_patient.DAY0 > per_patient.day_of_first_exam),
+			lambda row: f'DAY0 is {row.DAY0} but the first exam is done on {row.day_of_first_exam}'),
+		('day0_before_study', has_day0 & (per_patient.DAY0 < pd.Timestamp(initial_day_of_study)),
+			lambda row: f'DAY0 is {row.DAY0} but the initial day of study is {initial_day_of_study}'),
+		('exam_period_too_long', per_patient.exam_period > pd.Timedelta(num_max_days, unit = 'd'),
+			lambda row: f'exams from {row.first_exam} to {row.last_exam}, longer than {num_max_days} days'),
+	]
+	for issue, failing, detail in checks:
+		for patient, row in per_patient[failing.to_numpy()].iterrows():
+			issues.append(new_issue('error', issue, patient, patient_numbers, detail(row)))
+
+	severity_order = {'error': 0, 'warning': 1}
+	return sorted(issues, key = lambda issue: (severity_order[issue['severity']], issue['issue'], -1 if issue['PATIFALLNR'] is None else issue['PATIFALLNR']))
+
+def check_counts(issues):
+	'''Number of issues of each kind, as {(severity, issue): count}'''
+	counts = {}
+	for issue in issues:
+		key = (issue['severity'], issue['issue'])
+		counts[key] = counts.get(key, 0) + 1
+	return counts
+
+def save_check_report(issues, filepath_without_extension, file_format = 'json'):
+	'''Writes the issues as filepath_without_extension.check.json (with a summary) or .check.csv; returns the path'''
+	filepath = f'{filepath_without_extension}.check.{file_format}'
+	os.makedirs(os.path.dirname(filepath) or '.', exist_ok = True)
+	if file_format == 'json':
+		summary = [ {'severity': severity, 'issue': issue, 'count': count} for (severity, issue), count in check_counts(issues).items() ]
+		with open(filepath, 'w') as file:
+			json.dump({'summary': summary, 'issues': issues}, file, indent = 1, default = str)
+	else:
+		with open(filepath, 'w', newline = '') as file:
+			writer = csv.DictWriter(file, fieldnames = check_columns)
+			writer.writeheader()
+			writer.writerows(issues)
+	return filepath
+
+def check_summary(issues):
+	'''Text table of the number of issues of each kind'''
+	lines = [f"{'severity':<10} {'issue':<24} {'count':>7}"]
+	for (severity, issue), count in check_counts(issues).items():
+		lines.append(f'{severity:<10} {issue:<24} {count:>7}')
+	return '\n'.join(lines)
+
+# END PREFLIGHT CHECK
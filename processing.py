@@ -0,0 +1,268 @@
+import logging
+import shutil
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from myutils import red, orange
+from deduplication import resolve_duplicate_exams
+from grid import patient_cells
+from parameter_catalog import unknown_names
+from schema import is_compact, compact_results, day_offsets
+from diagnostics import get_logger, configure_logging, start_patient_measure, patient_measure
+from result_cache import settings_signature, patient_cache_key, load_cached_result, save_cached_result
+from ingestion import needed_columns
+from excel_reader import timed_read_excel_columns
+
+
+# START PER PATIENT PROCESSING
+# Everything needed to turn the lab results of one patient into its rows of the final sheet.
+# Settings are passed explicitly (no globals), so that patients can be processed in worker processes.
+
+horizontal_line = '=' * shutil.get_terminal_size().columns
+horizontal_line_before_space = f'\n{horizontal_line}'
+horizontal_line_after_space = f'{horizontal_line}\n'
+
+log = get_logger('processing')
+
+def period_maker(num_max_days, sub_period_duration):
+	'''Returns [7, 7, 7, 2] if num_max_days = 23 and sub_period_duration = 7'''
+	if num_max_days < sub_period_duration:
+		raise Exception('First input must be >= second')
+	if num_max_days % sub_period_duration == 0:
+		raise Exception(f'\n\nFor technical reasons num_max_days {num_max_days} cannot be a multiple of sub_period_duration {sub_period_duration}. To resolve set for example num_max_days to {num_max_days+1}.\n ')
+	num_full_sub_periods = int(num_max_days/sub_period_duration)
+	days_in_final_subperiod = num_max_days % sub_period_duration
+	period_list = [sub_period_duration for _ in range(num_full_sub_periods)]
+	if days_in_final_subperiod != 0: period_list = period_list +[days_in_final_subperiod]
+	return period_list
+
+def data_splitter(data, num_max_days, sub_period_duration):
+	'''Given data of lenght num_max_days splits it according to period_maker
+
+	e.g. num_max_days = 11
+	sub_period_duration = 3
+	period_list = period_maker(num_max_days, sub_period_duration) returns [3, 3, 3, 2]
+	data = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+
+	data_splitter(data, num_max_days, sub_period_duration) returns [[1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 11]]
+
+	'''
+	period_list = period_maker(num_max_days, sub_period_duration)
+	helper = [sum(period_list[:i]) for i in range(len(period_list)+1)]
+	return [  data[helper[i]:helper[i+1]] for i in range(len(helper)-1) ]
+
+def compact_patient(data, patient, settings):
+	'''Compact layout of the rows of one patient (see schema.py); rows already compact are returned as they are'''
+	if is_compact(data):
+		return data
+	parameter_catalog = settings['parameter_catalog']
+
+	# Raw rows (from the merged files) are turned into the compact layout of schema.py: parameter names repaired and
+	# not needed parameters dropped (see parameter_catalog.py), dates parsed, DAY counted from initial_day_of_study,
+	# ERGEBNIST split into VALUE (float, NaN if not a number) and TEXT (non numerical results, see normalization.py)
+	log.debug('%s\nHere is the data before renaming weird parameters: \n \n %s', horizontal_line_before_space, data)
+
+	if log.isEnabledFor(logging.DEBUG):
+		for param in unknown_names(data.BESCHREIBUNG, parameter_catalog):
+			log.debug(red(f'{param} is in lab results, but is not one of the needed parameters, so I am dropping it \n'))
+
+	data = compact_results(data, parameter_catalog, settings['initial_day_of_study'], settings['negative_result'], settings['positive_result'], settings['keep_kein_material'])
+
+	log.debug('Here is the data after renaming weird parameters: \n \n %s', data)
+	log.debug('Things are ok if the names in all needed and in data AFTER CORRECTION match.')
+	log.debug(horizontal_line_after_space)
+	return data
+
+def process_patient(data, patient, settings):
+	'''Cleans, deduplicates and grids the lab results of a single patient
+
+	data contains the rows of one patient as in the merged files, patient is the name used in messages (e.g. 100-12345678.xlsx).
+	settings is the dictionary made by make_settings.
+	Returns the cells of the patient in the final grid, the 9-digit PATIFALLNR and day0.
+	'''
+	day0_per_patient = settings['day0_per_patient']
+	initial_day_of_study = settings['initial_day_of_study']
+	num_max_days = settings['num_max_days']
+	reference_parameter = settings['reference_parameter']
+
+	log.debug('\n%s\n%s\n%s', horizontal_line, horizontal_line, orange(f'--> Processing patient {patient}...\n'))
+
+	data = compact_patient(data, patient, settings)
+
+	# START GETTING RID OF DUPLICATE EXAM 
+	# POSSIBILITIES:
+	
+	# 1. Restructure all so that parameters are column, not index, and use
+	# https://stackoverflow.com/questions/50885093/how-do-i-remove-rows-with-duplicate-values-of-columns-in-pandas-data-frame
+
+	# 2. Keep parameters as index, work on sub-frames for each parameter, drop duplicate date column
+	# Then reconstruct big dataframe by composition
+
+	## IMPROVED DUPLICATED ALGORITH: KEEP WITH THIS PRIORITY
+	# - the one done closest in time to penkid
+	# - the first of the day
+	# All parameters and days are resolved at once, see deduplication.py
+	index_to_keep = resolve_duplicate_exams(data, reference_parameter, data.VALUE.notna())
+	data = data.loc[index_to_keep]
+
+	data.reset_index(inplace = True, drop = True)
+
+	# VALUE and TEXT are kept apart in the cells, numbers are written as numbers to the final sheet, see grid.py
+
+
+	# END GETTING RID OF DUPLICATE EXAM # ----------
+
+	# END MANIPULATING DATAFRAME
+
+
+	# CAREFUL ACTUALLY DAY0 IS FROM EXTERNAL SOURCE, IT MAY BE THAT NO EXAM IS TAKEN ON DAY 0 <------------------------------------------------------------------------------------------------------------------- temporary
+	# Get patient day0 = when she enters hospital
+
+	# 9-digit identifier
+	current_patient_PATIFALLNR = data['PATIFALLNR'][0]
+
+	
+
+
+	# SWITCH THIS ON ONCE REAL DATA FOR DAY 0 IS AVAILABLE; NOW SIMULATE
+	#print('TAKING CORRECT DATE')
+	day0 = day0_per_patient[data['PATIENT'][0]]
+	day0_offset = int(day_offsets(np.array([day0], dtype = 'datetime64[ns]'), initial_day_of_study)[0])
+	#print(day0)
+
+
+	# simulate day0 as day before day of first exam; to switch off once real data for time0 is available
+	#day0 = day_of_first_exam - timedelta(days = 1)
+
+	# GETTING RID OF EXAMS DONE BEFORE DAY 0 and before november second 2021 and sort data by date
+	#print(day0)
+	# (DAY counts days from initial_day_of_study)
+	data = data[ (data.DAY >= day0_offset) & (data.DAY >= 0) ]
+	data = data.sort_values('DAY')
+	# END GETTING RID OF EXAMS DOBE BEFORE DAY 0
+
+	
+	if len(data) == 0:
+		raise Exception(f"It could be that every exam is done after day0; check patient map for patient {patient} ")
+	day_of_first_exam = pd.Timestamp(initial_day_of_study) + pd.Timedelta(days = int(data.DAY.min()))
+
+
+	if day0 > day_of_first_exam:
+		raise Exception(f'\nFor patient {patient} day 0 is {day0} but first exam is done on {day_of_first_exam}\n')
+
+	if day0 < initial_day_of_study:
+		raise Exception(f'\nFor patient {patient} day 0 is {day0} but initial day of study is {initial_day_of_study}\n')
+	  
+
+	# Get range of time in which exams are taken; not really used anywhere
+	day_first_exam, day_last_exam = min(data.LABEINDAT), max(data.LABEINDAT)
+	exam_period = day_last_exam - day_first_exam
+	# print(exam_period)
+
+	# Check time period
+	if exam_period > pd.Timedelta(num_max_days, unit = 'd'):
+		print(red(f'\n\n-----------SOMETHING WRONG---------\n\n Exam period lasts {exam_period}, longer than {num_max_days} days\n----------\n'))
+		raise Exception
+
+	# Results within the maximal period of staying in the hospital (num_max_days from day0, equal for everybody),
+	# as coordinates in the final grid; parameters not available from the lab stay empty there, see grid.py
+	cells = patient_cells(data, day0_offset, num_max_days)
+
+	log.debug('%s\n\n Here is the final data for patient %s: \n\n %s \n', horizontal_line_before_space, patient, data)
+
+	return cells, current_patient_PATIFALLNR, day0
+
+def make_settings(parameter_catalog, day0_per_patient, initial_day_of_study, num_max_days, sub_period_duration,
+				reference_parameter, keep_kein_material, empty_result, positive_result, negative_result, verbose, profile = False,
+				cache_directory = None, excel_reader = 'auto'):
+	'''Collects everything process_patient needs in a picklable dictionary
+
+	With cache_directory, run_patient re-uses the results cached there for unchanged input and settings (see result_cache.py).
+	excel_reader is the engine reading patient files, see excel_reader.py.
+	'''
+	settings = {
+		'parameter_catalog': parameter_catalog,
+		'day0_per_patient': day0_per_patient,
+		'initial_day_of_study': initial_day_of_study,
+		'num_max_days': num_max_days,
+		'sub_period_duration': sub_period_duration,
+		'reference_parameter': reference_parameter,
+		'keep_kein_material': keep_kein_material,
+		'empty_result': empty_result,
+		'positive_result': positive_result,
+		'negative_result': negative_result,
+		'verbose': verbose,
+		'profile': profile,
+		'cache_directory': cache_directory,
+		'excel_reader': excel_reader,
+	}
+	if cache_directory is not None:
+		settings['cache_signature'] = settings_signature(settings)
+	return settings
+
+def run_patient(patient, source, settings):
+	'''Reads (if source is a path) and processes one patient, never raises
+
+	Returns (patient, result of process_patient or None, traceback text or None, whether the result came from the cache,
+	measures or None), measures being taken only if settings['profile'] (see diagnostics.py).
+	'''
+	start = start_patient_measure() if settings['profile'] else None
+	rows_in = None
+	read_seconds = None
+	result = None
+	try:
+		if isinstance(source, str):
+			# only the columns the processing needs
+			data, read_seconds = timed_read_excel_columns(source, needed_columns, settings['excel_reader'])
+			log.debug('%s: read in %.3f s', patient, read_seconds)
+		else:
+			data = source.reset_index(drop = True)
+		rows_in = len(data)
+
+		key = None
+		if settings['cache_directory'] is not None:
+			# keyed on the compact rows, whose columns have the same types whether read from a patient file or from the merge
+			data = compact_patient(data, patient, settings)
+			key = patient_cache_key(data, settings)
+			result = load_cached_result(settings['cache_directory'], key)
+		cached = result is not None
+
+		if not cached:
+			result = process_patient(data, patient, settings)
+			if key is not None:
+				save_cached_result(settings['cache_directory'], key, result)
+		else:
+			log.debug('%s: unchanged, taken from the cache', patient)
+	except Exception:
+		return patient, None, traceback.format_exc(), False, patient_measure(start, patient, rows_in, None, read_seconds = read_seconds) if start else None
+	return patient, result, None, cached, patient_measure(start, patient, rows_in, len(result[0][0]), cached, read_seconds) if start else None
+
+# Settings of the worker processes, sent once per worker rather than once per patient
+worker_settings = None
+
+def init_worker(settings):
+	global worker_settings
+	worker_settings = settings
+	configure_logging(settings['verbose'])
+
+def run_patient_in_worker(patient, source):
+	return run_patient(patient, source, worker_settings)
+
+def run_patients(patients, sources, settings, jobs = 1):
+	'''Yields run_patient(patient, source, settings) for each patient, in the order of patients
+
+	With jobs > 1 the patients are processed by that many worker processes.
+	'''
+	if jobs <= 1:
+		for patient, source in zip(patients, sources):
+			yield run_patient(patient, source, settings)
+		return
+
+	chunksize = max(1, len(patients) // (jobs * 4))
+	with ProcessPoolExecutor(max_workers = jobs, initializer = init_worker, initargs = (settings,)) as executor:
+		yield from executor.map(run_patient_in_worker, patients, sources, chunksize = chunksize)
+
+# END PER PATIENT PROCESSING
@@ -21,6 +21,14 @@ directory_merged_results_per_patient_debug = 'b_lab_results_per_patient_debug'
 directory_final_sheet = 'c_final_sheet'
 patients_map_path = 'patients_map.xlsx'
 
+# Processed patients, re-used while their lab results and the parameters above do not change; trimmed to this size
+directory_patient_cache = 'd_patient_cache'
+patient_cache_max_mb = 1024
+
+# Engine reading patient files and the patients map: 'auto' (calamine if python-calamine is installed, else openpyxl
+# in read-only mode), 'calamine', 'openpyxl' or 'pandas', see excel_reader.py
+excel_reader_engine = 'auto'
+
 
 ####################################################################################################################################################################################
 # END PARAMETERS TO EDIT
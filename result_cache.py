@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import pickle
+
+import pandas as pd
+
+from parameter_catalog import catalog_signature
+
+
+# START PATIENT RESULT CACHE
+# The result of process_patient (cells of the patient in the final grid, PATIFALLNR, day0) is cached on disk, keyed by a
+# hash of the rows of the patient in the compact layout of schema.py (so that a patient read from its excel file and from
+# the store of the merge has the same key), its DAY0, the settings deciding the result and the source of the processing
+# modules. Reruns, e.g. after fixing the lab results of one patient, then process again only the patients whose input or
+# settings changed, and the full final sheet is put together from the cache. The cache is trimmed to a maximal size,
+# least recently used entries first.
+
+# Modules whose code decides the result of a patient; editing any of them invalidates the cache
+pipeline_modules = ['processing', 'schema', 'normalization', 'deduplication', 'grid', 'parameter_catalog', 'timestamps']
+
+def modules_signature(modules):
+	'''Hash of the source of the modules of this package named in modules'''
+	sha = hashlib.sha256()
+	directory = os.path.dirname(os.path.abspath(__file__))
+	for module in modules:
+		with open(f'{directory}/{module}.py', 'rb') as file:
+			sha.update(file.read())
+	return sha.hexdigest()
+
+def settings_signature(settings):
+	'''Hash of the settings of make_settings that decide the result of a patient, DAY0 aside (see patient_cache_key)'''
+	sha = hashlib.sha256()
+	sha.update(json.dumps({
+		'initial_day_of_study': str(settings['initial_day_of_study']),
+		'num_max_days': settings['num_max_days'],
+		'sub_period_duration': settings['sub_period_duration'],
+		'reference_parameter': settings['reference_parameter'],
+		'keep_kein_material': settings['keep_kein_material'],
+		'empty_result': settings['empty_result'],
+		'positive_result': settings['positive_result'],
+		'negative_result': settings['negative_result'],
+		# order of the parameters decides their rows in the final sheet
+		'parameters': list(settings['parameter_catalog']['parameters']),
+		'catalog': catalog_signature(settings['parameter_catalog']),
+	}).encode())
+	sha.update(modules_signature(pipeline_modules).encode())
+	return sha.hexdigest()
+
+def patient_cache_key(data, settings):
+	'''Cache key of the compact rows data of one patient under settings (which must have a cache_signature)'''
+	sha = hashlib.sha256(settings['cache_signature'].encode())
+	sha.update(json.dumps([ [str(col), str(data[col].dtype)] for col in data.columns ]).encode())
+	sha.update(pd.util.hash_pandas_object(data, index = False).to_numpy().tobytes())
+
+	# DAY0 comes from the patients map, not from the rows
+	patients = sorted(set(int(p)//10 for p in data['PATIFALLNR'].unique()))
+	sha.update(json.dumps([ str(settings['day0_per_patient'].get(p)) for p in patients ]).encode())
+	return sha.hexdigest()
+
+def cache_entry_path(cache_directory, key):
+	return f'{cache_directory}/{key[:2]}/{key}.pkl'
+
+def load_cached_result(cache_directory, key):
+	'''Cached result of key, or None; a hit counts as a use for eviction'''
+	filepath = cache_entry_path(cache_directory, key)
+	try:
+		with open(filepath, 'rb') as file:
+			result = pickle.load(file)
+		os.utime(filepath)
+	except Exception:
+		return None
+	return result
+
+def save_cached_result(cache_directory, key, result):
+	filepath = cache_entry_path(cache_directory, key)
+	os.makedirs(os.path.dirname(filepath), exist_ok = True)
+	# written aside and renamed, so that worker processes never read half an entry
+	temporary_filepath = f'{filepath}.{os.getpid()}.tmp'
+	with open(temporary_filepath, 'wb') as file:
+		pickle.dump(result, file, protocol = pickle.HIGHEST_PROTOCOL)
+	os.replace(temporary_filepath, filepath)
+
+def evict_cache(cache_directory, max_mb):
+	'''Removes the least recently used entries until the cache takes at most max_mb; returns the number of entries removed'''
+	if not os.path.isdir(cache_directory):
+		return 0
+	entries = []
+	for dirpath, _, filenames in os.walk(cache_directory):
+		for filename in filenames:
+			stat = os.stat(f'{dirpath}/{filename}')
+			entries.append((stat.st_mtime, stat.st_size, f'{dirpath}/{filename}'))
+
+	total = sum(size for _, size, _ in entries)
+	removed = 0
+	for _, size, filepath in sorted(entries):
+		if total <= max_mb * 1e6:
+			break
+		os.remove(filepath)
+		total -= size
+		removed += 1
+	return removed
+
+# END PATIENT RESULT CACHE
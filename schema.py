@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+from parameter_catalog import correct_names
+from normalization import normalize_results
+from timestamps import parse_timestamps
+
+
+# START COMPACT SCHEMA
+# All processing stages work on one compact layout of the lab results:
+# - PATIFALLNR int64 (9 digits) and PATIENT int64, the 8-digit identifier of the patients map, derived once
+# - BESCHREIBUNG categorical, the categories being the needed parameters in the order of parameters.txt, so that its codes
+#   are the rows of the final grid and comparing parameters compares integers
+# - LABEINDAT datetime64 (parsed with the known formats, see timestamps.py) and DAY int16, the number of days from
+#   initial_day_of_study (negative before it), by flooring to the day rather than formatting and parsing again
+# - VALUE float64 for numerical results and TEXT, categorical, for the others (see normalization.py)
+
+compact_columns = ['PATIFALLNR', 'PATIENT', 'BESCHREIBUNG', 'LABEINDAT', 'DAY', 'VALUE', 'TEXT']
+
+def parameter_dtype(catalog):
+	return pd.CategoricalDtype(catalog['parameters'])
+
+def is_compact(data):
+	return isinstance(data.BESCHREIBUNG.dtype, pd.CategoricalDtype) and 'DAY' in data.columns
+
+def day_offsets(dates, origin):
+	'''Whole days from the day of origin to the day of each date (time of the day ignored), as int16'''
+	days = (dates.astype('datetime64[D]') - np.datetime64(pd.Timestamp(origin).date(), 'D')).astype('int64')
+	limits = np.iinfo('int16')
+	if len(days) > 0 and (days.min() < limits.min or days.max() > limits.max):
+		raise Exception(f'\nSome dates are more than {limits.max} days away from {origin}\n')
+	return days.astype('int16')
+
+def compact_results(data, catalog, origin, negative_result, positive_result, keep_kein_material):
+	'''Turns raw rows (PATIFALLNR, BESCHREIBUNG, ERGEBNIST, LABEINDAT as in the raw results or merged files) into the compact
+	layout; rows of parameters that are not needed are dropped. Returns a new dataframe with a fresh index.'''
+	parameters = pd.Categorical(correct_names(data.BESCHREIBUNG, catalog), dtype = parameter_dtype(catalog))
+	keep = parameters.codes >= 0
+
+	labeindat = parse_timestamps(data.LABEINDAT[keep])
+	patifallnr = data.PATIFALLNR.to_numpy(dtype = 'int64')[keep]
+	compact = pd.DataFrame({
+		'PATIFALLNR': patifallnr,
+		'PATIENT': patifallnr // 10,
+		'BESCHREIBUNG': parameters[keep],
+		'LABEINDAT': labeindat,
+		'DAY': day_offsets(labeindat, origin),
+		'ERGEBNIST': data.ERGEBNIST.to_numpy()[keep],
+	})
+
+	# ERGEBNIST is split into VALUE and TEXT
+	return normalize_results(compact, negative_result, positive_result, keep_kein_material)
+
+# END COMPACT SCHEMA
@@ -0,0 +1,264 @@
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from diagnostics import get_logger
+
+
+# START RESIDENT SERVICE
+# magic.py --serve keeps the patients map, the parameter catalog and the processed cohort in memory and answers local
+# HTTP requests (on host:port, or on a Unix socket with unix:PATH) from a snapshot of the final grid, so that a request
+# only slices arrays. A watcher thread polls the raw results directory and, when exports are added, changed or removed,
+# merges and processes again (incrementally, with the cache of processed patients) and swaps in the new snapshot;
+# requests keep being answered from the previous one meanwhile. Changes of the patients map need a restart.
+#
+# GET  /status              what is loaded, when, and from which merge
+# GET  /patients            the patients of the cohort
+# GET  /patients/ID         grid of one patient (parameters x days from day0); ID is LFDNR, 8- or 9-digit PATIFALLNR
+# GET  /sheets/N            sub-period sheet N of the final sheet, for the cohort
+# GET  /errors              patients whose processing failed
+# POST /refresh             merge and process again now
+
+log = get_logger('service')
+
+default_address = '127.0.0.1:8765'
+default_watch_interval = 10
+
+def parse_address(address):
+	'''('unix', path) for unix:PATH, otherwise ('tcp', (host, port)) for HOST:PORT or PORT'''
+	if address.startswith('unix:'):
+		return 'unix', address[len('unix:'):]
+	host, _, port = address.rpartition(':')
+	if not port.isdigit():
+		raise ValueError(f'Cannot listen on {address}: use HOST:PORT, PORT or unix:PATH')
+	return 'tcp', (host or '127.0.0.1', int(port))
+
+def raw_files_signature(directory):
+	'''Name, size and modification time of each raw export of directory, to notice new, changed and removed exports'''
+	from ingestion import raw_results_files
+	if not os.path.isdir(directory):
+		return ()
+	signature = []
+	for name in raw_results_files(directory):
+		try:
+			stat = os.stat(f'{directory}/{name}')
+		except FileNotFoundError:
+			# removed while listing
+			continue
+		signature.append((name, stat.st_size, stat.st_mtime_ns))
+	return tuple(sorted(signature))
+
+def new_snapshot(cells_per_patient, patient_identifier_PATIFALLNR, day0_all_patients, patients_with_error, patient_numbers, parameters,
+				num_max_days, sub_period_duration, empty_result, lab_results_directory):
+	'''Everything the requests need, computed once per refresh: the grid of the cohort, the labels of its patients and
+	the lookups from the identifiers a request may use to the row of the patient'''
+	from grid import build_grid
+	from processing import data_splitter
+
+	patients = []
+	lookup = {}
+	for i, (patifallnr, day0) in enumerate(zip(patient_identifier_PATIFALLNR, day0_all_patients)):
+		patifallnr = int(patifallnr)
+		lfdnr = patient_numbers[patifallnr // 10]
+		lfdnr = lfdnr.item() if hasattr(lfdnr, 'item') else lfdnr
+		# label of the patient in the final sheet
+		patients.append({'patient': f'{lfdnr} - {str(patifallnr)[:-1]}_{str(patifallnr)[-1:]} - {day0:%d-%m-%Y}', 'LFDNR': lfdnr, 'PATIFALLNR': patifallnr, 'DAY0': f'{day0:%Y-%m-%d}'})
+		for key in (lfdnr, patifallnr, patifallnr // 10):
+			lookup[str(key)] = i
+
+	# filename of the patient file, e.g. 103-12345003.xlsx
+	errors = []
+	for filename in patients_with_error:
+		lfdnr, _, patient = filename[:-len('.xlsx')].partition('-')
+		errors.append({'file': filename, 'LFDNR': lfdnr, 'PATIFALLNR_8_digit': patient})
+
+	return {
+		'grid': build_grid(cells_per_patient, len(parameters), num_max_days, empty_result),
+		'split_days': data_splitter(list(range(num_max_days)), num_max_days, sub_period_duration),
+		'parameters': list(parameters),
+		'patients': patients,
+		'lookup': lookup,
+		'errors': errors,
+		'error_lookup': { key: error for error in errors for key in (error['LFDNR'], error['PATIFALLNR_8_digit']) },
+		'lab_results_directory': lab_results_directory,
+		'loaded_at': datetime.now().isoformat(timespec = 'seconds'),
+	}
+
+def patient_grid(snapshot, patient):
+	'''Grid of one patient as in the final sheet, None if the patient is not in the cohort'''
+	i = snapshot['lookup'].get(patient)
+	if i is None:
+		return None
+	return dict(snapshot['patients'][i], parameters = snapshot['parameters'], days = list(range(snapshot['grid'].shape[2])), results = snapshot['grid'][i].tolist())
+
+def cohort_sheet(snapshot, sheet):
+	'''Sub-period sheet number sheet (from 1, as Sheet1 of the final sheet) for the whole cohort, None if there is no such sheet'''
+	if sheet < 1 or sheet > len(snapshot['split_days']):
+		return None
+	days = snapshot['split_days'][sheet - 1]
+	return {
+		'sheet': sheet,
+		'parameters': snapshot['parameters'],
+		'days': days,
+		'patients': [ patient['patient'] for patient in snapshot['patients'] ],
+		# patients x parameters x days
+		'results': snapshot['grid'][:, :, days[0]:days[-1]+1].tolist(),
+	}
+
+def service_status(service):
+	snapshot = service['snapshot']
+	return {
+		'loaded_at': snapshot['loaded_at'],
+		'lab_results_directory': snapshot['lab_results_directory'],
+		'patients': len(snapshot['patients']),
+		'patients_with_errors': len(snapshot['errors']),
+		'sheets': len(snapshot['split_days']),
+		'refreshing': service['lock'].locked(),
+		'last_refresh_error': service['last_refresh_error'],
+	}
+
+def refresh_service(service, merge = True):
+	'''Builds a new snapshot with service['refresh'] and swaps it in; refreshes never overlap. Returns whether it worked'''
+	with service['lock']:
+		# the signature is taken first, so that exports written during the refresh trigger the next one
+		signature = raw_files_signature(service['watch_directory'])
+		start = time.perf_counter()
+		try:
+			snapshot = service['refresh'](merge)
+		except Exception as error:
+			log.exception('Refreshing failed, still answering from the snapshot of %s', service['snapshot']['loaded_at'] if service['snapshot'] else 'nothing')
+			service['last_refresh_error'] = str(error)
+			service['raw_signature'] = signature
+			return False
+		service['snapshot'] = snapshot
+		service['raw_signature'] = signature
+		service['last_refresh_error'] = None
+		log.info('\n Snapshot of %s patients ready in %.1f s, serving it.', len(snapshot['patients']), time.perf_counter() - start)
+		return True
+
+def watch_raw_results(service, interval):
+	'''Refreshes whenever the raw exports change; runs until the process ends'''
+	while True:
+		time.sleep(interval)
+		if raw_files_signature(service['watch_directory']) != service['raw_signature']:
+			log.info('\n Raw results in %s changed, merging and processing again...', service['watch_directory'])
+			refresh_service(service)
+
+def make_handler(service):
+	'''Request handler answering from the current snapshot of service'''
+
+	class ServiceRequestHandler(BaseHTTPRequestHandler):
+
+		def send_json(self, status, body):
+			content = json.dumps(body, default = str).encode()
+			self.send_response(status)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(content)))
+			self.end_headers()
+			self.wfile.write(content)
+
+		def do_GET(self):
+			snapshot = service['snapshot']
+			parts = [ part for part in urlparse(self.path).path.split('/') if part != '' ]
+
+			if parts == ['status']:
+				return self.send_json(200, service_status(service))
+			if parts == ['patients']:
+				return self.send_json(200, snapshot['patients'])
+			if parts == ['errors']:
+				return self.send_json(200, snapshot['errors'])
+			if len(parts) == 2 and parts[0] == 'patients':
+				grid = patient_grid(snapshot, parts[1])
+				if grid is not None:
+					return self.send_json(200, grid)
+				if parts[1] in snapshot['error_lookup']:
+					return self.send_json(404, {'error': f'processing patient {parts[1]} failed', 'patient': snapshot['error_lookup'][parts[1]]})
+				return self.send_json(404, {'error': f'patient {parts[1]} is not in the cohort'})
+			if len(parts) == 2 and parts[0] == 'sheets':
+				if not parts[1].isdigit():
+					return self.send_json(400, {'error': f'sheet must be a number, not {parts[1]}'})
+				sheet = cohort_sheet(snapshot, int(parts[1]))
+				if sheet is None:
+					return self.send_json(404, {'error': f'there are sheets 1 to {len(snapshot["split_days"])}'})
+				return self.send_json(200, sheet)
+			return self.send_json(404, {'error': f'unknown path {self.path}'})
+
+		def do_POST(self):
+			if urlparse(self.path).path.strip('/') != 'refresh':
+				return self.send_json(404, {'error': f'unknown path {self.path}'})
+			refreshed = refresh_service(service)
+			return self.send_json(200 if refreshed else 500, service_status(service))
+
+		def log_message(self, format, *args):
+			# client_address is empty on unix sockets, so it is not logged
+			log.debug('%s %s', self.requestline, format % args)
+
+	return ServiceRequestHandler
+
+class UnixHTTPServer(ThreadingHTTPServer):
+	address_family = socket.AF_UNIX
+
+	def server_bind(self):
+		# HTTPServer.server_bind expects a (host, port) address
+		socketserver.TCPServer.server_bind(self)
+		self.server_name, self.server_port = 'localhost', 0
+
+def remove_stale_socket(path):
+	'''Removes the unix socket left at path by a previous service; anything else at path is left alone and raises'''
+	try:
+		mode = os.stat(path).st_mode
+	except FileNotFoundError:
+		return
+	if not stat.S_ISSOCK(mode):
+		raise ValueError(f'Cannot listen on unix:{path}: {path} exists and is not a socket, it is left as it is')
+	os.remove(path)
+
+def stop_serving(signum, frame):
+	raise KeyboardInterrupt
+
+def serve(address, refresh, watch_directory, watch_interval = default_watch_interval, merge = True):
+	'''Serves the snapshots made by refresh(merge) on address (see parse_address) until interrupted; returns the exit code'''
+	kind, bind_address = parse_address(address)
+	# checked before the cohort is loaded, so that a wrong path fails at once
+	if kind == 'unix':
+		remove_stale_socket(bind_address)
+
+	service = {'refresh': refresh, 'snapshot': None, 'lock': threading.Lock(), 'watch_directory': watch_directory, 'raw_signature': None, 'last_refresh_error': None}
+	if not refresh_service(service, merge):
+		return 1
+
+	if kind == 'unix':
+		remove_stale_socket(bind_address)
+		server = UnixHTTPServer(bind_address, make_handler(service))
+		listening = f'unix:{bind_address}'
+	else:
+		server = ThreadingHTTPServer(bind_address, make_handler(service))
+		listening = f'http://{server.server_address[0]}:{server.server_address[1]}'
+	server.daemon_threads = True
+
+	if watch_interval > 0:
+		threading.Thread(target = watch_raw_results, args = (service, watch_interval), daemon = True).start()
+
+	watching = f'watching {watch_directory} every {watch_interval:g} s' if watch_interval > 0 else f'not watching {watch_directory}'
+	log.info('\n Serving on %s (%s), Ctrl+C to stop.', listening, watching)
+	# stopped by a service manager as by Ctrl+C
+	signal.signal(signal.SIGTERM, stop_serving)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		if kind == 'unix' and os.path.exists(bind_address) and stat.S_ISSOCK(os.stat(bind_address).st_mode):
+			os.remove(bind_address)
+	return 0
+
+# END RESIDENT SERVICE
@@ -0,0 +1,98 @@
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from ingestion import read_raw_results_chunks, concat_raw_results, empty_raw_results
+from store import parquet_supported
+
+
+# START OUT-OF-CORE SHARDS
+# For raw exports larger than memory. First phase: the raw csv files are streamed chunk by chunk and the kept rows are
+# spilled to on-disk shards, all rows of a patient landing in the same shard (hash of the 8-digit PATIFALLNR). Second
+# phase: the shards are read back and processed one at a time, so that memory holds one shard instead of all raw results.
+# The number of shards and the rows per chunk follow from a memory budget. Shards are directories of part files, parquet
+# with pyarrow and pickles otherwise, numbered in reading order so that a shard reads back in the order of a full merge.
+
+shards_dirname = 'shards'
+shards_index_filename = 'shards.json'
+
+# Rough size in memory of raw results: bytes per byte of csv once parsed, merged and processed, and bytes per parsed row
+memory_per_raw_byte = 8
+memory_per_raw_row = 1000
+
+def shards_path(dirname):
+	return f'{dirname}/{shards_dirname}'
+
+def has_shards(dirname):
+	return dirname is not None and os.path.exists(f'{shards_path(dirname)}/{shards_index_filename}')
+
+def shards_for_budget(raw_bytes, memory_budget_mb):
+	'''Number of shards so that one shard of raw_bytes of raw exports fits in memory_budget_mb'''
+	return max(1, math.ceil(raw_bytes * memory_per_raw_byte / (memory_budget_mb * 1e6)))
+
+def chunksize_for_budget(memory_budget_mb):
+	'''Rows per chunk of raw export, a chunk taking at most half of memory_budget_mb'''
+	return max(1000, int(memory_budget_mb * 1e6 / 2 / memory_per_raw_row))
+
+def shard_of(patients_8_digit, num_shards):
+	'''Shard of each 8-digit PATIFALLNR; multiplicative hashing spreads consecutive identifiers over the shards'''
+	patients = np.asarray(patients_8_digit, dtype = np.uint64)
+	return ((patients * np.uint64(11400714819323198485) >> np.uint64(32)) % np.uint64(num_shards)).astype(np.int64)
+
+def shard_directory(dirname, shard):
+	return f'{shards_path(dirname)}/shard-{shard:04d}'
+
+def write_part(df, directory, part):
+	os.makedirs(directory, exist_ok = True)
+	if parquet_supported():
+		df.to_parquet(f'{directory}/part-{part:06d}.parquet', index = False)
+	else:
+		df.to_pickle(f'{directory}/part-{part:06d}.pkl')
+
+def read_part(filepath):
+	if filepath.endswith('.parquet'):
+		return pd.read_parquet(filepath)
+	return pd.read_pickle(filepath)
+
+def spill_raw_results(filepaths, dirname, patients_8_digit, catalog, num_shards, chunksize):
+	'''Streams the raw exports filepaths into num_shards shards in dirname/shards, keeping the rows read_raw_results_file keeps
+
+	Returns the set of all 9-digit PATIFALLNR seen, the counts of not needed names as {name: rows} and the rows spilled.
+	'''
+	seen_patients = set()
+	unknown_counts = {}
+	part = 0
+	rows = 0
+	for filepath in filepaths:
+		for chunk in read_raw_results_chunks(filepath, patients_8_digit, catalog, seen_patients, unknown_counts, chunksize):
+			if len(chunk) == 0:
+				continue
+			chunk = chunk.assign(BESCHREIBUNG = chunk.BESCHREIBUNG.astype('category'))
+			shards = shard_of(chunk.PATIFALLNR.to_numpy() // 10, num_shards)
+			for shard in np.unique(shards):
+				write_part(chunk[shards == shard], shard_directory(dirname, int(shard)), part)
+			part += 1
+			rows += len(chunk)
+
+	os.makedirs(shards_path(dirname), exist_ok = True)
+	with open(f'{shards_path(dirname)}/{shards_index_filename}', 'w') as file:
+		json.dump({'shards': num_shards, 'patients': sorted(seen_patients)}, file)
+	return seen_patients, unknown_counts, rows
+
+def load_shards_index(dirname):
+	'''Returns the number of shards of dirname and the set of all 9-digit PATIFALLNR seen in the raw exports spilled to them'''
+	with open(f'{shards_path(dirname)}/{shards_index_filename}') as file:
+		index = json.load(file)
+	return index['shards'], set(index['patients'])
+
+def load_shard(dirname, shard):
+	'''Raw rows of one shard of dirname, in the order of a full merge'''
+	directory = shard_directory(dirname, shard)
+	if not os.path.isdir(directory):
+		return empty_raw_results()
+	return concat_raw_results(read_part(f'{directory}/{part}') for part in sorted(os.listdir(directory)))
+
+# END OUT-OF-CORE SHARDS
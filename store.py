@@ -0,0 +1,99 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from myutils import natsort
+
+
+# START MERGED RESULTS STORE
+# Next to (or instead of) one excel file per patient, the merging routine writes all merged rows into a single file,
+# sorted by patient. Re-using the last merge then costs one read instead of one read_excel per patient.
+# The file is parquet with pyarrow and a pickle otherwise, as the part files of shards.py.
+
+merged_store_filename = 'merged.parquet'
+merged_store_pickle_filename = 'merged.pkl'
+# Every merged patient file, also those without rows, which have no row in the store to be named by
+merged_store_files_filename = 'merged_files.json'
+
+# Column holding the name of the excel file the rows would have been written to, e.g. 100-12345678.xlsx
+store_file_column = 'FILE'
+
+def parquet_supported():
+	try:
+		import pyarrow
+	except ImportError:
+		return False
+	return True
+
+def merged_store_path(dirname):
+	return f'{dirname}/{merged_store_filename}'
+
+def merged_store_pickle_path(dirname):
+	return f'{dirname}/{merged_store_pickle_filename}'
+
+def merged_store_files_path(dirname):
+	return f'{dirname}/{merged_store_files_filename}'
+
+def save_merged_store(raw_df_per_patient, dirname):
+	'''Writes a dictionary filename -> raw rows of the patient into dirname/merged.parquet, or merged.pkl without pyarrow'''
+	os.makedirs(dirname, exist_ok=True)
+
+	filenames = sorted(raw_df_per_patient, key=natsort)
+	if len(filenames) == 0:
+		return
+
+	merged = pd.concat([raw_df_per_patient[f] for f in filenames], ignore_index=True)
+	merged[store_file_column] = pd.Categorical(np.repeat(filenames, [len(raw_df_per_patient[f]) for f in filenames]), categories=filenames)
+
+	# Parameter names repeat on every row
+	merged['BESCHREIBUNG'] = merged.BESCHREIBUNG.astype('category')
+
+	if parquet_supported():
+		# Parquet needs one type per column; results that pandas read as numbers in some files and as text in others are stored as text
+		for col in merged.columns:
+			if merged[col].dtype == object:
+				merged[col] = merged[col].astype(str)
+		merged.to_parquet(merged_store_path(dirname), index=False)
+		stale_path = merged_store_pickle_path(dirname)
+	else:
+		merged.to_pickle(merged_store_pickle_path(dirname))
+		stale_path = merged_store_path(dirname)
+	# a store of the other kind left in dirname by an earlier run would be read instead of this one
+	if os.path.exists(stale_path):
+		os.remove(stale_path)
+	with open(merged_store_files_path(dirname), 'w') as file:
+		json.dump(filenames, file, indent=1)
+
+def has_merged_store(dirname):
+	return (os.path.exists(merged_store_path(dirname)) and parquet_supported()) or os.path.exists(merged_store_pickle_path(dirname))
+
+def load_merged_store(dirname):
+	'''Reads dirname/merged.parquet (or merged.pkl) back into a dictionary filename -> raw rows of the patient
+
+	Rows are stored sorted by patient, so each patient is a slice of the same frame. Patients without rows get an empty
+	frame, as their (empty) excel file would give.
+	'''
+	if os.path.exists(merged_store_path(dirname)) and parquet_supported():
+		merged = pd.read_parquet(merged_store_path(dirname))
+	else:
+		merged = pd.read_pickle(merged_store_pickle_path(dirname))
+	files = merged.pop(store_file_column)
+
+	raw_df_per_patient = {}
+	codes = files.cat.codes.to_numpy()
+	if len(codes) > 0:
+		boundaries = np.flatnonzero(np.diff(codes)) + 1
+		starts = np.concatenate([[0], boundaries])
+		stops = np.concatenate([boundaries, [len(codes)]])
+		raw_df_per_patient = { files.cat.categories[codes[start]]: merged.iloc[start:stop] for start, stop in zip(starts, stops) }
+
+	# stores written before the list of files only know the patients with rows
+	if os.path.exists(merged_store_files_path(dirname)):
+		with open(merged_store_files_path(dirname)) as file:
+			filenames = json.load(file)
+		raw_df_per_patient = { filename: raw_df_per_patient.get(filename, merged.iloc[0:0]) for filename in filenames }
+	return raw_df_per_patient
+
+# END MERGED RESULTS STORE
@@ -0,0 +1,132 @@
+import argparse
+import os
+import random
+import shutil
+from datetime import timedelta
+
+from myutils import generate_parameters
+from program_parameters import reference_parameter
+from magic import initial_day_of_study
+
+
+# START SYNTHETIC COHORT
+# Writes a study directory that looks like the real one, without any real patient data: raw lab exports in
+# a_lab_results_raw (cp1252, ;-separated, 9-digit PATIFALLNR, names as the lab writes them, including the strange-character
+# ones as UTF-8 bytes), the matching patients_map.xlsx, parameters_directory and the empty output directories.
+# Results mix comma decimals, +/-, positiv/negativ, text and Kein Material rows; the reference parameter is measured
+# once or twice on most days, other parameters are often measured more than once a day.
+
+raw_columns = ['AUFTRAGNR', 'PATIFALLNR', 'GEBDAT', 'SEX', 'EINSCODE', 'LABEINDAT', 'BESCHREIBUNG', 'ERGEBNIST']
+study_directories = ['a_lab_results_raw', 'b_lab_results_per_patient', 'b_lab_results_per_patient_debug', 'c_final_sheet']
+
+# Lab parameters that are not in parameters.txt, ignored by the pipeline
+other_parameters = ['Blutgruppe', 'Antikörpersuchtest', 'Hepatitis B s-Antigen', 'Vitamin B12']
+
+default_parameters_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parameters_directory')
+
+qualitative_results = ['+', '-', 'positiv', 'negativ']
+text_results = ['n.a.', 'folgt', '<0,5', '>1000', 'hämolytisch']
+no_material_results = ['Kein Material', 'K.Mat.']
+
+def lab_bytes(name):
+	'''Bytes of a parameter name as the lab writes it: names broken by a Mac (e.g. Gesamteiweiﬂ) as UTF-8, the others as cp1252'''
+	from parameter_catalog import repair_name
+	if repair_name(name) != name:
+		return name.encode('utf-8')
+	return name.encode('cp1252')
+
+def random_result(rng, scale):
+	draw = rng.random()
+	if draw < 0.8:
+		return f'{rng.uniform(0.1, 2) * scale:.{rng.choice([0, 1, 2])}f}'.replace('.', ',')
+	if draw < 0.9:
+		return rng.choice(qualitative_results)
+	if draw < 0.96:
+		return rng.choice(text_results)
+	return rng.choice(no_material_results)
+
+def patient_rows(rng, patient_9_digit, day0, parameters, reference_parameter, days, samples_per_day, scales):
+	'''Yields (PATIFALLNR, LABEINDAT, BESCHREIBUNG, ERGEBNIST) of one patient, from the day before day0 on'''
+	stay = rng.randint(max(1, days // 2), days)
+	for day_offset in range(-1, stay):
+		day = day0 + timedelta(days = day_offset)
+
+		# reference parameter: once or twice on most days, so that other duplicates are resolved around it
+		if rng.random() < 0.8:
+			for _ in range(rng.choice([1, 1, 2])):
+				time = day + timedelta(hours = rng.randint(5, 20), minutes = rng.randint(0, 59))
+				yield patient_9_digit, time, reference_parameter, random_result(rng, scales[reference_parameter])
+
+		for parameter in rng.sample(parameters, max(1, len(parameters) // 3)):
+			if parameter == reference_parameter:
+				continue
+			for _ in range(rng.randint(1, samples_per_day)):
+				time = day + timedelta(hours = rng.randint(0, 23), minutes = rng.randint(0, 59))
+				yield patient_9_digit, time, parameter, random_result(rng, scales[parameter])
+
+def write_cohort(root, patients = 100, days = 20, samples_per_day = 2, files = 2, seed = 0, unmapped_patients = 1,
+				parameters_directory = default_parameters_directory, first_patient = 20000000):
+	'''Writes a synthetic study directory in root; returns the number of raw rows written
+
+	patients: patients in the map, each with results on up to days days and up to samples_per_day samples of a parameter
+	per day, spread over files raw exports. unmapped_patients more patients have results but are not in the map.
+	first_patient: 8-digit PATIFALLNR of the first patient; below 10000000 the identifiers start with a zero.
+	'''
+	import pandas as pd
+
+	rng = random.Random(seed)
+	for directory in study_directories:
+		os.makedirs(f'{root}/{directory}', exist_ok = True)
+	if os.path.abspath(parameters_directory) != os.path.abspath(f'{root}/parameters_directory'):
+		shutil.copytree(parameters_directory, f'{root}/parameters_directory', dirs_exist_ok = True)
+
+	parameters = generate_parameters(f'{parameters_directory}/parameters.txt') + other_parameters
+	if reference_parameter not in parameters:
+		parameters.append(reference_parameter)
+	scales = { parameter: 10 ** rng.randint(0, 3) for parameter in parameters }
+	names = { parameter: lab_bytes(parameter) for parameter in parameters }
+
+	patients_map = []
+	exports = [open(f'{root}/a_lab_results_raw/export{i}.csv', 'wb') for i in range(files)]
+	rows = 0
+	try:
+		for export in exports:
+			export.write((';'.join(raw_columns) + '\r\n').encode('cp1252'))
+
+		for k in range(patients + unmapped_patients):
+			patient_8_digit = first_patient + k * 7
+			patient_9_digit = patient_8_digit * 10 + rng.randint(0, 9)
+			day0 = initial_day_of_study + timedelta(days = rng.randint(0, 365))
+			if k < patients:
+				patients_map.append((patient_8_digit, 100 + k, day0))
+
+			for patifallnr, time, parameter, result in patient_rows(rng, patient_9_digit, day0, parameters, reference_parameter, days, samples_per_day, scales):
+				rows += 1
+				prefix = f'{rng.randint(10**7, 10**8 - 1)};{patifallnr:09d};01.01.1950;{rng.choice("MW")};X;{time.strftime("%d.%m.%Y %H:%M")};'
+				rng.choice(exports).write(prefix.encode('cp1252') + names[parameter] + f';{result}\r\n'.encode('cp1252'))
+	finally:
+		for export in exports:
+			export.close()
+
+	pd.DataFrame(patients_map, columns = ['PATIFALLNR', 'LFDNR', 'DAY0']).to_excel(f'{root}/patients_map.xlsx', index = False)
+	return rows
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(description = 'Writes a synthetic study directory (raw lab exports, patients map) to benchmark and test the pipeline')
+	parser.add_argument('root', help = 'study directory to write')
+	parser.add_argument('--patients', type = int, default = 100)
+	parser.add_argument('--days', type = int, default = 20, help = 'days with results per patient, at most')
+	parser.add_argument('--samples-per-day', type = int, default = 2, help = 'samples of a parameter per day, at most')
+	parser.add_argument('--files', type = int, default = 2, help = 'raw exports to spread the rows over')
+	parser.add_argument('--unmapped-patients', type = int, default = 1, help = 'patients with results that are not in the map')
+	parser.add_argument('--seed', type = int, default = 0)
+	parser.add_argument('--first-patient', type = int, default = 20000000, help = '8-digit PATIFALLNR of the first patient, below 10000000 for identifiers starting with a zero')
+	args = parser.parse_args(argv)
+
+	rows = write_cohort(args.root, args.patients, args.days, args.samples_per_day, args.files, args.seed, args.unmapped_patients, first_patient = args.first_patient)
+	print(f'{rows} rows of {args.patients} patients written to {args.root}')
+
+# END SYNTHETIC COHORT
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,106 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+
+# START TIMESTAMPS
+# LABEINDAT (and DAY0 of the patients map) are parsed with the formats the lab and the map are known to use, without
+# format inference. The lab format dd.mm.yyyy HH:MM is rearranged into ISO text and parsed by numpy in one go; values with
+# another shape go through the other known formats one by one, and only values matching none of them fall back to
+# pd.to_datetime(dayfirst = True), as before. Each distinct text is parsed once per process: parses are cached, since
+# the same timestamps come back in every patient and every run of the merged results.
+
+lab_timestamp_format = '%d.%m.%Y %H:%M'
+other_timestamp_formats = ['%d.%m.%Y %H:%M:%S', '%d.%m.%Y', '%d-%m-%Y', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
+
+# text -> datetime64[ns]; emptied when full
+parsed_timestamps = {}
+parsed_timestamps_max_entries = 1000000
+
+def lab_iso(text):
+	'''dd.mm.yyyy HH:MM as yyyy-mm-ddTHH:MM, None for text of another shape'''
+	if len(text) == 16 and text[2] == '.' and text[5] == '.' and text[10] == ' ' and text[13] == ':':
+		return f'{text[6:10]}-{text[3:5]}-{text[0:2]}T{text[11:16]}'
+	return None
+
+def parse_timestamp(value):
+	'''One value with any of the other known formats, or as pd.to_datetime(dayfirst = True) understands it'''
+	if isinstance(value, str):
+		text = value.strip()
+		for timestamp_format in other_timestamp_formats:
+			try:
+				return np.datetime64(datetime.strptime(text, timestamp_format), 'ns')
+			except ValueError:
+				pass
+	return pd.to_datetime(value, dayfirst = True).to_datetime64().astype('datetime64[ns]')
+
+def parse_or_fail(value, errors):
+	'''parse_timestamp, NaT for values it cannot parse if errors is 'coerce' '''
+	try:
+		return parse_timestamp(value)
+	except (ValueError, OverflowError, TypeError):
+		if errors == 'coerce':
+			return np.datetime64('NaT', 'ns')
+		raise
+
+def parse_new_timestamps(texts, errors = 'raise'):
+	'''datetime64[ns] of texts, none of them in the cache'''
+	isos = [lab_iso(text) for text in texts]
+	if all(iso is not None for iso in isos):
+		try:
+			return np.array(isos, dtype = 'datetime64[m]').astype('datetime64[ns]')
+		except ValueError:
+			# e.g. 31.02.2022 10:00; each text is parsed on its own below
+			pass
+
+	parsed = np.empty(len(texts), dtype = 'datetime64[ns]')
+	for i, (text, iso) in enumerate(zip(texts, isos)):
+		if iso is not None:
+			try:
+				parsed[i] = np.datetime64(iso, 'm')
+				continue
+			except ValueError:
+				pass
+		parsed[i] = parse_or_fail(text, errors)
+	return parsed
+
+def parse_timestamps(values, errors = 'raise'):
+	'''Array-like of timestamp texts (or of datetimes) to datetime64[ns]; missing values become NaT
+
+	Values that cannot be parsed raise, or become NaT if errors is 'coerce'.
+	'''
+	values = pd.Series(values)
+	if pd.api.types.is_datetime64_any_dtype(values.dtype):
+		return values.to_numpy(dtype = 'datetime64[ns]')
+
+	codes, uniques = pd.factorize(values)
+	uniques = np.asarray(uniques, dtype = object)
+
+	parsed = np.empty(len(uniques), dtype = 'datetime64[ns]')
+	missing = []
+	for i, value in enumerate(uniques):
+		cached = parsed_timestamps.get(value) if isinstance(value, str) else None
+		if cached is None:
+			missing.append(i)
+		else:
+			parsed[i] = cached
+
+	if len(missing) > 0:
+		texts = [ uniques[i] for i in missing ]
+		if all(isinstance(text, str) for text in texts):
+			new = parse_new_timestamps(texts, errors)
+		else:
+			# datetimes read from excel files, mixed with texts
+			new = np.array([ parse_or_fail(value, errors) for value in texts ], dtype = 'datetime64[ns]')
+		parsed[missing] = new
+
+		if len(parsed_timestamps) + len(missing) > parsed_timestamps_max_entries:
+			parsed_timestamps.clear()
+		# values that could not be parsed are not cached, so that they raise again where errors is 'raise'
+		parsed_timestamps.update((text, timestamp) for text, timestamp in zip(texts, new) if isinstance(text, str) and not np.isnat(timestamp))
+
+	# missing values have code -1, i.e. the NaT appended at the end
+	return np.append(parsed, np.datetime64('NaT', 'ns'))[codes]
+
+# END TIMESTAMPS
@@ -0,0 +1,105 @@
+import os
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+
+# START FINAL WORKBOOK WRITER
+# The final workbook is opened once and all sheets are written in a single pass. With xlsxwriter installed, rows are
+# streamed in constant memory mode (each row is flushed to disk as soon as the next one starts); otherwise the sheets go
+# through a single pandas ExcelWriter with openpyxl. Either way the layout is the one of DataFrame.to_excel.
+
+header_style = {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}
+
+# Results are written as numbers, not as text. With the General format the decimal separator is the one of the locale of
+# excel, so a German excel shows 3,4; any other excel number format (e.g. '0.00') can be set here.
+result_style = {'num_format': 'General'}
+
+def streaming_engine_available():
+	try:
+		import xlsxwriter
+	except ImportError:
+		return False
+	return True
+
+def header_runs(labels_per_level, level):
+	'''(start, stop) of the runs of equal labels of level, a run also ending when an outer level changes'''
+	runs = []
+	start = 0
+	for i in range(1, len(labels_per_level[level]) + 1):
+		if i == len(labels_per_level[level]) or any(labels_per_level[l][i] != labels_per_level[l][start] for l in range(level + 1)):
+			runs.append((start, i))
+			start = i
+	return runs
+
+def write_dataframe_rows(worksheet, df, header_format, result_format = None):
+	'''Writes df row by row, with merged header cells for the outer column levels as DataFrame.to_excel does'''
+	levels = df.columns.nlevels
+	labels_per_level = [df.columns.get_level_values(level) for level in range(levels)]
+
+	for level in range(levels):
+		worksheet.write(level, 0, df.columns.names[level], header_format)
+		if level < levels - 1:
+			for start, stop in header_runs(labels_per_level, level):
+				if stop - start > 1:
+					worksheet.merge_range(level, start + 1, level, stop, labels_per_level[level][start], header_format)
+				else:
+					worksheet.write(level, start + 1, labels_per_level[level][start], header_format)
+		else:
+			for i, label in enumerate(labels_per_level[level]):
+				worksheet.write(level, i + 1, label, header_format)
+
+	# index name row
+	worksheet.write(levels, 0, df.index.name, header_format)
+
+	values = df.to_numpy(dtype = object)
+	for i, label in enumerate(df.index):
+		row = values[i]
+		row = np.where(pd.isna(row), None, row)
+		worksheet.write(levels + 1 + i, 0, label, header_format)
+		worksheet.write_row(levels + 1 + i, 1, row, result_format)
+
+def sheet_bytes(filepath, number_of_sheets):
+	'''Compressed size of each sheet inside the xlsx file'''
+	with zipfile.ZipFile(filepath) as archive:
+		return [ archive.getinfo(f'xl/worksheets/sheet{s+1}.xml').compress_size for s in range(number_of_sheets) ]
+
+def write_workbook(filepath, sheets):
+	'''Writes the sheets, an iterable of (sheet name, dataframe), into a new workbook at filepath
+
+	The dataframes are consumed one at a time. Returns one dictionary per sheet with its name, seconds spent and bytes written.
+	'''
+	os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+	report = []
+
+	if streaming_engine_available():
+		import xlsxwriter
+		workbook = xlsxwriter.Workbook(filepath, {'constant_memory': True})
+		header_format = workbook.add_format(header_style)
+		result_format = workbook.add_format(result_style)
+		for sheetname, df in sheets:
+			start = time.perf_counter()
+			write_dataframe_rows(workbook.add_worksheet(sheetname), df, header_format, result_format)
+			report.append({'sheet': sheetname, 'seconds': time.perf_counter() - start})
+		start = time.perf_counter()
+		workbook.close()
+	else:
+		with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
+			for sheetname, df in sheets:
+				start = time.perf_counter()
+				df.to_excel(writer, sheet_name=sheetname)
+				report.append({'sheet': sheetname, 'seconds': time.perf_counter() - start})
+			start = time.perf_counter()
+
+	# Serializing happens (at least partly) when closing; spread it over the sheets by size
+	closing_seconds = time.perf_counter() - start
+	sizes = sheet_bytes(filepath, len(report))
+	for entry, size in zip(report, sizes):
+		entry['bytes'] = size
+		entry['seconds'] += closing_seconds * size / max(sum(sizes), 1)
+
+	return report
+
+# END FINAL WORKBOOK WRITER